@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -62,6 +64,10 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    # Server-Timing headers and timing logs while profiling is on
+    'melodies.middleware.ProfilingMiddleware',
+    # request counts and latency histograms for /api/chants/metrics/
+    'melodies.middleware.MetricsMiddleware',
     # CORS
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -105,16 +111,78 @@ _default_db_path = os.path.join(BASE_DIR, 'data', 'chants.db')
 os.makedirs(os.path.dirname(_default_db_path), exist_ok=True)
 DATABASE_NAME = os.getenv('DATABASE_PATH', _default_db_path)
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': DATABASE_NAME,
-        'USER': 'root',
-        'PASSWORD': '123456',
-        'HOST': '127.0.0.1',
-        'PORT': '3306',
+# Memory-mapped columnar copy of the default datasets shared by all workers,
+# written by `manage.py build_default_snapshot`. Missing file = SQL only.
+DEFAULT_SNAPSHOT_PATH = os.getenv(
+    'DEFAULT_SNAPSHOT_PATH',
+    os.path.join(os.path.dirname(DATABASE_NAME), 'default_datasets.snapshot'),
+)
+
+# Separate SQLite file with the default datasets, built offline by
+# `manage.py build_default_database` and attached read-only to every
+# connection (melodies/database.py). Missing file = defaults in DATABASE_PATH.
+DEFAULT_DATABASE_PATH = os.getenv(
+    'DEFAULT_DATABASE_PATH',
+    os.path.join(os.path.dirname(DATABASE_NAME), 'default_datasets.db'),
+)
+
+# DATABASE_ENGINE=postgresql stores everything in PostgreSQL instead, for
+# many users writing at once; it is configured by the POSTGRES_* variables
+# and needs the CREATEDB privilege to run the tests.
+DATABASE_ENGINE = os.getenv('DATABASE_ENGINE', 'sqlite')
+# Keep a worker's connection (and its pragmas and page cache) for this many
+# seconds instead of reconnecting on every request.
+DATABASE_CONN_MAX_AGE = int(os.getenv('DATABASE_CONN_MAX_AGE', '600'))
+
+if DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': DATABASE_NAME,
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'OPTIONS': {
+                # Seconds a statement waits for another worker's write lock
+                # before failing with "database is locked".
+                'timeout': float(os.getenv('DATABASE_BUSY_TIMEOUT', '30')),
+            },
+        }
+    }
+elif DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'chantlab'),
+            'USER': os.getenv('POSTGRES_USER', 'chantlab'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        }
     }
+else:
+    raise ImproperlyConfigured('DATABASE_ENGINE must be sqlite or postgresql')
+
+# Pragmas run on every new SQLite connection (melodies/database.py).
+# 'wal': readers do not block on a writer and the writer does not block
+# readers; synchronous=NORMAL syncs at checkpoints only (a power loss can
+# drop the last transactions, never corrupt the file); the file is
+# memory-mapped and shared between the workers, and every connection keeps
+# a 64 MiB page cache. 'default' keeps SQLite's rollback journal and
+# defaults. journal_mode is stored in the file: switching back to
+# 'default' keeps WAL until it is changed with `PRAGMA journal_mode=delete`.
+SQLITE_PROFILES = {
+    'default': {},
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'memory',
+    },
 }
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'wal')
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ImproperlyConfigured('SQLITE_PROFILE must be one of: {}'.format(', '.join(SQLITE_PROFILES)))
 
 
 # Password validation
@@ -169,7 +237,53 @@ CORS_ORIGIN_ALLOW_ALL = True
 
 # Directory with mafft temporary files
 TEMP_DIR = 'mafft-temp'
+# MAFFT strategy of alignments: empty keeps the MAFFT defaults, 'auto'
+# picks one by input size (core.mafft.MAFFT_STRATEGY_THRESHOLDS, not yet
+# calibrated with `manage.py benchmark_mafft_strategies`), any other value
+# names a core.mafft.MAFFT_STRATEGIES entry.
+MAFFT_STRATEGY = os.getenv('MAFFT_STRATEGY', '') or None
 
 
 # Directory with mrbayes temporary files
 MRBAYES_TEMP_DIR = 'mrbayes-temp'
+# Consensus trees of finished MrBayes analyses, keyed by the job hash
+MRBAYES_RESULTS_DIR = os.path.join(MRBAYES_TEMP_DIR, 'results')
+
+# MrBayes stops once the average standard deviation of split frequencies
+# (ASDSF) across runs drops below this value (0.01 is the usual choice).
+# Off by default, which runs the full ngen; deployments opt in by setting it.
+MRBAYES_STOPVAL = float(os.getenv('MRBAYES_STOPVAL', '') or 0) or None
+# Wall-clock budget of one MrBayes run in seconds; the trees sampled so far
+# are summarized when it runs out. Empty means no limit.
+MRBAYES_MAX_SECONDS = float(os.getenv('MRBAYES_MAX_SECONDS', '') or 0) or None
+
+# Admission control for heavy computations, shared by all workers. 'global'
+# and 'per_client' limit concurrent runs, 'max_queued' the requests waiting
+# for a slot, 'queue_timeout' how long they wait in seconds and 'budget' the
+# largest estimated cost accepted: total volpiano length for alignments,
+# generations x taxa for MrBayes. A waiting request holds a gunicorn worker,
+# so the sum of every 'global' and 'max_queued' must stay below the 4
+# workers to keep one free for interactive endpoints; by default busy
+# requests are answered 429 with Retry-After instead of queued.
+COMPUTE_LIMITS = {
+    'align': {'global': 2, 'per_client': 1, 'max_queued': 0, 'queue_timeout': 0, 'budget': 2000000},
+    'mrbayes': {'global': 1, 'per_client': 1, 'max_queued': 0, 'queue_timeout': 0, 'budget': 2000000000},
+}
+COMPUTE_POLL_SECONDS = 0.5
+
+# Reverse proxies whose X-Forwarded-For header names the client address,
+# e.g. '127.0.0.1' behind a local nginx. Other clients could forge it.
+TRUSTED_PROXIES = [address for address in os.getenv('TRUSTED_PROXIES', '').split(',') if address]
+
+# Request profiling: stage timings in Server-Timing headers and one JSON log
+# line per request. Always on with PROFILING=True, otherwise while the flag
+# file exists (`manage.py profiling on|off`).
+PROFILING = os.getenv('PROFILING', 'False') == 'True'
+PROFILING_FLAG_FILE = os.getenv('PROFILING_FLAG_FILE', os.path.join(os.path.dirname(DATABASE_NAME), 'profiling.enabled'))
+
+# Metrics: every worker writes its counters and histograms to its own file
+# in METRICS_DIR at most every METRICS_FLUSH_SECONDS; /api/chants/metrics/
+# merges them in the Prometheus text format for the listed addresses.
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(os.path.dirname(DATABASE_NAME), 'metrics'))
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+METRICS_ALLOWED_ADDRESSES = os.getenv('METRICS_ALLOWED_ADDRESSES', '127.0.0.1,::1').split(',')
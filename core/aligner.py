@@ -2,16 +2,19 @@ import os
 import re
 import uuid
 import logging
+from contextlib import contextmanager
 from django.http.response import JsonResponse
 from rest_framework import status
 from pycantus.volpiano.utils import normalize_liquescents
  
 
-from melodies.models import Chant
+from melodies.models import VisibleChant
+from melodies.snapshot import SNAPSHOT_FIELDS, get_snapshot
 
+from core import profiling
 from core.chant_processor import ChantProcessor
 from core.interval_processor import IntervalProcessor
-from core.mafft import Mafft
+from core.mafft import CONCATENATE_PLACEHOLDER, Mafft
 from django.conf import settings
 
 class Aligner():
@@ -136,15 +139,12 @@ class Aligner():
         '''
         Align chants using MSA on pitch values
         '''
-        # Dealing with alignment temporary files to avoid elementary race conditions.
-        temp_dir = settings.TEMP_DIR
-        if not os.path.isdir(temp_dir):
-            os.mkdir(temp_dir)
+        with cls._mafft_inputs() as mafft_inputs_path:
+            return cls._alignment_pitches(mafft_inputs_path, ids, concatenated, keep_liquescents)
 
-        mafft_job_name = str(uuid.uuid4().hex)
-        mafft_inputs_temp_file_name = mafft_job_name + '_mafft-inputs.txt'
-        mafft_inputs_path = os.path.join(temp_dir, mafft_inputs_temp_file_name)
 
+    @classmethod
+    def _alignment_pitches(cls, mafft_inputs_path, ids, concatenated, keep_liquescents):
         # Make sure the file is empty:
         cls._cleanup(mafft_inputs_path)
 
@@ -153,10 +153,8 @@ class Aligner():
         mafft.set_input(mafft_inputs_path)#.replace("\\", "/")) 
         mafft.add_option('--text')
         mafft.add_option('--textmatrix resources/00_textmatrix_complete')
+        mafft.set_strategy(settings.MAFFT_STRATEGY)
 
-        # save errors
-        error_sources = []
-        error_ids = []
         finished = False
 
         # iterate until there are no alignment errors
@@ -169,11 +167,6 @@ class Aligner():
             #print('Aligning IDs: {}'.format(ids))
             #print('Aligning names: {}'.format(names))
 
-            success_sources = []
-            success_ids = []
-            success_volpianos = []
-            success_urls = []
-
             for i, (volpiano, cantus_id, siglum) in enumerate(zip(volpianos, cantus_ids, siglums)):
                 mafft.add_volpiano(ChantProcessor.process_volpiano_flats(volpiano), i, cantus_id, siglum)
 
@@ -200,9 +193,6 @@ class Aligner():
 
 
             # try aligning melody and text
-            text_syllabified = [ChantProcessor.get_syllables_from_text(text) for text in texts] # - removed text from mafft alignment
-            chants = []
-
             if concatenated:
                 # reorder volpiano_map, ordered_siglums
                 volpiano_map = [volpiano_map[i] for i in melody_order]
@@ -222,51 +212,24 @@ class Aligner():
             else:
                 aligned_melodies_with_text_boundaries = Mafft.add_text_boundaries(aligned_melodies, volpianos, melody_order, keep_liquescents=keep_liquescents)
 
-            for i, id in enumerate(melody_order):
-                try:
-                    aligned_chant_with_text, is_text_compatible = cls._get_volpiano_text_JSON(aligned_melodies_with_text_boundaries[i], text_syllabified[id] if id != -1 else [])
-                    chants.append(aligned_chant_with_text)
-                    if not concatenated:
-                        success_volpianos.append(aligned_melodies[i])
-                    if id != -1:
-                        success_sources.append(sources[id])
-                        success_ids.append(ids[id])
-                        success_urls.append(urls[id])
-                    if not is_text_compatible:
-                        raise RuntimeError("Unequal text and alpiano word/syllable counts")
-                except RuntimeError as e:
-                    # found an error, the alignment will be run again
-                    # finished = False
-                    logging.error(str(e))
-                    if id != -1:
-                        error_sources.append(sources[id])
-                        error_ids.append(ids[id])
+            chants, errors, success = cls._chants_with_text(
+                aligned_melodies_with_text_boundaries, melody_order, ids, sources, urls, texts,
+                aligned=None if concatenated else aligned_melodies)
 
             cls._cleanup(mafft_inputs_path)   # Comment out this cleanup to retain MAFFT output files
         if concatenated:
-            success_volpianos = aligned_melodies
-            success_sources = ordered_siglums
-            success_ids = [[ids[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)]
-            success_urls = [[urls[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)]
+            success = cls._concatenated_success(aligned_melodies, ordered_siglums, volpiano_map, ids, urls)
             grouped_chants = list(map(list, zip(*[chants[i:i + len(ordered_siglums)] for i in range(0, len(chants), len(ordered_siglums))])))
             chants = [[item for sublist in group for item in sublist] for group in grouped_chants]
         else:
             # remove unused newick names
-            used_ids = set(success_ids)
+            used_ids = set(success['ids'])
             newick_names_dict = {name: id for name, id in newick_names_dict.items() if id in used_ids}
 
         result = {
             'chants': chants,
-            'errors': {
-                "sources": error_sources,
-                "ids": error_ids
-            }, 
-            'success': {
-                'sources': success_sources,
-                'ids': success_ids,
-                'volpianos': success_volpianos,
-                'urls': success_urls,
-            },
+            'errors': errors,
+            'success': success,
             'guideTree': guide_tree,
             'newickNamesDict': newick_names_dict,
             'alignmentMode': 'full'
@@ -280,15 +243,13 @@ class Aligner():
         '''
         Align chants using MSA on interval values
         '''
-        logging.info('DEBUG: running MAFFT intervals with ids {}'.format(ids))
+        with cls._mafft_inputs() as mafft_inputs_path:
+            return cls._alignment_intervals(mafft_inputs_path, ids, concatenated, keep_liquescents)
 
-        temp_dir = settings.TEMP_DIR
-        if not os.path.isdir(temp_dir):
-            os.mkdir(temp_dir)
 
-        mafft_job_name = str(uuid.uuid4().hex)
-        mafft_inputs_temp_file_name = mafft_job_name + '_mafft-inputs.txt'
-        mafft_inputs_path = os.path.join(temp_dir, mafft_inputs_temp_file_name)
+    @classmethod
+    def _alignment_intervals(cls, mafft_inputs_path, ids, concatenated, keep_liquescents):
+        logging.info('DEBUG: running MAFFT intervals with ids {}'.format(ids))
 
         # Make sure the file is empty:
         cls._cleanup(mafft_inputs_path)
@@ -298,11 +259,9 @@ class Aligner():
         mafft.set_input(mafft_inputs_path)#.replace("\\", "/"))
         mafft.add_option('--text')
         mafft.add_option('--textmatrix resources/mafft_interval_matrix')
+        mafft.set_strategy(settings.MAFFT_STRATEGY)
 
 
-        # save errors
-        error_sources = []
-        error_ids = []
         finished = False
 
         # iterate until there are no alignment errors
@@ -311,11 +270,6 @@ class Aligner():
 
             sources, urls, texts, volpianos, newick_names, siglums, cantus_ids = cls._get_alignment_data_from_db(ids, keep_liquescents=keep_liquescents)
 
-            success_sources = []
-            success_ids = []
-            success_volpianos = []
-            success_urls = []
-
             for i, (volpiano, cantus_id, siglum) in enumerate(zip(volpianos, cantus_ids, siglums)):
                 interval_repr = IntervalProcessor.transform_volpiano_to_intervals(
                     ChantProcessor.process_volpiano_flats(volpiano))
@@ -353,14 +307,8 @@ class Aligner():
                                                             for vol_j, al_vol in enumerate(al_vols.split("#"))]) 
                                                             for vol_i, al_vols in enumerate(aligned_melodies_volpianos)]
             else:
-                aligned_melodies_volpianos = [IntervalProcessor.transform_intervals_to_volpiano(intervals)
-                    for intervals in aligned_melodies_intervals
-                ]
-                if keep_liquescents: # reconstruct liquenscents
-                    aligned_melodies_volpianos = [
-                        ChantProcessor.reconstruct_liquenscents(al_vol, volpianos[vol_id]) for al_vol, vol_id in zip(aligned_melodies_volpianos, volpiano_map) 
-                    ]
-                        
+                aligned_melodies_volpianos = cls._volpianos_from_intervals(
+                    aligned_melodies_intervals, volpianos, sequence_order, keep_liquescents)
 
 
             logging.info('DEBUG: Aligned melodies volpianos:')
@@ -369,8 +317,6 @@ class Aligner():
 
 
             # try aligning melody and text
-            text_syllabified = [ChantProcessor.get_syllables_from_text(text) for text in texts]
-            chants = []
             if concatenated:
                 #aligned_melodies_volpianos = [mel for _, mel in sorted({id: aligned_melodies_volpianos[i] for i, id in enumerate(sequence_order)}.items())]
                 alignment = [mel.split("#") for mel in aligned_melodies_volpianos]
@@ -386,53 +332,26 @@ class Aligner():
             else:
                 aligned_melodies_with_text_boundaries = Mafft.add_text_boundaries(aligned_melodies_volpianos, volpianos, sequence_order, keep_liquescents=keep_liquescents)
 
-            for i, id in enumerate(sequence_order):
-                try:
-                    aligned_chant_with_text, is_text_compatible = cls._get_volpiano_text_JSON(aligned_melodies_with_text_boundaries[i], text_syllabified[id] if id != -1 else [])
-                    chants.append(aligned_chant_with_text)
-                    if not concatenated:
-                        success_volpianos.append(aligned_melodies_intervals[i])
-                    if id != -1:
-                        success_sources.append(sources[id])
-                        success_ids.append(ids[id])
-                        success_urls.append(urls[id])
-                    if not is_text_compatible:
-                        raise RuntimeError("Unequal text and alpiano word/syllable counts")
-                except RuntimeError as e:
-                    # found an error, the alignment will be run again
-                    # finished = False
-                    logging.error(str(e))
-                    if id != -1:
-                        error_sources.append(sources[id])
-                        error_ids.append(ids[id])
+            chants, errors, success = cls._chants_with_text(
+                aligned_melodies_with_text_boundaries, sequence_order, ids, sources, urls, texts,
+                aligned=None if concatenated else aligned_melodies_intervals)
 
             cls._cleanup(mafft_inputs_path)
 
         cls._cleanup(mafft_inputs_path)
         if concatenated:
-            success_volpianos = aligned_melodies_intervals
-            success_sources = ordered_siglums
-            success_ids = [[ids[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)]
-            success_urls = [[urls[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)]
+            success = cls._concatenated_success(aligned_melodies_intervals, ordered_siglums, volpiano_map, ids, urls)
             grouped_chants = list(map(list, zip(*[chants[i:i + len(ordered_siglums)] for i in range(0, len(chants), len(ordered_siglums))])))
             chants = [[item for sublist in group for item in sublist] for group in grouped_chants]
         else:
             # remove unused newick names
-            used_ids = set(success_ids)
+            used_ids = set(success['ids'])
             newick_names_dict = {name: id for name, id in newick_names_dict.items() if id in used_ids}
 
         result = {
             'chants': chants,
-            'errors': {
-                "sources": error_sources,
-                "ids": error_ids
-            }, 
-            'success': {
-                'sources': success_sources,
-                'ids': success_ids,
-                'volpianos': success_volpianos,
-                'urls': success_urls,
-            },
+            'errors': errors,
+            'success': success,
             'guideTree': guide_tree,
             'newickNamesDict': newick_names_dict,
             'alignmentMode': 'intervals'
@@ -440,6 +359,122 @@ class Aligner():
 
         return result
 
+    @classmethod
+    def extend_alignment(cls, ids, aligned_sequences, new_ids, mode, keep_liquescents=True, fragments=False):
+        '''
+        Add chants to an existing (non-concatenated) MAFFT alignment with
+        MAFFT --add instead of realigning everything. `aligned_sequences` are
+        the 'success.volpianos' of a previous 'full' or 'intervals' result,
+        in the order of `ids`.
+        '''
+        all_ids = list(ids) + list(new_ids)
+        alignment_data = cls._get_alignment_data_from_db(all_ids, keep_liquescents=keep_liquescents)
+        if isinstance(alignment_data, JsonResponse):
+            return alignment_data
+        sources, urls, texts, volpianos, newick_names, siglums, cantus_ids = alignment_data
+
+        with cls._mafft_inputs() as mafft_inputs_path:
+            mafft = Mafft()
+            mafft.set_input(mafft_inputs_path)
+            mafft.add_option('--text')
+            if mode == 'intervals':
+                mafft.add_option('--textmatrix resources/mafft_interval_matrix')
+            else:
+                mafft.add_option('--textmatrix resources/00_textmatrix_complete')
+
+            for i in range(len(ids), len(all_ids)):
+                sequence = ChantProcessor.process_volpiano_flats(volpianos[i])
+                if mode == 'intervals':
+                    sequence = IntervalProcessor.transform_volpiano_to_intervals(sequence)
+                mafft.add_volpiano(sequence, i, cantus_ids[i], siglums[i])
+
+            try:
+                mafft.run_add(aligned_sequences, fragments=fragments)
+                aligned = mafft.get_aligned_sequences()
+                melody_order = mafft.get_sequence_order()
+            except RuntimeError as e:
+                logging.error(str(e))
+                return JsonResponse({'message': 'There was a problem with MAFFT runtime'},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Text boundaries are padded jointly over all rows, so they are
+        # recomputed for the merged alignment; MAFFT is the expensive part.
+        if mode == 'intervals':
+            aligned_volpianos = cls._volpianos_from_intervals(aligned, volpianos, melody_order, keep_liquescents)
+        else:
+            aligned_volpianos = aligned
+        aligned_with_text_boundaries = Mafft.add_text_boundaries(
+            aligned_volpianos, volpianos, melody_order, keep_liquescents=keep_liquescents)
+        chants, errors, success = cls._chants_with_text(
+            aligned_with_text_boundaries, melody_order, all_ids, sources, urls, texts, aligned=aligned)
+
+        used_ids = set(success['ids'])
+        newick_names_dict = {name: id for id, name in zip(all_ids, newick_names) if id in used_ids}
+
+        return {
+            'chants': chants,
+            'errors': errors,
+            'success': success,
+            # MAFFT --add keeps the existing rows and builds no guide tree
+            # for the merged alignment
+            'guideTree': None,
+            'newickNamesDict': newick_names_dict,
+            'alignmentMode': 'intervals' if mode == 'intervals' else 'full'
+        }
+
+    @classmethod
+    def _volpianos_from_intervals(cls, aligned_intervals, volpianos, melody_order, keep_liquescents):
+        '''Volpianos of the aligned interval rows of a non-concatenated alignment'''
+        aligned_volpianos = [IntervalProcessor.transform_intervals_to_volpiano(intervals)
+                             for intervals in aligned_intervals]
+        if keep_liquescents: # reconstruct liquenscents
+            aligned_volpianos = [ChantProcessor.reconstruct_liquenscents(al_vol, volpianos[vol_id])
+                                 for al_vol, vol_id in zip(aligned_volpianos, melody_order)]
+        return aligned_volpianos
+
+    @classmethod
+    def _chants_with_text(cls, aligned_with_text_boundaries, melody_order, ids, sources, urls, texts, aligned=None):
+        '''
+        Combine every aligned row (with text boundaries) with the syllables
+        of its text; returns the chants and the 'errors' and 'success' parts
+        of the result. Chants whose text does not fit their melody are
+        listed in both. `aligned` are the rows reported as success volpianos;
+        melody_order entries of -1 are concatenation placeholders.
+        '''
+        with profiling.stage('syllabify'):
+            text_syllabified = [ChantProcessor.get_syllables_from_text(text) for text in texts]
+        chants = []
+        errors = {'sources': [], 'ids': []}
+        success = {'sources': [], 'ids': [], 'volpianos': [], 'urls': []}
+        for i, id in enumerate(melody_order):
+            try:
+                aligned_chant_with_text, is_text_compatible = cls._get_volpiano_text_JSON(aligned_with_text_boundaries[i], text_syllabified[id] if id != -1 else [])
+                chants.append(aligned_chant_with_text)
+                if aligned is not None:
+                    success['volpianos'].append(aligned[i])
+                if id != -1:
+                    success['sources'].append(sources[id])
+                    success['ids'].append(ids[id])
+                    success['urls'].append(urls[id])
+                if not is_text_compatible:
+                    raise RuntimeError("Unequal text and alpiano word/syllable counts")
+            except RuntimeError as e:
+                logging.error(str(e))
+                if id != -1:
+                    errors['sources'].append(sources[id])
+                    errors['ids'].append(ids[id])
+        return chants, errors, success
+
+    @classmethod
+    def _concatenated_success(cls, aligned, ordered_siglums, volpiano_map, ids, urls):
+        '''The 'success' part of a concatenated alignment: one row per source'''
+        return {
+            'sources': ordered_siglums,
+            'ids': [[ids[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)],
+            'volpianos': aligned,
+            'urls': [[urls[j] for j in volpiano_map[i] if j != -1] for i, _ in enumerate(ordered_siglums)],
+        }
+
     @classmethod
     def _group_volpianos(cls, volpianos, map, subseq_id):
         grouped_volpianos = []
@@ -451,6 +486,7 @@ class Aligner():
         return grouped_volpianos
 
     @classmethod
+    @profiling.staged('syllable_alignment')
     def _get_volpiano_syllable_alignment(cls, volpianos):
         # extend each word to the same number of syllables
         # and each syllables to the same number of characters
@@ -620,17 +656,92 @@ class Aligner():
         return complete_volpiano
 
 
+    @classmethod
+    @contextmanager
+    def _mafft_inputs(cls):
+        '''
+        Path of a new MAFFT input file in settings.TEMP_DIR; it and the files
+        MAFFT writes next to it are removed however the alignment ends, also
+        when MAFFT fails or is killed by a cancellation
+        '''
+        temp_dir = settings.TEMP_DIR
+        if not os.path.isdir(temp_dir):
+            os.mkdir(temp_dir)
+        mafft_inputs_path = os.path.join(temp_dir, str(uuid.uuid4().hex) + '_mafft-inputs.txt')
+        try:
+            yield mafft_inputs_path
+        finally:
+            cls._cleanup(mafft_inputs_path)
+
+
     @classmethod
     def _cleanup(cls, file):
-        if os.path.exists(file):
-            os.remove(file)
+        for path in (file, file + '.tree', file + '.add', file + '.' + CONCATENATE_PLACEHOLDER):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    @classmethod
+    def _get_chants(cls, ids):
+        '''
+        Fetch the chants to align in one pass: default chants come from the
+        shared snapshot when one is loaded, the rest from a single query
+        '''
+        chants = {}
+        remaining = list(ids)
+        snapshot = get_snapshot()
+        if snapshot is not None and remaining:
+            rows = snapshot.rows_for_ids(remaining)
+            for record in snapshot.records(rows[rows >= 0], SNAPSHOT_FIELDS):
+                chants[record['id']] = VisibleChant(**record)
+            remaining = [id for id, row in zip(remaining, rows.tolist()) if row < 0]
+        if remaining:
+            chants.update(VisibleChant.objects.in_bulk(remaining))
+        return chants
+
+
+    @classmethod
+    def get_volpiano_lengths(cls, ids):
+        '''
+        Volpiano lengths of the chants that exist among `ids`, used to
+        estimate the cost of aligning them
+        '''
+        chants_by_id = cls._get_chants(ids)
+        return [len(chants_by_id[id].volpiano or '') for id in ids if id in chants_by_id]
+
+
+    @classmethod
+    def _unique_newick_name(cls, chant, used_newick_names):
+        newick_name = ChantProcessor.build_chant_newick_name(chant)
+        if newick_name in used_newick_names:
+            counter = 0
+            while newick_name + "_" + str(counter) in used_newick_names:
+                counter += 1
+            newick_name += "_" + str(counter)
+        used_newick_names.add(newick_name)
+        return newick_name
+
 
-        treefile = file + '.tree'
-        if os.path.exists(treefile):
-            os.remove(treefile)
+    @classmethod
+    def get_newick_names(cls, ids):
+        '''
+        Newick names of the chants, in the same order and made unique the
+        same way as in alignment results
+        '''
+        used_newick_names = set()
+        chants_by_id = cls._get_chants(ids)
+        newick_names = []
+        for id in ids:
+            chant = chants_by_id.get(id)
+            if chant is None:
+                return JsonResponse({'message': 'Chant with id ' + str(id) + ' does not exist'},
+                    status=status.HTTP_404_NOT_FOUND)
+            newick_names.append(cls._unique_newick_name(chant, used_newick_names))
+        return newick_names
 
 
     @classmethod
+    @profiling.staged('fetch')
     def _get_alignment_data_from_db(cls, ids, keep_liquescents=True):
         sources = []
         urls = []
@@ -640,33 +751,26 @@ class Aligner():
         siglums = []
         cantus_ids = []
         used_newick_names = set()
+        chants_by_id = cls._get_chants(ids)
         for id in ids:
-            try:
-                chant = Chant.objects.get(pk=id)
-
-                siglum = chant.siglum if chant.siglum else ""
-                position = chant.position if chant.position else ""
-                folio = chant.folio if chant.folio else ""
-                source = siglum + ", " + folio + ", " + position
-                cantus_id = chant.cantus_id if chant.cantus_id else ""
-                sources.append(source)
-
-                urls.append(chant.chantlink)
-
-                newick_name = ChantProcessor.build_chant_newick_name(chant)
-                if newick_name in used_newick_names:
-                    counter = 0
-                    while newick_name + "_" + str(counter) in used_newick_names:
-                        counter += 1
-                    newick_name += "_" + str(counter)
-                newick_names.append(newick_name)
-                used_newick_names.add(newick_name)
-                siglums.append(siglum)
-                cantus_ids.append(cantus_id)
-            except Chant.DoesNotExist:
+            chant = chants_by_id.get(id)
+            if chant is None:
                 return JsonResponse({'message': 'Chant with id ' + str(id) + ' does not exist'},
                     status=status.HTTP_404_NOT_FOUND)
 
+            siglum = chant.siglum if chant.siglum else ""
+            position = chant.position if chant.position else ""
+            folio = chant.folio if chant.folio else ""
+            source = siglum + ", " + folio + ", " + position
+            cantus_id = chant.cantus_id if chant.cantus_id else ""
+            sources.append(source)
+
+            urls.append(chant.chantlink)
+
+            newick_names.append(cls._unique_newick_name(chant, used_newick_names))
+            siglums.append(siglum)
+            cantus_ids.append(cantus_id)
+
             texts.append(chant.full_text if chant.full_text is not None else "")
             volpianos.append(chant.volpiano if chant.volpiano is not None else "")
         
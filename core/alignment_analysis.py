@@ -0,0 +1,93 @@
+from core.distances import DistanceCalculator
+
+PARTITION_SEPARATOR = '#'
+
+
+class AlignmentAnalyzer():
+    '''
+    The AlignmentAnalyzer class computes per-column statistics of an
+    alignment: consensus, entropy, gap fraction and variable sites
+    '''
+
+    @classmethod
+    def symbol_counts(cls, matrix):
+        '''
+        Return the non-gap symbols of an encoded alignment and a
+        (symbols, columns) array with how often each occurs in each column
+        '''
+        import numpy as np
+
+        symbols = np.array([symbol for symbol in np.unique(matrix)
+                            if symbol != DistanceCalculator.GAP], dtype=np.uint8)
+        counts = np.zeros((len(symbols), matrix.shape[1]), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            counts[i] = (matrix == symbol).sum(axis=0)
+        return symbols, counts
+
+    @classmethod
+    def column_statistics(cls, alpianos, offset=0):
+        '''
+        Statistics of every column of the aligned sequences. Column indices
+        in the site lists are shifted by `offset`.
+        '''
+        import numpy as np
+
+        matrix = DistanceCalculator.encode_alignment(alpianos)
+        rows, columns = matrix.shape
+        symbols, counts = cls.symbol_counts(matrix)
+        notes = counts.sum(axis=0)
+
+        consensus = np.full(columns, DistanceCalculator.GAP, dtype=np.uint8)
+        if len(symbols):
+            consensus = np.where(notes > 0, symbols[counts.argmax(axis=0)], consensus)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frequencies = np.where(notes > 0, counts / notes, 0.0)
+            entropy = -np.where(frequencies > 0, frequencies * np.log2(frequencies), 0.0).sum(axis=0)
+
+        states = (counts > 0).sum(axis=0)
+        # parsimony-informative: at least two states seen at least twice each
+        informative = (counts >= 2).sum(axis=0) >= 2
+        return {
+            'length': columns,
+            'consensus': consensus.tobytes().decode('ascii'),
+            'entropy': np.round(entropy + 0.0, 6).tolist(),
+            'gapFraction': np.round(1 - notes / rows, 6).tolist() if rows else [],
+            'variableSites': (np.flatnonzero(states > 1) + offset).tolist(),
+            'informativeSites': (np.flatnonzero(informative) + offset).tolist(),
+        }
+
+    @classmethod
+    def partition_statistics(cls, alpianos, partition_names=None):
+        '''
+        Statistics of every '#'-separated (Cantus ID) partition of a
+        concatenated alignment; site indices refer to the whole alignment
+        '''
+        split = [alpiano.split(PARTITION_SEPARATOR) for alpiano in alpianos]
+        partition_count = len(split[0]) if split else 0
+        if any(len(parts) != partition_count for parts in split):
+            raise ValueError('Aligned melodies have different partitions')
+        if partition_names and len(partition_names) < partition_count:
+            raise ValueError('The alignment has {} partitions but only {} partition names'.format(
+                partition_count, len(partition_names)))
+
+        partitions = []
+        offset = 0
+        for i, sequences in enumerate(zip(*split)):
+            statistics = cls.column_statistics(list(sequences), offset=offset)
+            statistics['start'] = offset
+            statistics['name'] = partition_names[i] if partition_names else str(i)
+            partitions.append(statistics)
+            offset += statistics['length'] + len(PARTITION_SEPARATOR)
+        return partitions
+
+    @classmethod
+    def analyze(cls, alpianos, partitions=False, partition_names=None):
+        if not alpianos:
+            raise ValueError('The alignment is empty')
+        result = cls.column_statistics(alpianos)
+        if partitions:
+            result['partitions'] = cls.partition_statistics(alpianos, partition_names)
+            result['consensus'] = PARTITION_SEPARATOR.join(
+                partition['consensus'] for partition in result['partitions'])
+        return result
@@ -9,7 +9,6 @@ import math
 import os
 import re
 
-import pandas as pd
 from django.conf import settings
 
 # Exact chants.csv columns from the published CantusCorpus v1.0 file.
@@ -117,6 +116,7 @@ def text_value(value):
         return None
     if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
         return None
+    import pandas as pd
     try:
         if pd.isna(value):
             return None
@@ -161,6 +161,8 @@ def _lookup_table(filename, name_column='name'):
     if cached is not None:
         return cached
 
+    import pandas as pd
+
     path = _static_csv_path(filename)
     id_to_name = {}
     name_to_id = {}
@@ -339,6 +341,8 @@ def normalize_chant_dataframe(df):
     Extra columns are dropped. Protected columns are ignored. Missing
     database columns are left absent so the caller can fill defaults.
     '''
+    import pandas as pd
+
     if df is None or not hasattr(df, 'columns'):
         raise UploadError('The uploaded file is not a valid CSV table')
     if len(df.index) > _MAX_UPLOAD_ROWS:
@@ -1,4 +1,3 @@
-import chant21
 # from cltk.phonology.lat.syllabifier import syllabify
 # from cltk.phonology.lat.transcription import Transcriber
 from volpiano_display_utilities.cantus_text_syllabification import syllabify_text
@@ -162,6 +161,10 @@ class ChantProcessor():
         '''
         Return an easily renderable representation of a chant
         '''
+        # chant21 pulls in music21, which is slow to import; only the
+        # chant display view needs it.
+        import chant21
+
         converter = chant21.cantus.ConverterCantusVolpiano(strict=False)
         converter.parseData(melody + '/' + text)
         chant = converter.stream
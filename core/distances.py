@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from core import metrics
+
+SCORE_MATRICES = {
+    'full': 'resources/00_textmatrix_complete',
+    'intervals': 'resources/mafft_interval_matrix',
+}
+METRICS = ('p', 'hamming', 'weighted')
+# Serialized distance matrices of recent alignments, keyed by alignment hash.
+DISTANCE_CACHE_SIZE = 32
+
+_DISTANCE_CACHE = OrderedDict()
+_DISTANCE_CACHE_LOCK = threading.Lock()
+_COST_TABLES = {}
+
+
+def load_score_matrix(path):
+    '''Read a MAFFT --textmatrix file into a symmetric {(a, b): score} dict.'''
+    matrix = {}
+    with open(path) as matrix_file:
+        for line in matrix_file:
+            parts = line.split('#', 1)[0].split()
+            if len(parts) != 3:
+                continue
+            first, second = chr(int(parts[0], 16)), chr(int(parts[1], 16))
+            matrix[(first, second)] = int(parts[2])
+            matrix.setdefault((second, first), int(parts[2]))
+    return matrix
+
+
+class DistanceCalculator():
+    '''
+    The DistanceCalculator class computes pairwise distances between the
+    aligned melodies of an alignment
+    '''
+
+    GAP = ord('-')
+    # Word/syllable boundaries, the '#' chant separator, clefs and barlines
+    # carry no melodic content and are compared as gaps.
+    GAP_CHARS = '-|~#1234567 '
+
+    _translation = bytes.maketrans(GAP_CHARS.encode('ascii'), b'-' * len(GAP_CHARS))
+
+    @classmethod
+    def encode_alignment(cls, alpianos):
+        '''
+        Encode aligned sequences as an (N, L) uint8 matrix of ASCII codes in
+        which every non-melodic character is the gap code
+        '''
+        import numpy as np
+
+        if not alpianos:
+            return np.zeros((0, 0), dtype=np.uint8)
+        encoded = [alpiano.encode('ascii', 'replace').translate(cls._translation)
+                   for alpiano in alpianos]
+        length = len(encoded[0])
+        if any(len(sequence) != length for sequence in encoded):
+            raise ValueError('Aligned melodies must all have the same length')
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8).reshape(len(encoded), length)
+
+    # Pairwise site counts are computed as products of per-symbol indicator
+    # matrices, (N, L) x (L, N), one symbol at a time, so the work runs in
+    # BLAS and memory stays at a few (N, L) arrays.
+
+    @classmethod
+    def _symbols(cls, matrix):
+        import numpy as np
+
+        return [symbol for symbol in np.unique(matrix) if symbol != cls.GAP]
+
+    @classmethod
+    def _pair_counts(cls, matrix):
+        '''Sites where both melodies have a note, and where they have the same note'''
+        import numpy as np
+
+        present = (matrix != cls.GAP).astype(np.float32)
+        compared = present @ present.T
+        same = np.zeros_like(compared)
+        for symbol in cls._symbols(matrix):
+            indicator = (matrix == symbol).astype(np.float32)
+            same += indicator @ indicator.T
+        return compared.astype(np.float64), same.astype(np.float64)
+
+    @classmethod
+    def p_distance(cls, matrix):
+        '''
+        Proportion of differing sites among the sites where both melodies
+        have a note. Pairs without any comparable site get distance 1.
+        '''
+        import numpy as np
+
+        compared, same = cls._pair_counts(matrix)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(compared > 0, (compared - same) / compared, 1.0)
+        np.fill_diagonal(distances, 0.0)
+        return distances
+
+    @classmethod
+    def hamming(cls, matrix):
+        '''
+        Number of differing sites; a note against a gap counts as a
+        difference, sites where both melodies have a gap do not
+        '''
+        import numpy as np
+
+        gaps = (matrix == cls.GAP).astype(np.float32)
+        _, same = cls._pair_counts(matrix)
+        distances = matrix.shape[1] - (gaps @ gaps.T).astype(np.float64) - same
+        np.fill_diagonal(distances, 0.0)
+        return distances
+
+    @classmethod
+    def cost_table(cls, mode):
+        '''
+        (256, 256) table of substitution costs derived from the MAFFT score
+        matrix used for `mode`: s(a,a)/2 + s(b,b)/2 - s(a,b), never negative
+        '''
+        import numpy as np
+
+        if mode not in _COST_TABLES:
+            scores = load_score_matrix(os.path.join(settings.BASE_DIR, SCORE_MATRICES[mode]))
+            table = np.zeros((256, 256), dtype=np.float32)
+            for (first, second), score in scores.items():
+                table[ord(first), ord(second)] = score
+            self_scores = np.diagonal(table).copy()
+            costs = (self_scores[:, None] + self_scores[None, :]) / 2 - table
+            costs = np.maximum(costs, 0)
+            # gap sites are left out of the comparison entirely
+            costs[cls.GAP, :] = 0
+            costs[:, cls.GAP] = 0
+            _COST_TABLES[mode] = costs
+        return _COST_TABLES[mode]
+
+    @classmethod
+    def weighted(cls, matrix, mode='full'):
+        '''
+        Mean substitution cost over the sites where both melodies have a
+        note. Pairs without any comparable site get the largest cost.
+        '''
+        import numpy as np
+
+        costs = cls.cost_table(mode)
+        present = (matrix != cls.GAP).astype(np.float32)
+        compared = present @ present.T
+        total = np.zeros_like(compared)
+        for symbol in cls._symbols(matrix):
+            indicator = (matrix == symbol).astype(np.float32)
+            total += indicator @ costs[symbol][matrix].T
+        compared, total = compared.astype(np.float64), total.astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(compared > 0, total / compared, float(costs.max()))
+        np.fill_diagonal(distances, 0.0)
+        return distances
+
+    @classmethod
+    def alignment_hash(cls, alpianos, metric, mode):
+        digest = hashlib.sha256('{}\n{}\n'.format(metric, mode).encode('utf-8'))
+        for alpiano in alpianos:
+            digest.update(alpiano.encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    @classmethod
+    def distance_json(cls, alpianos, metric='p', mode='full'):
+        '''
+        JSON body with the distance matrix of the aligned melodies; recent
+        results are kept serialized so repeated requests skip the work
+        '''
+        import numpy as np
+
+        if metric not in METRICS:
+            raise ValueError('Unknown distance metric: {}'.format(metric))
+        if metric == 'weighted' and mode not in SCORE_MATRICES:
+            raise ValueError('Weighted distances are only available for full and interval alignments')
+
+        key = cls.alignment_hash(alpianos, metric, mode)
+        with _DISTANCE_CACHE_LOCK:
+            if key in _DISTANCE_CACHE:
+                _DISTANCE_CACHE.move_to_end(key)
+                metrics.inc('chantlab_cache_requests_total', cache='distances', result='hit')
+                return _DISTANCE_CACHE[key]
+        metrics.inc('chantlab_cache_requests_total', cache='distances', result='miss')
+
+        matrix = cls.encode_alignment(alpianos)
+        if metric == 'hamming':
+            distances = cls.hamming(matrix)
+        elif metric == 'weighted':
+            distances = cls.weighted(matrix, mode)
+        else:
+            distances = cls.p_distance(matrix)
+        content = json.dumps({
+            'metric': metric,
+            'alignmentHash': key,
+            'distances': np.round(distances, 6).tolist(),
+        })
+
+        with _DISTANCE_CACHE_LOCK:
+            _DISTANCE_CACHE[key] = content
+            while len(_DISTANCE_CACHE) > DISTANCE_CACHE_SIZE:
+                _DISTANCE_CACHE.popitem(last=False)
+        return content
@@ -2,8 +2,9 @@ from django.http import HttpResponse
 
 import csv
 
+from core import profiling
 from core.cantus_schema import V1_EXPORT_FIELDS, chant_to_v1_row
-from melodies.models import Chant
+from melodies.models import VisibleChant
 
 
 class Exporter():
@@ -12,12 +13,13 @@ class Exporter():
     '''
 
     @classmethod
+    @profiling.staged('export')
     def export_to_csv(cls, ids):
         '''
         Create a CantusCorpus v1.0 CSV file of chants
         '''
 
-        chants = Chant.objects.filter(pk__in=ids)
+        chants = VisibleChant.objects.filter(pk__in=ids)
 
         response = HttpResponse(content_type='text/csv')
         response['Content-Disposition'] = 'attachment;filename=dataset.csv'
@@ -1,11 +1,11 @@
 import os
 import shutil
-import subprocess
 import sys
 from pycantus.volpiano.utils import clean_volpiano, normalize_liquescents
+from core import processes
+from core import profiling
 from core.chant_processor import ChantProcessor
 import logging
-from ete3 import Tree
 
 _DEFAULT_MAFFT_PATH = '/opt/conda/bin/mafft'
 
@@ -20,12 +20,47 @@ def _resolve_mafft_path():
 
 MAFFT_PATH = _resolve_mafft_path()
 CONCATENATE_PLACEHOLDER = "concat_placeholder"
+
+# MAFFT alignment strategies, from the most accurate to the fastest.
+MAFFT_STRATEGIES = {
+    'linsi': ['--localpair', '--maxiterate 1000'],   # L-INS-i
+    'fftnsi': ['--retree 2', '--maxiterate 2'],      # FFT-NS-i
+    'fftns2': ['--retree 2'],                        # FFT-NS-2, the MAFFT default
+    'fftns1': ['--retree 1'],                        # FFT-NS-1
+    'parttree': ['--retree 1', '--parttree'],        # PartTree, no guide tree output
+}
+_STRATEGIES_WITHOUT_GUIDE_TREE = frozenset({'parttree'})
+
+# (max. number of sequences, max. total sequence length, strategy), checked in
+# order; inputs above every row use PartTree. Only used with
+# settings.MAFFT_STRATEGY = 'auto'. These are estimates until they are
+# calibrated on the seed corpus with `manage.py benchmark_mafft_strategies`;
+# settings.MAFFT_STRATEGY_THRESHOLDS overrides them.
+MAFFT_STRATEGY_THRESHOLDS = (
+    (60, 30000, 'linsi'),
+    (200, 100000, 'fftnsi'),
+    (2000, 1000000, 'fftns2'),
+    (20000, 10000000, 'fftns1'),
+)
+
+
+def select_strategy(sequence_count, total_length, thresholds=None):
+    '''Pick a MAFFT strategy name for an input of the given size.'''
+    if thresholds is None:
+        from django.conf import settings
+        thresholds = getattr(settings, 'MAFFT_STRATEGY_THRESHOLDS', MAFFT_STRATEGY_THRESHOLDS)
+    for max_sequences, max_total_length, strategy in thresholds:
+        if sequence_count <= max_sequences and total_length <= max_total_length:
+            return strategy
+    return 'parttree'
+
+
 class Mafft():
     '''
     The Mafft class is the interface for working with the MAFFT software
     '''
 
-    def __init__(self):
+    def __init__(self, collapse_duplicates=True):
         self._input = None
         self._output = None
         self._output_guide_tree_file = None
@@ -36,6 +71,14 @@ class Mafft():
         self._process = None
 
         self._sequences_to_align = []
+        # Byte-identical sequences are aligned once and copied back afterwards;
+        # maps the index of the first occurrence to the indices of its copies.
+        self._collapse_duplicates = collapse_duplicates
+        self._duplicates = {}
+
+        # None keeps plain MAFFT defaults, 'auto' selects by input size
+        self._strategy = None
+        self.selected_strategy = None
 
         self._aligned_sequences = None
         self._sequence_idxs = None
@@ -46,6 +89,9 @@ class Mafft():
         self._input = file
         # MAFFT outputs the guide tree to a file called e.g. 'testinput.txt.tree'
         self._output_guide_tree_file = self._input + '.tree'
+        for path in (self._input, self._output_guide_tree_file, self._input + '.add',
+                     self._input + '.' + CONCATENATE_PLACEHOLDER):
+            processes.register_temp_path(path)
 
     
     def set_output(self, file):
@@ -61,10 +107,49 @@ class Mafft():
     def set_prefix(self, prefix):
         self._prefix = prefix
 
+
+    def set_strategy(self, strategy):
+        if strategy is not None and strategy != 'auto' and strategy not in MAFFT_STRATEGIES:
+            raise ValueError('Unknown MAFFT strategy: {}'.format(strategy))
+        self._strategy = strategy
+
+
+    def _strategy_for(self, sequences):
+        if self._strategy == 'auto':
+            return select_strategy(len(sequences), sum(len(seq) for seq in sequences))
+        return self._strategy
+
+
+    def _strategy_options(self, strategy):
+        return list(MAFFT_STRATEGIES[strategy]) if strategy else []
+
+    def _collapse(self, sequences):
+        '''Return the indices to send to MAFFT and a map of duplicates.
+
+        Only the first occurrence of each sequence is aligned. Nothing is
+        collapsed if fewer than two distinct sequences would remain, because
+        MAFFT does not produce a guide tree for a single sequence.
+        '''
+        if not self._collapse_duplicates:
+            return list(range(len(sequences))), {}
+        first_by_sequence = {}
+        unique = []
+        duplicates = {}
+        for i, seq in enumerate(sequences):
+            first = first_by_sequence.setdefault(seq, i)
+            if first == i:
+                unique.append(i)
+            else:
+                duplicates.setdefault(first, []).append(i)
+        if len(unique) < 2:
+            return list(range(len(sequences))), {}
+        return unique, duplicates
+
     def _align_sequences(self, sequences):
+        unique, duplicates = self._collapse(sequences)
         fasta_content = ""
-        for i, seq in enumerate(sequences):
-            fasta_content += f"> {i}\n{seq}\n"
+        for i in unique:
+            fasta_content += f"> {i}\n{sequences[i]}\n"
         if os.path.exists(self._input):
             os.remove(self._input)
         with open(self._input, 'a') as file:
@@ -73,9 +158,11 @@ class Mafft():
         command += self._prefix + " " if self._prefix else ""
         command += MAFFT_PATH + " "  # Temporary, for testing with local mafft install
         options = [op for op in self._options if op != "--treeout"]
+        options += self._strategy_options(self._strategy_for([sequences[i] for i in unique]))
         command += " ".join(options) + " "
         command += self._input + " " if self._input else ""
-        process = subprocess.run(command, capture_output=True, shell=True)
+        with profiling.stage('mafft'):
+            process = processes.run(command, capture_output=True, shell=True, name='mafft')
 
         if process.stderr:
             logging.error(process.stderr)
@@ -84,8 +171,13 @@ class Mafft():
             os.remove(self._input)
 
         sequences, sequence_idxs =  Mafft._decode_process_output(process) 
-        
-        return [mel for _, mel in sorted({id: sequences[i] for i, id in enumerate(sequence_idxs)}.items())]
+        aligned = {id: sequences[i] for i, id in enumerate(sequence_idxs)}
+        for first, copies in duplicates.items():
+            if first in aligned:
+                for copy in copies:
+                    aligned[copy] = aligned[first]
+
+        return [mel for _, mel in sorted(aligned.items())]
 
         
     def _generate_sequence_file(self, concatenate=False):
@@ -109,12 +201,13 @@ class Mafft():
                 volpiano_map.append(volpiano_id)
                 ordered_siglums.append(siglum)
 
-        for seq in sequences:
-            with open(self._input, 'a') as file:
-                name = str(self._counter)
-
-                file.write("> " + name + "\n")
-                file.write(seq + "\n")
+        unique, self._duplicates = self._collapse(sequences)
+        # the concatenated run only builds the tree over a fixed alignment
+        self.selected_strategy = None if concatenate else self._strategy_for([sequences[i] for i in unique])
+        with open(self._input, 'a') as file:
+            for i in unique:
+                file.write("> " + str(i) + "\n")
+                file.write(sequences[i] + "\n")
                 self._counter += 1
         return volpiano_map, ordered_siglums
 
@@ -142,6 +235,7 @@ class Mafft():
             indices[id] = indices[id][1:]
         return melody
 
+    @profiling.staged('text_boundaries')
     def add_text_boundaries(mafft_aligned_melodies, volpianos, melody_order, keep_liquescents = True):
         if len(mafft_aligned_melodies) == 0:
             return []
@@ -285,8 +379,13 @@ class Mafft():
 
     def decode_process(self):
         sequences, sequence_idxs =  Mafft._decode_process_output(self._process)
-        self._aligned_sequences = sequences
-        self._sequence_idxs = sequence_idxs        
+        # expand collapsed duplicates right after the sequence they copy
+        self._aligned_sequences = []
+        self._sequence_idxs = []
+        for seq, idx in zip(sequences, sequence_idxs):
+            for copy_idx in [idx] + self._duplicates.get(idx, []):
+                self._aligned_sequences.append(seq)
+                self._sequence_idxs.append(copy_idx)
         #self._aligned_sequences = [mel for _, mel in sorted({id: sequences[i] for i, id in enumerate(sequence_idxs)}.items())]
         #self._sequence_idxs = [mel_id for mel_id, _ in sorted({id: sequences[i] for i, id in enumerate(sequence_idxs)}.items())]
         
@@ -308,7 +407,20 @@ class Mafft():
 
 
     def __preprocess_guide_nodes(self, node_names=None):
+        from ete3 import Tree
+
         tree = Tree(self._output_guide_tree_file)
+        # re-attach collapsed duplicates as zero-length siblings of their leaf
+        for leaf in tree.get_leaves():
+            if "__" not in leaf.name:
+                continue
+            prefix, idx = leaf.name.split("__", 1)
+            if not idx.isdigit() or int(idx) not in self._duplicates:
+                continue
+            leaf.add_child(name=leaf.name, dist=0)
+            for copy_idx in self._duplicates[int(idx)]:
+                leaf.add_child(name="{}__{}".format(prefix, copy_idx), dist=0)
+            leaf.name = ""
         for node in tree.traverse():
             if "__" in node.name:
                 if node.name.split("__")[1] == CONCATENATE_PLACEHOLDER.lower():
@@ -330,6 +442,8 @@ class Mafft():
 
 
     def get_guide_tree(self, node_names=None):
+        if self.selected_strategy in _STRATEGIES_WITHOUT_GUIDE_TREE:
+            return None
         if not self._guide_tree:
             self.load_guide_tree(node_names)
         return self._guide_tree
@@ -354,14 +468,18 @@ class Mafft():
         command = ""
         command += self._prefix + " " if self._prefix else ""
         command += MAFFT_PATH + " "  # Temporary, for testing with local mafft install
-        command += " ".join(self._options) + " "
+        options = list(self._options)
+        if self.selected_strategy in _STRATEGIES_WITHOUT_GUIDE_TREE:
+            options.remove('--treeout')
+        command += " ".join(options + self._strategy_options(self.selected_strategy)) + " "
         if concatenate:
             command += "--keeplength --add " + self._input+"."+CONCATENATE_PLACEHOLDER + " " # MAFFT workarround to generate only the tree, but not change the alignment
             with open(self._input+"."+CONCATENATE_PLACEHOLDER, 'a') as file:
                 file.write(f"> {CONCATENATE_PLACEHOLDER}\n\n") 
         command += self._input + " " if self._input else ""
 
-        process = subprocess.run(command, capture_output=True, shell=True)
+        with profiling.stage('mafft'):
+            process = processes.run(command, capture_output=True, shell=True, name='mafft')
 
         if concatenate:
             if os.path.exists(self._input+"."+CONCATENATE_PLACEHOLDER):
@@ -380,3 +498,43 @@ class Mafft():
         self._aligned_sequences = None
         self._sequence_idxs = None
         return volpiano_map, ordered_siglums
+
+
+    def run_add(self, existing_alignment, fragments=False):
+        '''
+        Align the added volpianos against an existing alignment with
+        MAFFT --add (or --addfragments for short sequences). The existing rows
+        are named 0..n-1 and keep their relative alignment; the added rows are
+        named by their volpiano_id. No guide tree is written: MAFFT does not
+        rebuild it for the merged alignment.
+        '''
+        self._duplicates = {}
+        self.selected_strategy = None
+        added_path = self._input + '.add'
+        with open(self._input, 'w') as file:
+            for i, seq in enumerate(existing_alignment):
+                file.write("> " + str(i) + "\n")
+                file.write(seq + "\n")
+        with open(added_path, 'w') as file:
+            for seq, volpiano_id, _, _ in self._sequences_to_align:
+                file.write("> " + str(volpiano_id) + "\n")
+                file.write(seq + "\n")
+
+        command = ""
+        command += self._prefix + " " if self._prefix else ""
+        command += MAFFT_PATH + " "
+        command += " ".join(op for op in self._options if op != "--treeout") + " "
+        command += ("--addfragments " if fragments else "--add ") + added_path + " "
+        command += self._input
+        with profiling.stage('mafft'):
+            process = processes.run(command, capture_output=True, shell=True, name='mafft')
+
+        if os.path.exists(added_path):
+            os.remove(added_path)
+        if process.stderr:
+            logging.error(process.stderr)
+
+        self._process = process
+        self._counter = 0
+        self._aligned_sequences = None
+        self._sequence_idxs = None
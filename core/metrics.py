@@ -0,0 +1,242 @@
+'''In-process metrics registry shared by the gunicorn workers.
+
+Each worker keeps its counters and histograms in memory and writes them to
+its own JSON file in the metrics directory (at most every `flush_seconds`).
+The metrics endpoint merges the files of all workers and renders them in
+the Prometheus text format.
+
+Like the mark-dead step of prometheus_client's multiprocess mode, files of
+exited workers do not pile up: collect() folds the file of every dead pid
+on this host into the host's archive file (metrics-{host}-archive.json)
+and removes it, so counters never go backwards while the directory stays
+at one file per live worker plus one per host. A worker also folds a file
+left under its own pid by an earlier process before its first write.
+Files of other hosts are left to their own workers.
+'''
+import fcntl
+import json
+import math
+import os
+import socket
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0.0
+_flushed = False
+
+HELP = {
+    'chantlab_requests_total': ('counter', 'HTTP requests by view, method and status'),
+    'chantlab_request_seconds': ('histogram', 'HTTP request latency by view'),
+    'chantlab_subprocess_launches_total': ('counter', 'MAFFT/MrBayes subprocesses started'),
+    'chantlab_subprocess_failures_total': ('counter', 'MAFFT/MrBayes subprocesses that exited with an error'),
+    'chantlab_cache_requests_total': ('counter', 'Cache lookups by cache and result (hit or miss)'),
+    'chantlab_compute_jobs': ('gauge', 'Admitted (running) and waiting (queued) computations'),
+    'chantlab_temp_dir_bytes': ('gauge', 'Size of the temporary directories'),
+    'chantlab_temp_dir_files': ('gauge', 'Files in the temporary directories'),
+}
+
+
+def _key(name, labels):
+    return name + '|' + json.dumps(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets),
+                                            'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def _host_prefix():
+    return 'metrics-{}-'.format(socket.gethostname())
+
+
+def _worker_file(directory):
+    return os.path.join(directory, '{}{}.json'.format(_host_prefix(), os.getpid()))
+
+
+def _write(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(counters, histograms, worker):
+    '''Add the metrics of one worker file to `counters` and `histograms`.'''
+    for key, value in worker['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+    for key, histogram in worker['histograms'].items():
+        merged = histograms.get(key)
+        if merged is None or merged['buckets'] != histogram['buckets']:
+            histograms[key] = {'buckets': histogram['buckets'], 'counts': list(histogram['counts']),
+                               'sum': histogram['sum'], 'count': histogram['count']}
+            continue
+        merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+        merged['sum'] += histogram['sum']
+        merged['count'] += histogram['count']
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dead_worker_files(directory, own):
+    '''Files of this host whose pid is gone; `own` counts this process's pid as gone.'''
+    prefix = _host_prefix()
+    paths = []
+    for name in os.listdir(directory):
+        pid = name[len(prefix):-len('.json')]
+        if not (name.startswith(prefix) and name.endswith('.json') and pid.isdigit()):
+            continue
+        pid = int(pid)
+        if (own and pid == os.getpid()) or (pid != os.getpid() and not _pid_alive(pid)):
+            paths.append(os.path.join(directory, name))
+    return paths
+
+
+def fold_dead_workers(directory, own=False):
+    '''
+    Merge the files of dead workers of this host into the host's archive
+    file and remove them; returns how many were folded.
+    '''
+    if not os.path.isdir(directory):
+        return 0
+    with open(os.path.join(directory, 'metrics.lock'), 'w') as lock:
+        # scrapes of several workers may fold at the same time
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths = _dead_worker_files(directory, own)
+        if not paths:
+            return 0
+        archive_path = os.path.join(directory, _host_prefix() + 'archive.json')
+        archive = _read(archive_path) or {'counters': {}, 'histograms': {}}
+        for path in paths:
+            worker = _read(path)
+            if worker is not None:
+                _merge(archive['counters'], archive['histograms'], worker)
+        _write(archive_path, json.dumps(archive))
+        for path in paths:
+            os.remove(path)
+    return len(paths)
+
+
+def flush(directory, flush_seconds=0):
+    '''Write this worker's metrics if `flush_seconds` passed since the last write.'''
+    global _last_flush, _flushed
+    now = time.monotonic()
+    if now - _last_flush < flush_seconds:
+        return
+    with _lock:
+        _last_flush = now
+        content = json.dumps({'counters': _counters, 'histograms': _histograms})
+    os.makedirs(directory, exist_ok=True)
+    if not _flushed:
+        # a file under our pid was written by an earlier process
+        fold_dead_workers(directory, own=True)
+        _flushed = True
+    _write(_worker_file(directory), content)
+
+
+def collect(directory):
+    '''Merge the metrics of all workers: ({key: value}, {key: histogram}).'''
+    counters, histograms = {}, {}
+    fold_dead_workers(directory)
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    for name in names:
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        worker = _read(os.path.join(directory, name))
+        if worker is not None:
+            _merge(counters, histograms, worker)
+    return counters, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _number(value):
+    if math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(counters, histograms, gauges=()):
+    '''
+    Prometheus text format of the merged metrics; `gauges` are
+    (name, labels, value) tuples measured at scrape time.
+    '''
+    families = {}
+    for key, value in counters.items():
+        name, labels = key.split('|', 1)
+        families.setdefault(name, []).append((name, json.loads(labels), value))
+    for key, histogram in histograms.items():
+        name, labels = key.split('|', 1)
+        labels = json.loads(labels)
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            families.setdefault(name, []).append((name + '_bucket', labels + [['le', _number(bound)]], cumulative))
+        families[name].append((name + '_bucket', labels + [['le', '+Inf']], histogram['count']))
+        families[name].append((name + '_sum', labels, histogram['sum']))
+        families[name].append((name + '_count', labels, histogram['count']))
+    for name, labels, value in gauges:
+        families.setdefault(name, []).append((name, sorted(labels.items()), value))
+
+    lines = []
+    for name in sorted(families):
+        kind, description = HELP.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample, labels, value in families[name]:
+            lines.append('{}{} {}'.format(sample, _labels(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    '''Forget this worker's metrics (tests).'''
+    global _last_flush, _flushed
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _last_flush = 0.0
+        _flushed = False
@@ -1,3 +1,7 @@
+import hashlib
+import io
+import itertools
+import json
 import os
 import subprocess
 import shutil
@@ -7,29 +11,82 @@ from django.conf import settings
 import random
 import string
 import logging
+import time
 
-def mrbayes_analyzis(ids, alpianos, number_of_generations, alignment_names):
-    mrbayes = MrBayesVolpiano(ngen = number_of_generations)
+from core import metrics
+from core import processes
+from core import profiling
+from core.alignment_analysis import AlignmentAnalyzer
+from core.distances import DistanceCalculator
+
+# How often the MrBayes diagnostics file is checked against the budget.
+MONITOR_INTERVAL_SECONDS = 5
+# Compacted partitions with fewer variable sites are merged with a neighbour.
+MIN_PARTITION_SITES = 10
+# Symbols MrBayes gets to see; '#' is a chant separator, not part of the volpiano.
+SUPPORTED_SYMBOLS = "abcdefghjklmnopqrsyYiIzZ)ABCDEFGHJKLMNOPQRS-#"
+
+
+class _GapTranslation(dict):
+    '''str.translate table: supported symbols map to themselves, anything else to a gap'''
+    def __missing__(self, key):
+        self[key] = ord('-')
+        return self[key]
+
+
+SEQUENCE_TRANSLATION = _GapTranslation((ord(symbol), ord(symbol)) for symbol in SUPPORTED_SYMBOLS)
+
+
+class _HashWriter():
+    '''File-like object feeding everything written to a sha256'''
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, text):
+        self.hash.update(text.encode('utf-8'))
+
+
+def mrbayes_analyzis(ids, alpianos, number_of_generations, alignment_names, stopval=None, max_seconds=None, compact=False):
+    mrbayes = MrBayesVolpiano(ngen = number_of_generations, stopval=stopval, max_seconds=max_seconds, compact=compact)
     newick, nexus_con_tre, nexus_alignment, mb_script, error_message = mrbayes.run(alignment_names=alignment_names, alpianos=alpianos)
-    
+
     result = {
         'newick': newick,
         'mbScript': mb_script,
         'nexusAlignment': nexus_alignment,
         'nexusConTre': nexus_con_tre,
+        'convergence': mrbayes.convergence,
+        'compaction': mrbayes.compaction,
         'error': error_message
     }
 
-    return result
+    return result, mrbayes.ran
 
 class MrBayesVolpiano():
 
-    def __init__(self, mcmc_nruns = 4, ngen = 4000000, nchains=8, samplefreq=1000, printfreq=1000):
+    def __init__(self, mcmc_nruns = 4, ngen = 4000000, nchains=8, samplefreq=1000, printfreq=1000,
+                 stopval=None, diagnfreq=5000, max_seconds=None, checkfreq=10000, compact=False):
         self.mcmc_nruns = mcmc_nruns
         self.ngen = ngen
         self.nchains = nchains
         self.samplefreq = samplefreq
         self.printfreq = printfreq
+        # ngen is the generation budget; with stopval MrBayes stops earlier
+        # once the ASDSF of the runs drops below it (needs nruns > 1)
+        self.stopval = stopval if mcmc_nruns > 1 else None
+        self.diagnfreq = diagnfreq
+        self.max_seconds = max_seconds
+        # generations between checkpoints an interrupted run resumes from
+        self.checkfreq = checkfreq
+        # drop all-gap and constant columns and merge tiny partitions; the
+        # compacted matrix is modelled Mkv+G, without invariant sites (+I)
+        self.compact = compact
+        self.compaction = None
+        self.convergence = None
+        # whether MrBayes ran a whole analysis in this call (not a stored
+        # result, a duplicate, a failure or a partial run); only those
+        # runtimes feed the runtime model
+        self.ran = False
 
     def run(self, alignment_names, alpianos):
         # normalize alignment names
@@ -38,71 +95,286 @@ class MrBayesVolpiano():
             normalized_names.append(MrBayesVolpiano._siglum_to_fasta_header_name(name))
         alignment_names = normalized_names
         melodies = {}
-        partitions = []
-        init_paritions = True
+        partitions = None
         for source_name, alpiano in zip(alignment_names, alpianos):
-            aligned_sequence = alpiano.replace("|", "-")
-            aligned_sequence = aligned_sequence.replace("~", "-")
-            aligned_sequence = aligned_sequence.replace("1", "-")
-            aligned_sequence = aligned_sequence.replace("4", "-")
-            aligned_sequence = MrBayesVolpiano._filter_not_supported_symbols(aligned_sequence)
-            subsequences = aligned_sequence.split("#") # chant splitter
-            if init_paritions:
-                partitions = [0]
-                for subsequence in subsequences:
-                    partitions.append(len(subsequence) + partitions[-1])
-                del partitions[0]
-            else: 
-                sequence_length = 0
-                for i, subsequence in enumerate(subsequences):
-                    if partitions[i] != sequence_length + len(subsequence):
-                        logging.error("Different sequences have different partition lengths.")
-                        logging.error(partitions)
-                        logging.error(alpianos)
-                        return "", "", "", "", "Melodies are not aligned! Different sequences have different partition lengths. Partitions: {} Alpianos: {}".format(partitions, alpianos)
-                    sequence_length += len(subsequence)
-            init_paritions = False
+            subsequences = alpiano.translate(SEQUENCE_TRANSLATION).split("#") # chant splitter
+            ends = list(itertools.accumulate(len(subsequence) for subsequence in subsequences))
+            if partitions is None:
+                partitions = ends
+            elif ends != partitions:
+                logging.error("Different sequences have different partition lengths.")
+                logging.error(partitions)
+                logging.error(alpianos)
+                return "", "", "", "", "Melodies are not aligned! Different sequences have different partition lengths. Partitions: {} Alpianos: {}".format(partitions, alpianos)
             melodies[source_name] = ''.join(subsequences)
 
-        nexus_content = MrBayesVolpiano._generate_nexus(sequences=melodies, ntax=len(melodies), nchar=partitions[-1])
-        mb_content = self._generate_mb(partitions=partitions)
+        if self.compact:
+            melodies, partitions, self.compaction = MrBayesVolpiano._compact(melodies, partitions)
+            if not partitions:
+                return "", "", "", "", "The alignment has no variable sites to analyse"
 
+        matrix = {'sequences': melodies, 'ntax': len(melodies), 'nchar': partitions[-1]}
 
-        # Create a directory in the 'mrbayes-temp' folder with a randomly generated ID
-        mrbayes_job_id = str(uuid.uuid4().hex)
-        temp_dir = os.path.join('mrbayes-temp', mrbayes_job_id)
-        os.makedirs(temp_dir)
+        # Identical analyses share a job directory and a stored result
+        job_key = self._job_key(matrix, partitions)
+        stored = MrBayesVolpiano._load_result(job_key)
+        metrics.inc('chantlab_cache_requests_total', cache='mrbayes_results', result='miss' if stored is None else 'hit')
+        if stored is not None:
+            self.convergence = stored['convergence']
+            return MrBayesVolpiano._rename_tree_nodes(stored['newick'], alignment_names), stored['nexusConTre'], MrBayesVolpiano._generate_nexus(**matrix), stored['mbScript'], ""
 
-        # Create nexus file and mb script in the created directory
-        nexus_file_path = os.path.join(temp_dir, 'chantlab.nexus')
-        mb_file_path = os.path.join(temp_dir, 'chantlab.mb')
-        with open(nexus_file_path, 'w') as nexus_file:
-            nexus_file.write(nexus_content)
-        with open(mb_file_path, 'w') as mb_file:
-            mb_file.write(mb_content)
-
-        # Run the shell command "mb chantlab.mb" in the created directory
-        subprocess.run(['mb', 'chantlab.mb'], cwd=temp_dir)
+        temp_dir = os.path.join(settings.MRBAYES_TEMP_DIR, job_key)
+        os.makedirs(temp_dir, exist_ok=True)
+        processes.register_temp_path(temp_dir, keep_on_interrupt=True)
+        lock_path = os.path.join(temp_dir, 'chantlab.lock')
+        if not MrBayesVolpiano._acquire_lock(lock_path):
+            return "", "", MrBayesVolpiano._generate_nexus(**matrix), "", "An identical MrBayes analysis is already running"
 
         try:
-            # Load the file 'chantlab.nexus.con.tre'
-            con_tre_file_path = os.path.join(temp_dir, 'chantlab.nexus.con.tre')
-            with open(con_tre_file_path, 'r') as con_tre_file:
-                nexus_con_tre = con_tre_file.read()
-            newick = MrBayesVolpiano._extract_newick(nexus_con_tre)
-        except:
-            logging.error("Cannot find chantlab.nexus.con.tre file - check the chantlab.log for more information.")
-            con_tre_file_path = os.path.join(temp_dir, 'chantlab.log')
-            with open(con_tre_file_path, 'r') as con_tre_file:
-                log = con_tre_file.read()
-            return "", "", nexus_content, mb_content, "Cannot find chantlab.nexus.con.tre file, check the log: {}".format(log)
-
-        # Delete the generated directory and its contents
-        shutil.rmtree(temp_dir)
+            # continue from the last checkpoint of an interrupted run
+            resume = os.path.exists(os.path.join(temp_dir, 'chantlab.nexus.ckp'))
+
+            # Write the nexus file and mb script straight into the job directory;
+            # the response reads them back once MrBayes is done
+            nexus_file_path = os.path.join(temp_dir, 'chantlab.nexus')
+            mb_file_path = os.path.join(temp_dir, 'chantlab.mb')
+            with open(nexus_file_path, 'w') as nexus_file:
+                MrBayesVolpiano._write_nexus(nexus_file, **matrix)
+            with open(mb_file_path, 'w') as mb_file:
+                self._write_mb(mb_file, partitions, append=resume)
+
+            # Run the shell command "mb chantlab.mb" in the job directory
+            with profiling.stage('mrbayes'):
+                self.convergence = self._run_monitored(temp_dir)
+            self.convergence['resumed'] = resume
+            if self.convergence['stoppedBy'] == 'time':
+                # summarize the trees sampled before the budget ran out
+                with open(os.path.join(temp_dir, 'chantlab.sum.mb'), 'w') as mb_file:
+                    mb_file.write(self._generate_summary_mb())
+                with profiling.stage('mrbayes_summary'):
+                    processes.run(['mb', 'chantlab.sum.mb'], cwd=temp_dir)
 
+            nexus_content = MrBayesVolpiano._read_text(nexus_file_path)
+            mb_content = MrBayesVolpiano._read_text(mb_file_path)
+            try:
+                # Load the file 'chantlab.nexus.con.tre'
+                con_tre_file_path = os.path.join(temp_dir, 'chantlab.nexus.con.tre')
+                with open(con_tre_file_path, 'r') as con_tre_file:
+                    nexus_con_tre = con_tre_file.read()
+                newick = MrBayesVolpiano._extract_newick(nexus_con_tre)
+            except (OSError, IndexError):
+                stopped = self.convergence['stoppedBy'] in ('time', 'stoprule')
+                log_name = 'chantlab.sum.log' if self.convergence['stoppedBy'] == 'time' else 'chantlab.log'
+                logging.error("Cannot find chantlab.nexus.con.tre file - check the {} for more information.".format(log_name))
+                log = MrBayesVolpiano._read_text(os.path.join(temp_dir, log_name))
+                if not stopped:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                # otherwise only the summary failed; keep the checkpoint so
+                # that resubmitting continues the run
+                return "", "", nexus_content, mb_content, "Cannot find chantlab.nexus.con.tre file, check the log: {}".format(log)
+        finally:
+            if os.path.exists(lock_path):
+                os.remove(lock_path)
+
+        if self.convergence['stoppedBy'] == 'time':
+            # keep the checkpoint so that resubmitting continues the run
+            os.remove(os.path.join(temp_dir, 'chantlab.nexus.con.tre'))
+        else:
+            MrBayesVolpiano._store_result(job_key, {
+                'newick': newick,
+                'nexusConTre': nexus_con_tre,
+                'mbScript': mb_content,
+                'convergence': self.convergence,
+            })
+            # Delete the generated directory and its contents
+            shutil.rmtree(temp_dir)
+            self.ran = not resume
 
         return MrBayesVolpiano._rename_tree_nodes(newick, alignment_names), nexus_con_tre, nexus_content, mb_content, ""
 
+    def _compact(melodies, partitions):
+        '''
+        Keep only the variable columns of the matrix. All-gap columns are
+        dropped, constant columns are counted per partition, and partitions
+        left with fewer than MIN_PARTITION_SITES columns are merged.
+
+        This gives up +I modelling: MrBayes cannot combine coding=variable
+        with invariant sites, so the compacted matrix is analysed Mkv+G and
+        the invariant-site counts are only reported, not modelled.
+        '''
+        import numpy as np
+
+        names = list(melodies)
+        matrix = DistanceCalculator.encode_alignment([melodies[name] for name in names])
+        _, counts = AlignmentAnalyzer.symbol_counts(matrix)
+        states = (counts > 0).sum(axis=0)
+        variable = states > 1
+
+        groups = []
+        start = 0
+        for end in partitions:
+            sites = int(variable[start:end].sum())
+            invariant = int((states[start:end] == 1).sum())
+            if groups and groups[-1]['sites'] < MIN_PARTITION_SITES:
+                groups[-1]['sites'] += sites
+                groups[-1]['invariantSites'] += invariant
+            else:
+                groups.append({'sites': sites, 'invariantSites': invariant})
+            start = end
+        if len(groups) > 1 and groups[-1]['sites'] < MIN_PARTITION_SITES:
+            tail = groups.pop()
+            groups[-1]['sites'] += tail['sites']
+            groups[-1]['invariantSites'] += tail['invariantSites']
+        groups = [group for group in groups if group['sites'] > 0]
+
+        compacted_partitions = [int(end) for end in np.cumsum([group['sites'] for group in groups])]
+        columns = matrix[:, variable]
+        compacted = {name: columns[i].tobytes().decode('ascii') for i, name in enumerate(names)}
+        report = {
+            'originalNchar': int(matrix.shape[1]),
+            'nchar': int(columns.shape[1]),
+            'gapSites': int((states == 0).sum()),
+            'invariantSites': int((states == 1).sum()),
+            'originalPartitions': len(partitions),
+            'partitions': groups,
+        }
+        return compacted, compacted_partitions, report
+
+    def _job_key(self, matrix, partitions):
+        '''Hash of the NEXUS matrix and every parameter of the generated mb script'''
+        parameters = json.dumps([self.mcmc_nruns, self.ngen, self.nchains, self.samplefreq, self.printfreq,
+                                 self.stopval, self.diagnfreq, self.checkfreq, self.compact, list(partitions)])
+        writer = _HashWriter()
+        MrBayesVolpiano._write_nexus(writer, **matrix)
+        writer.write('\n' + parameters)
+        return writer.hash.hexdigest()
+
+    def _load_result(job_key):
+        path = os.path.join(settings.MRBAYES_RESULTS_DIR, job_key + '.json')
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as result_file:
+                return json.load(result_file)
+        except (OSError, ValueError):
+            logging.warning("Ignoring unreadable MrBayes result {}".format(path))
+            return None
+
+    def _store_result(job_key, result):
+        os.makedirs(settings.MRBAYES_RESULTS_DIR, exist_ok=True)
+        path = os.path.join(settings.MRBAYES_RESULTS_DIR, job_key + '.json')
+        temp_path = path + '.' + uuid.uuid4().hex
+        with open(temp_path, 'w') as result_file:
+            json.dump(result, result_file)
+        os.replace(temp_path, path)
+
+    def _acquire_lock(lock_path):
+        '''Create the job lock file; a lock left by a dead process is taken over'''
+        for _ in range(2):
+            try:
+                descriptor = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = MrBayesVolpiano._read_text(lock_path).strip()
+                if owner.isdigit() and MrBayesVolpiano._process_alive(int(owner)):
+                    return False
+                os.remove(lock_path)
+                continue
+            with os.fdopen(descriptor, 'w') as lock_file:
+                lock_file.write(str(os.getpid()))
+            return True
+        return False
+
+    def _process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _read_text(path):
+        try:
+            with open(path, 'r') as text_file:
+                return text_file.read()
+        except OSError:
+            return ""
+
+    def _run_monitored(self, temp_dir):
+        '''
+        Run MrBayes, following its convergence diagnostics in the .mcmc file
+        and stopping it when the wall-clock budget runs out
+        '''
+        started = time.monotonic()
+        process = processes.popen(['mb', 'chantlab.mb'], cwd=temp_dir)
+        stopped_by = None
+        diagnostics = {'generation': 0, 'asdsf': None}
+        while process.poll() is None:
+            try:
+                process.wait(timeout=MONITOR_INTERVAL_SECONDS)
+            except subprocess.TimeoutExpired:
+                pass
+            diagnostics = MrBayesVolpiano._read_diagnostics(os.path.join(temp_dir, 'chantlab.nexus.mcmc')) or diagnostics
+            elapsed = time.monotonic() - started
+            logging.info("mrbayes {}: generation {} of {}, ASDSF {}, {:.0f}s".format(
+                temp_dir, diagnostics['generation'], self.ngen, diagnostics['asdsf'], elapsed))
+            if process.poll() is None and self.max_seconds and elapsed > self.max_seconds:
+                stopped_by = 'time'
+                processes.terminate(process, grace_seconds=30)
+        if stopped_by is None:
+            processes.record_exit(process.args, process.returncode)
+
+        diagnostics = MrBayesVolpiano._read_diagnostics(os.path.join(temp_dir, 'chantlab.nexus.mcmc')) or diagnostics
+        converged = (self.stopval is not None and diagnostics['asdsf'] is not None
+                     and diagnostics['asdsf'] <= self.stopval)
+        if stopped_by is None:
+            stopped_by = 'stoprule' if converged and diagnostics['generation'] < self.ngen else 'ngen'
+        return {
+            'generations': diagnostics['generation'],
+            'asdsf': diagnostics['asdsf'],
+            'stopval': self.stopval,
+            'converged': converged,
+            'stoppedBy': stopped_by,
+            'seconds': round(time.monotonic() - started, 1),
+        }
+
+    def _read_diagnostics(mcmc_file_path):
+        '''Last generation and average standard deviation of split frequencies in a .mcmc file'''
+        if not os.path.exists(mcmc_file_path):
+            return None
+        header = None
+        last = None
+        with open(mcmc_file_path, 'r') as mcmc_file:
+            for line in mcmc_file:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'Gen':
+                    header = fields
+                elif header and fields[0].isdigit():
+                    last = fields
+        if last is None:
+            return None
+        asdsf = None
+        for name, value in zip(header, last):
+            if name.startswith('AvgStdDev'):
+                try:
+                    asdsf = float(value)
+                except ValueError:
+                    pass
+        return {'generation': int(last[0]), 'asdsf': asdsf}
+
+    def _generate_summary_mb(self):
+        mb_file = io.StringIO()
+        mb_file.write("begin mrbayes;\n")
+        mb_file.write("[summarize the trees of an interrupted run]\n")
+        mb_file.write("log start filename=chantlab.sum.log;\n")
+        mb_file.write("set autoclose=yes nowarn=yes;\n")
+        mb_file.write("execute chantlab.nexus;\n")
+        mb_file.write("sumt nruns={} relburnin=yes burninfrac=0.50;\n".format(self.mcmc_nruns))
+        mb_file.write("sump nruns={};\n".format(self.mcmc_nruns))
+        mb_file.write("log stop;\n")
+        mb_file.write("end;\n")
+        return mb_file.getvalue()
+
     def _extract_newick(nexus_con_tre):
         newick_line = nexus_con_tre.split('\n')[-3]
         offset = len(newick_line.split('(')[0])
@@ -110,71 +382,94 @@ class MrBayesVolpiano():
 
 
     def _generate_nexus(sequences, ntax, nchar):
-        nexus_content = ""
-        nexus_content += "#NEXUS\n"
-        nexus_content += "BEGIN DATA;\n"
-        nexus_content += "\tDIMENSIONS NTAX={} NCHAR={};\n".format(ntax, nchar)
-        nexus_content += "\tFORMAT DATATYPE=STANDARD GAP=- MISSING=?;\n"
-        nexus_content += "\tMATRIX\n"
-        nexus_content += "\n"
-        for source_name in sequences:
-            nexus_content += "{}\t{}\n".format(source_name, sequences[source_name])
-        nexus_content += ";\n"
-        nexus_content += "end;"
-        return nexus_content
-
-    def _generate_mb(self, partitions):
-        mb_file = ""
-        mb_file += "begin mrbayes;\n"
-        mb_file += "[Script documentation carried out using comments]\n"
-        mb_file += "\n"
-        mb_file += "[log the analysis]\n"
-        mb_file += "log start filename=chantlab.log;\n"
-        mb_file += "[read the matrix chantlab.nexus]\n"
-        mb_file += "execute chantlab.nexus;\n"
-        mb_file += "\n"
-        mb_file += "[close analysis at end]\n"
-        mb_file += "set autoclose=yes;\n"
-        mb_file += "[This command shows the status of all the taxa, according to the documentation]\n"
-        mb_file += "taxastat;\n"
-        mb_file += "\n"
-        mb_file += "[definition of individual partitions per marker come from partitions.txt]\n"
+        nexus_file = io.StringIO()
+        MrBayesVolpiano._write_nexus(nexus_file, sequences, ntax, nchar)
+        return nexus_file.getvalue()
+
+    def _write_nexus(nexus_file, sequences, ntax, nchar):
+        nexus_file.write("#NEXUS\n")
+        nexus_file.write("BEGIN DATA;\n")
+        nexus_file.write("\tDIMENSIONS NTAX={} NCHAR={};\n".format(ntax, nchar))
+        nexus_file.write("\tFORMAT DATATYPE=STANDARD GAP=- MISSING=?;\n")
+        nexus_file.write("\tMATRIX\n")
+        nexus_file.write("\n")
+        for source_name, sequence in sequences.items():
+            nexus_file.write(source_name)
+            nexus_file.write("\t")
+            nexus_file.write(sequence)
+            nexus_file.write("\n")
+        nexus_file.write(";\n")
+        nexus_file.write("end;")
+
+    def _generate_mb(self, partitions, append=False):
+        mb_file = io.StringIO()
+        self._write_mb(mb_file, partitions, append=append)
+        return mb_file.getvalue()
+
+    def _partition_codes(count):
+        '''Distinct random charset names'''
         partition_codes = set()
         partition_code = ''.join(random.choices(string.ascii_lowercase, k=random.randint(5, 8))) 
-        while len(partition_codes) != len(partitions):
+        while len(partition_codes) != count:
             while partition_code in partition_codes:
                 partition_code = ''.join(random.choices(string.ascii_lowercase, k=random.randint(5, 8)))
             partition_codes.add(partition_code)
-        partition_codes = list(partition_codes)
+        return list(partition_codes)
+
+    def _write_mb(self, mb_file, partitions, append=False):
+        mb_file.write("begin mrbayes;\n")
+        mb_file.write("[Script documentation carried out using comments]\n")
+        mb_file.write("\n")
+        mb_file.write("[log the analysis]\n")
+        mb_file.write("log start filename=chantlab.log;\n")
+        mb_file.write("[read the matrix chantlab.nexus]\n")
+        mb_file.write("execute chantlab.nexus;\n")
+        mb_file.write("\n")
+        mb_file.write("[close analysis at end]\n")
+        mb_file.write("set autoclose=yes;\n")
+        mb_file.write("[This command shows the status of all the taxa, according to the documentation]\n")
+        mb_file.write("taxastat;\n")
+        mb_file.write("\n")
+        mb_file.write("[definition of individual partitions per marker come from partitions.txt]\n")
+        partition_codes = MrBayesVolpiano._partition_codes(len(partitions))
         for i, (code, sequence_end) in enumerate(zip(partition_codes, partitions)):
             sequence_start = 1 if i == 0 else partitions[i-1] + 1
-            mb_file += "charset {}={}-{};\n".format(code, sequence_start, sequence_end)    
-        mb_file += "\n"
-        mb_file += "[definition of the single partition]\n"
-        mb_file += "partition chants={}:{};\n".format(len(partitions), ','.join(partition_codes))
-        mb_file += "\n"
-        mb_file += "[specification of substitution models]\n"
-        mb_file += "set partition=chants;\n"
-        mb_file += "lset applyto=(1) coding=all rates=invgamma; [Mkv+I+G, nstates is automatic for the standard datatype]\n"
-        mb_file += "\n"
-        mb_file += "[show the model just specified for each partition]\n"
-        mb_file += "showmodel;\n"
-        mb_file += "[set up the MCMC, with this setting the analysis will need not less than 16 threads]\n"
-        mb_file += "mcmcp nruns={} ngen={} nchains={} samplefreq={} printfreq={};\n".format(self.mcmc_nruns, self.ngen, self.nchains, self.samplefreq, self.printfreq)
-        mb_file += "[run the MCMC]\n"
-        mb_file += "mcmc;\n"
-        mb_file += "\n"
-        mb_file += "[summarize the posterior trees]\n"
-        mb_file += "sumt nruns=4 relburnin=yes burninfrac=0.50;\n"
-        mb_file += "plot;\n"
-        mb_file += "\n"
-        mb_file += "[summarize parameter posteriors]\n"
-        mb_file += "sump;\n"
-        mb_file += "\n"
-        mb_file += "log stop;\n"
-        mb_file += "end;\n"
-
-        return mb_file
+            mb_file.write("charset {}={}-{};\n".format(code, sequence_start, sequence_end))
+        mb_file.write("\n")
+        mb_file.write("[definition of the single partition]\n")
+        mb_file.write("partition chants={}:{};\n".format(len(partitions), ','.join(partition_codes)))
+        mb_file.write("\n")
+        mb_file.write("[specification of substitution models]\n")
+        mb_file.write("set partition=chants;\n")
+        if self.compaction and self.compaction['invariantSites']:
+            mb_file.write("[constant sites were removed, so there is no +I; invariant sites per partition: {}]\n".format(
+                ','.join(str(group['invariantSites']) for group in self.compaction['partitions'])))
+            mb_file.write("lset applyto=(all) coding=variable rates=gamma; [Mkv+G conditioned on variable characters]\n")
+        else:
+            mb_file.write("lset applyto=(1) coding=all rates=invgamma; [Mkv+I+G, nstates is automatic for the standard datatype]\n")
+        mb_file.write("\n")
+        mb_file.write("[show the model just specified for each partition]\n")
+        mb_file.write("showmodel;\n")
+        mb_file.write("[set up the MCMC, with this setting the analysis will need not less than 16 threads]\n")
+        mb_file.write("mcmcp nruns={} ngen={} nchains={} samplefreq={} printfreq={}".format(self.mcmc_nruns, self.ngen, self.nchains, self.samplefreq, self.printfreq))
+        if self.stopval:
+            mb_file.write(" mcmcdiagn=yes diagnfreq={} stoprule=yes stopval={}".format(self.diagnfreq, self.stopval))
+        mb_file.write(" checkpoint=yes checkfreq={}".format(self.checkfreq))
+        if append:
+            mb_file.write(" append=yes")
+        mb_file.write(";\n")
+        mb_file.write("[run the MCMC]\n")
+        mb_file.write("mcmc;\n")
+        mb_file.write("\n")
+        mb_file.write("[summarize the posterior trees]\n")
+        mb_file.write("sumt nruns=4 relburnin=yes burninfrac=0.50;\n")
+        mb_file.write("plot;\n")
+        mb_file.write("\n")
+        mb_file.write("[summarize parameter posteriors]\n")
+        mb_file.write("sump;\n")
+        mb_file.write("\n")
+        mb_file.write("log stop;\n")
+        mb_file.write("end;\n")
 
 
 
@@ -223,10 +518,4 @@ class MrBayesVolpiano():
 
 
     def _filter_not_supported_symbols(volpiano_melody):
-        filtered_melody = ""
-        for c in volpiano_melody:
-            if not c in "abcdefghjklmnopqrsyYiIzZ)ABCDEFGHJKLMNOPQRS-#": # symbol '#' is a chant separator, not part of the volpiano
-                filtered_melody += "-"
-            else:
-                filtered_melody += c
-        return filtered_melody
\ No newline at end of file
+        return volpiano_melody.translate(SEQUENCE_TRANSLATION)
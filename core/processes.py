@@ -0,0 +1,125 @@
+'''Subprocesses of heavy computations (MAFFT, MrBayes).
+
+They are started in their own process group, so a cancelled or orphaned
+job can be stopped together with every process it spawned. Whoever runs a
+computation can listen, per thread, for the process groups and temporary
+paths it creates.
+'''
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from core import metrics
+
+_local = threading.local()
+
+
+@contextmanager
+def tracked(listener):
+    '''Call `listener(event, value)` for processes and temp paths created in this thread.'''
+    previous = getattr(_local, 'listener', None)
+    _local.listener = listener
+    try:
+        yield
+    finally:
+        _local.listener = previous
+
+
+def _notify(event, value):
+    listener = getattr(_local, 'listener', None)
+    if listener is not None:
+        listener(event, value)
+
+
+def register_temp_path(path, keep_on_interrupt=False):
+    '''
+    Announce a temporary file or directory of the running job. Paths kept on
+    interrupt (resumable job directories) are only removed on cancellation.
+    '''
+    _notify('temp_path', [os.path.abspath(path), keep_on_interrupt])
+
+
+def program_name(args):
+    '''Metrics label of a command: the name of the program it runs.'''
+    first = args.split()[0] if isinstance(args, str) else args[0]
+    return os.path.basename(first)
+
+
+def popen(args, name=None, **kwargs):
+    '''
+    subprocess.Popen in a new process group; `name` labels the launch
+    in the metrics (defaults to the program name).
+    '''
+    process = subprocess.Popen(args, start_new_session=True, **kwargs)
+    metrics.inc('chantlab_subprocess_launches_total', program=name or program_name(args))
+    _notify('process', process.pid)
+    return process
+
+
+def record_exit(args, returncode, name=None):
+    '''Count a subprocess that exited with an error.'''
+    if returncode:
+        metrics.inc('chantlab_subprocess_failures_total', program=name or program_name(args))
+
+
+def run(args, capture_output=False, name=None, **kwargs):
+    '''subprocess.run in a new process group'''
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    with popen(args, name=name, **kwargs) as process:
+        stdout, stderr = process.communicate()
+    record_exit(args, process.returncode, name)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def terminate(process, grace_seconds=5):
+    '''Stop a child started with popen() and its whole process group.'''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace_seconds)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def kill_process_group(pgid, grace_seconds=5):
+    '''SIGTERM the process group, then SIGKILL whatever is left after the grace period.'''
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + grace_seconds
+    while _group_alive(pgid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if _group_alive(pgid):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def remove_temp_paths(temp_paths, keep_resumable=False):
+    for path, keep_on_interrupt in temp_paths:
+        if keep_resumable and keep_on_interrupt:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
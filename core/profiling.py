@@ -0,0 +1,61 @@
+'''Per-request stage timings.
+
+Code that does heavy work marks its stages with `stage(name)` or the
+`staged(name)` decorator. Timings are only taken while a profile is active
+in the current thread (see melodies.middleware.ProfilingMiddleware);
+otherwise both cost one attribute lookup.
+'''
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class Profile():
+    '''Accumulated seconds and call counts of the stages of one request'''
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds):
+        total, count = self.stages.get(name, (0.0, 0))
+        self.stages[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def profiled():
+    '''Collect the stages run in this thread into a new Profile.'''
+    previous = getattr(_local, 'profile', None)
+    profile = _local.profile = Profile()
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+
+@contextmanager
+def stage(name):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def staged(name):
+    '''Decorator timing every call of the function as stage `name`.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'profile', None) is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
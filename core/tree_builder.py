@@ -0,0 +1,141 @@
+from core.distances import DistanceCalculator
+
+
+class TreeBuilder():
+    '''
+    The TreeBuilder class builds quick exploratory trees (neighbor-joining
+    or UPGMA) from an alignment, as a fast alternative to MrBayes
+    '''
+
+    METHODS = ('nj', 'upgma')
+    _RESERVED_CHARS = " (),:;[]'"
+    _label_translation = str.maketrans(_RESERVED_CHARS, '_' * len(_RESERVED_CHARS))
+
+    @classmethod
+    def build(cls, alpianos, names, method='nj'):
+        '''
+        Return the Newick string of a tree over the aligned melodies and the
+        Newick labels used for `names`, in the same order
+        '''
+        if method not in cls.METHODS:
+            raise ValueError('Unknown tree method: {}'.format(method))
+        if len(alpianos) != len(names):
+            raise ValueError('Every aligned melody needs a name')
+        if not alpianos:
+            raise ValueError('The alignment is empty')
+
+        labels = cls.newick_labels(names)
+        matrix = DistanceCalculator.encode_alignment(alpianos)
+        distances = DistanceCalculator.p_distance(matrix)
+        if method == 'upgma':
+            return cls.upgma(distances, labels), labels
+        return cls.neighbor_joining(distances, labels), labels
+
+    @classmethod
+    def newick_label(cls, name):
+        '''
+        Make a name safe to use unquoted in Newick: whitespace and reserved
+        characters become underscores, as in the MAFFT guide tree
+        '''
+        return str(name).translate(cls._label_translation)
+
+    @classmethod
+    def newick_labels(cls, names):
+        '''
+        Newick labels of `names`, in the same order; labels that collide
+        once sanitized (e.g. 'a b' and 'a_b') get a counter suffix, as
+        chant Newick names do
+        '''
+        labels = []
+        used = set()
+        for name in names:
+            label = cls.newick_label(name)
+            if label in used:
+                counter = 0
+                while label + '_' + str(counter) in used:
+                    counter += 1
+                label += '_' + str(counter)
+            used.add(label)
+            labels.append(label)
+        return labels
+
+    @classmethod
+    def _branch(cls, node, length):
+        return '{}:{:.6f}'.format(node, max(length, 0.0))
+
+    @classmethod
+    def neighbor_joining(cls, distances, labels):
+        '''
+        Saitou & Nei neighbor-joining; returns an unrooted tree whose last
+        three nodes meet at the root. Negative branch lengths are set to 0.
+        '''
+        import numpy as np
+
+        d = np.array(distances, dtype=np.float64)
+        nodes = list(labels)
+        if len(nodes) == 1:
+            return nodes[0] + ';'
+        if len(nodes) == 2:
+            half = d[0, 1] / 2
+            return '({},{});'.format(cls._branch(nodes[0], half), cls._branch(nodes[1], half))
+
+        while len(nodes) > 3:
+            size = len(nodes)
+            totals = d.sum(axis=1)
+            q = (size - 2) * d - totals[:, None] - totals[None, :]
+            np.fill_diagonal(q, np.inf)
+            i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+            length_i = 0.5 * d[i, j] + (totals[i] - totals[j]) / (2 * (size - 2))
+            length_j = d[i, j] - length_i
+            joined = '({},{})'.format(cls._branch(nodes[i], length_i), cls._branch(nodes[j], length_j))
+
+            keep = [k for k in range(size) if k != i and k != j]
+            to_joined = 0.5 * (d[i, keep] + d[j, keep] - d[i, j])
+            reduced = np.zeros((size - 1, size - 1), dtype=np.float64)
+            reduced[:-1, :-1] = d[np.ix_(keep, keep)]
+            reduced[-1, :-1] = to_joined
+            reduced[:-1, -1] = to_joined
+            d = reduced
+            nodes = [nodes[k] for k in keep] + [joined]
+
+        length_a = 0.5 * (d[0, 1] + d[0, 2] - d[1, 2])
+        length_b = d[0, 1] - length_a
+        length_c = d[0, 2] - length_a
+        return '({},{},{});'.format(
+            cls._branch(nodes[0], length_a),
+            cls._branch(nodes[1], length_b),
+            cls._branch(nodes[2], length_c),
+        )
+
+    @classmethod
+    def upgma(cls, distances, labels):
+        '''
+        UPGMA (average linkage); returns a rooted ultrametric tree
+        '''
+        import numpy as np
+
+        d = np.array(distances, dtype=np.float64)
+        nodes = list(labels)
+        sizes = [1] * len(nodes)
+        heights = [0.0] * len(nodes)
+        np.fill_diagonal(d, np.inf)
+
+        while len(nodes) > 1:
+            i, j = sorted(np.unravel_index(np.argmin(d), d.shape))
+            height = d[i, j] / 2
+            joined = '({},{})'.format(
+                cls._branch(nodes[i], height - heights[i]),
+                cls._branch(nodes[j], height - heights[j]),
+            )
+            keep = [k for k in range(len(nodes)) if k != i and k != j]
+            to_joined = (sizes[i] * d[i, keep] + sizes[j] * d[j, keep]) / (sizes[i] + sizes[j])
+            reduced = np.full((len(keep) + 1, len(keep) + 1), np.inf)
+            reduced[:-1, :-1] = d[np.ix_(keep, keep)]
+            reduced[-1, :-1] = to_joined
+            reduced[:-1, -1] = to_joined
+            d = reduced
+            nodes = [nodes[k] for k in keep] + [joined]
+            sizes = [sizes[k] for k in keep] + [sizes[i] + sizes[j]]
+            heights = [heights[k] for k in keep] + [height]
+
+        return nodes[0] + ';'
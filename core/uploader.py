@@ -1,5 +1,10 @@
+import io
+from collections import defaultdict, deque
+
+from django.db import connection, transaction
 from django.db.models import Max
 
+from core import profiling
 from core.cantus_schema import (
     PROTECTED_FIELDS,
     UploadError,
@@ -8,10 +13,19 @@ from core.cantus_schema import (
     text_value,
 )
 from melodies.access import is_default_dataset_name
-from melodies.models import Chant
+from melodies.models import Chant, VisibleChant
+from melodies.snapshot import mark_default_datasets_changed
 
 _FLOAT_FIELDS = frozenset({'sequence', 'cao_concordances'})
 _BATCH_SIZE = 5000
+# Identify a chant across two versions of a dataset, e.g. a reseed.
+SYNC_KEY_FIELDS = ('chantlink', 'melody_id', 'srclink')
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
 
 class Uploader():
@@ -29,13 +43,15 @@ class Uploader():
             raise UploadError('The CSV file contains no chant rows')
 
         if dataset_idx is None:
-            max_dataset_idx = Chant.objects.aggregate(Max('dataset_idx'))['dataset_idx__max']
+            max_dataset_idx = VisibleChant.objects.aggregate(Max('dataset_idx'))['dataset_idx__max']
             dataset_idx = 0 if max_dataset_idx is None else max_dataset_idx + 1
 
         for row in rows:
             row['dataset_idx'] = dataset_idx
 
-        cls._bulk_insert(rows)
+        with transaction.atomic():
+            cls._bulk_insert(rows)
+            cls._mark_if_default(dataset_name, owner)
         return dataset_idx
 
     @classmethod
@@ -57,7 +73,9 @@ class Uploader():
         for row in rows:
             row['dataset_idx'] = idx
 
-        cls._bulk_insert(rows)
+        with transaction.atomic():
+            cls._bulk_insert(rows)
+            cls._mark_if_default(dataset_name, owner)
         return dataset_name
 
     @classmethod
@@ -81,13 +99,109 @@ class Uploader():
         return True
 
     @classmethod
-    def _rows_from_dataframe(cls, df, dataset_name, owner):
-        mapped = normalize_chant_dataframe(df)
+    def sync_dataframe(cls, df, dataset_name, owner=None, dataset_idx=None):
+        '''
+        Bring a dataset to the rows of the dataframe in place: only the chants
+        that changed are inserted, updated or deleted, and matched chants keep
+        their ids (see diff_rows). Returns the counts of diff_counts.
+        '''
+        rows = cls._rows_from_dataframe(df, dataset_name, owner)
+        if not rows:
+            raise UploadError('The CSV file contains no chant rows')
+
+        fields = cls._data_fields()
+        existing = Chant.objects.filter(dataset_name=dataset_name, owner=owner)
+        if dataset_idx is None:
+            dataset_idx = existing.values_list('dataset_idx', flat=True).first()
+        if dataset_idx is None:
+            max_dataset_idx = VisibleChant.objects.aggregate(Max('dataset_idx'))['dataset_idx__max']
+            dataset_idx = 0 if max_dataset_idx is None else max_dataset_idx + 1
+        diff = cls.diff_rows(list(existing.values('id', 'dataset_idx', *fields)), rows)
+
+        with transaction.atomic():
+            deleted = diff['delete']
+            for start in range(0, len(deleted), _BATCH_SIZE):
+                Chant.objects.filter(pk__in=deleted[start:start + _BATCH_SIZE]).delete()
+            if diff['update']:
+                Chant.objects.bulk_update([Chant(**row) for row in diff['update']],
+                                          sorted(diff['changed_fields']), batch_size=_BATCH_SIZE)
+            if diff['insert']:
+                for row in diff['insert']:
+                    row['dataset_idx'] = dataset_idx
+                cls._bulk_insert(diff['insert'])
+            if diff['delete'] or diff['update'] or diff['insert']:
+                cls._mark_if_default(dataset_name, owner)
+        return cls.diff_counts(diff)
+
+    @classmethod
+    def _mark_if_default(cls, dataset_name, owner):
+        '''Invalidate the default dataset snapshot when default rows changed'''
+        if owner is None and is_default_dataset_name(dataset_name):
+            mark_default_datasets_changed()
+
+    @classmethod
+    def diff_rows(cls, current, rows):
+        '''
+        Match new `rows` (from _rows_from_dataframe) to the `current` rows of
+        a dataset (dicts with their ids). Chants match on SYNC_KEY_FIELDS, or
+        on all their data when they have none of them; chants with the same
+        key are paired in order. Matched rows get the id (and dataset_idx)
+        of their current row.
+
+        Returns the rows to 'insert', the matched rows to 'update' and the
+        'unchanged' ones, the ids to 'delete' and the 'changed_fields' of
+        the updates.
+        '''
+        fields = cls._data_fields()
+
+        def key(row):
+            sync_key = tuple(row.get(field) for field in SYNC_KEY_FIELDS)
+            if any(value is not None for value in sync_key):
+                return ('key',) + sync_key
+            return ('data',) + tuple(row.get(field) for field in fields)
+
+        unmatched = defaultdict(deque)
+        for row in sorted(current, key=lambda row: row['id']):
+            unmatched[key(row)].append(row)
+
+        diff = {'insert': [], 'update': [], 'unchanged': [], 'delete': [], 'changed_fields': set()}
+        for row in rows:
+            candidates = unmatched.get(key(row))
+            if not candidates:
+                diff['insert'].append(row)
+                continue
+            old = candidates.popleft()
+            row['id'] = old['id']
+            if 'dataset_idx' in old:
+                row['dataset_idx'] = old['dataset_idx']
+            changed = [field for field in fields if old.get(field) != row.get(field)]
+            if changed:
+                diff['changed_fields'].update(changed)
+                diff['update'].append(dict({field: row.get(field) for field in fields}, **row))
+            else:
+                diff['unchanged'].append(row)
+        diff['delete'] = sorted(row['id'] for candidates in unmatched.values() for row in candidates)
+        return diff
+
+    @classmethod
+    def diff_counts(cls, diff):
+        return {name: len(diff[name]) for name in ('insert', 'update', 'delete', 'unchanged')}
+
+    @classmethod
+    def _data_fields(cls):
+        '''Chant fields a CSV file can set.'''
         allowed = {
             field.attname if field.is_relation else field.name
             for field in Chant._meta.fields
         } - PROTECTED_FIELDS
         allowed.discard('id')
+        return sorted(allowed)
+
+    @classmethod
+    @profiling.staged('upload_rows')
+    def _rows_from_dataframe(cls, df, dataset_name, owner):
+        mapped = normalize_chant_dataframe(df)
+        allowed = set(cls._data_fields())
 
         rows = []
         owner_id = owner.id if owner is not None else None
@@ -106,6 +220,25 @@ class Uploader():
         return rows
 
     @classmethod
+    @profiling.staged('upload_insert')
     def _bulk_insert(cls, rows):
+        if connection.vendor == 'postgresql':
+            cls._copy_insert(rows)
+            return
         chants = [Chant(**row) for row in rows]
         Chant.objects.bulk_create(chants, batch_size=_BATCH_SIZE)
+
+    @classmethod
+    def _copy_insert(cls, rows):
+        '''Stream the rows to PostgreSQL with one COPY FROM STDIN (text format)'''
+        columns = sorted({column for row in rows for column in row})
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(_copy_value(row.get(column)) for column in columns) + '\n')
+        data.seek(0)
+        quote = connection.ops.quote_name
+        sql = 'COPY {} ({}) FROM STDIN'.format(
+            quote(Chant._meta.db_table),
+            ', '.join(quote(Chant._meta.get_field(column).column) for column in columns))
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, data)
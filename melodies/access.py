@@ -1,6 +1,6 @@
 from django.db.models import Q
 
-from melodies.models import Chant
+from melodies.models import Chant, VisibleChant
 
 DEFAULT_DATASET_NAMES = ('CantusCorpus v1.0', 'netvor-0.3')
 
@@ -30,8 +30,14 @@ def ordered_data_sources(user):
 def visible_chants(user):
     defaults = default_dataset_filter()
     if user is not None and user.is_authenticated:
-        return Chant.objects.filter(defaults | Q(owner=user))
-    return Chant.objects.filter(defaults)
+        return VisibleChant.objects.filter(defaults | Q(owner=user))
+    return VisibleChant.objects.filter(defaults)
+
+
+def owned_chants(user):
+    if user is not None and user.is_authenticated:
+        return Chant.objects.filter(owner=user)
+    return Chant.objects.none()
 
 
 def flatten_ids(ids):
@@ -47,9 +53,21 @@ def flatten_ids(ids):
 
 
 def all_ids_visible(user, ids):
+    from melodies.snapshot import get_snapshot
+
     flat = flatten_ids(ids)
     if not flat:
         return True
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        try:
+            rows = snapshot.rows_for_ids(flat).tolist()
+        except (TypeError, ValueError, OverflowError):
+            rows = None
+        if rows is not None:
+            flat = [item for item, row in zip(flat, rows) if row < 0]
+            if not flat:
+                return True
     visible = set(
         visible_chants(user).filter(pk__in=flat).values_list('id', flat=True)
     )
@@ -5,8 +5,35 @@ class MelodiesConfig(AppConfig):
     name = 'melodies'
 
     def ready(self):
-        from django.db.models.signals import post_migrate
+        from django.core.signals import request_started
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate, pre_migrate
+        from melodies.database import (
+            configure_connection, drop_visible_view, reattach_default_database, restore_visible_view,
+        )
+        connection_created.connect(configure_connection, dispatch_uid='configure_sqlite_connection')
+        pre_migrate.connect(drop_visible_view, dispatch_uid='drop_visible_chant_view')
+        post_migrate.connect(restore_visible_view, dispatch_uid='restore_visible_chant_view')
         post_migrate.connect(seed_default_datasets_after_migrate, sender=self)
+        request_started.connect(reap_orphaned_computations, dispatch_uid='reap_orphaned_computations')
+        request_started.connect(reattach_default_database, dispatch_uid='reattach_default_database')
+
+
+def reap_orphaned_computations(sender, **kwargs):
+    '''
+    On the first request of a worker, kill MAFFT/MrBayes processes left by
+    workers that were killed (e.g. by the gunicorn timeout) and remove
+    their temporary files.
+    '''
+    import logging
+    from django.core.signals import request_started
+    from django.db import DatabaseError
+    from melodies.scheduler import reap_dead_jobs
+    request_started.disconnect(dispatch_uid='reap_orphaned_computations')
+    try:
+        reap_dead_jobs()
+    except DatabaseError as e:
+        logging.warning('Cannot reap orphaned computations: {}'.format(e))
 
 
 def seed_default_datasets_after_migrate(sender, **kwargs):
@@ -0,0 +1,123 @@
+'''SQLite tuning of every new database connection.
+
+settings.SQLITE_PROFILE names one of settings.SQLITE_PROFILES, a dict of
+pragmas run when Django opens a connection. With persistent connections
+(CONN_MAX_AGE) this happens once per worker rather than once per request.
+
+The default datasets can live in a separate file (settings.DEFAULT_DATABASE_PATH,
+written by `manage.py build_default_database`) that every connection attaches
+read-only as the `defaults` schema. The TEMP view chant_visible (the
+VisibleChant model) reads the chants of both databases; without the file it
+is the main chant table alone. Replacing the file is picked up by the next
+request of every worker, see reattach_default_database.
+'''
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+
+DEFAULTS_SCHEMA = 'defaults'
+
+
+def pragma_statements(pragmas):
+    '''PRAGMA statements of a profile; journal_mode first, it must run outside a transaction.'''
+    names = sorted(pragmas, key=lambda name: name != 'journal_mode')
+    return ['PRAGMA {}={}'.format(name, pragmas[name]) for name in names]
+
+
+def default_database_path(connection):
+    '''The default datasets file to attach to `connection`, or None.'''
+    path = settings.DEFAULT_DATABASE_PATH
+    if connection.vendor != 'sqlite' or connection.is_in_memory_db() or not path:
+        return None
+    return path if os.path.exists(path) else None
+
+
+def _file_key(path):
+    '''Identity of the file at `path`: a rename over it changes the inode.'''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _chant_columns(cursor, schema):
+    cursor.execute('PRAGMA {}.table_info(chant)'.format(schema))
+    return [row[1] for row in cursor.fetchall()]
+
+
+def create_visible_view(connection):
+    '''(Re)create the TEMP view chant_visible of an SQLite connection.'''
+    with connection.cursor() as cursor:
+        columns = _chant_columns(cursor, 'main')
+        sql = 'SELECT * FROM main.chant'
+        if columns and getattr(connection, 'default_database_key', None) is not None:
+            # explicit columns, so that a default datasets file built before
+            # a chant migration still lines up (missing columns are NULL)
+            attached = set(_chant_columns(cursor, DEFAULTS_SCHEMA))
+            quote_name = connection.ops.quote_name
+            sql = 'SELECT {} FROM main.chant UNION ALL SELECT {} FROM {}.chant'.format(
+                ', '.join(quote_name(column) for column in columns),
+                ', '.join(quote_name(column) if column in attached else 'NULL AS ' + quote_name(column)
+                          for column in columns),
+                DEFAULTS_SCHEMA)
+        cursor.execute('DROP VIEW IF EXISTS temp.chant_visible')
+        cursor.execute('CREATE TEMP VIEW chant_visible AS ' + sql)
+
+
+def attach_default_database(connection, path):
+    '''Attach the default datasets file at `path` read-only and include its chants in chant_visible.'''
+    key = _file_key(path)
+    with connection.cursor() as cursor:
+        cursor.execute('ATTACH DATABASE %s AS {}'.format(DEFAULTS_SCHEMA),
+                       ['file:{}?mode=ro'.format(quote(os.path.abspath(path)))])
+    connection.default_database_key = key
+    create_visible_view(connection)
+
+
+def configure_connection(sender, connection, **kwargs):
+    '''connection_created receiver running the pragmas of the SQLite profile and attaching the default datasets'''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in pragma_statements(settings.SQLITE_PROFILES[settings.SQLITE_PROFILE]):
+            cursor.execute(statement)
+    connection.default_database_key = None
+    path = default_database_path(connection)
+    if path is not None:
+        attach_default_database(connection, path)
+    else:
+        create_visible_view(connection)
+
+
+def reattach_default_database(sender, **kwargs):
+    '''
+    request_started receiver closing the connection when the default
+    datasets file was replaced (or added or removed) since it was attached,
+    so that the request reconnects and reads the current file
+    '''
+    from django.db import connection
+    if connection.vendor != 'sqlite' or connection.connection is None or connection.in_atomic_block:
+        return
+    path = default_database_path(connection)
+    key = _file_key(path) if path is not None else None
+    if key != getattr(connection, 'default_database_key', None):
+        connection.close()
+
+
+def drop_visible_view(sender, using, **kwargs):
+    '''pre_migrate receiver: SQLite cannot rebuild the chant table while a view refers to it'''
+    from django.db import connections
+    connection = connections[using]
+    if connection.vendor == 'sqlite' and connection.connection is not None:
+        with connection.cursor() as cursor:
+            cursor.execute('DROP VIEW IF EXISTS temp.chant_visible')
+
+
+def restore_visible_view(sender, using, **kwargs):
+    '''post_migrate receiver recreating the view removed by drop_visible_view'''
+    from django.db import connections
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        create_visible_view(connection)
@@ -0,0 +1,174 @@
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from melodies.database import pragma_statements
+from melodies.synthetic import synthetic_chant_rows
+
+COLUMNS = ('incipit', 'cantus_id', 'mode', 'siglum', 'position', 'folio', 'feast_id', 'genre_id',
+           'office_id', 'full_text', 'volpiano', 'dataset_name', 'dataset_idx')
+LIST_QUERY = ('SELECT id, incipit, cantus_id, siglum, genre_id, office_id, volpiano FROM chant '
+              'WHERE dataset_idx = 0 AND siglum IN ({}) ORDER BY incipit')
+FETCH_QUERY = 'SELECT * FROM chant WHERE id IN ({})'
+INSERT_QUERY = 'INSERT INTO chant ({}) VALUES ({})'.format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+UPDATE_QUERY = 'UPDATE chant SET volpiano = ? WHERE id = ?'
+
+
+def _rows(count, seed, dataset_idx):
+    return [tuple(row[column] for column in COLUMNS[:-2]) + ('benchmark', dataset_idx)
+            for row in synthetic_chant_rows(count, seed=seed)]
+
+
+def _connect(path, profile, timeout):
+    db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    for statement in pragma_statements(settings.SQLITE_PROFILES[profile]):
+        db.execute(statement)
+    return db
+
+
+def _reader(path, profile, timeout, seconds, seed, results):
+    '''Chant list filtered by sources, then a chant selection fetched by id, like the list and align views.'''
+    rng = random.Random(seed)
+    db = _connect(path, profile, timeout)
+    sigla = [siglum for siglum, in db.execute('SELECT DISTINCT siglum FROM chant')]
+    max_id = db.execute('SELECT MAX(id) FROM chant').fetchone()[0]
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            selected = rng.sample(sigla, min(3, len(sigla)))
+            db.execute(LIST_QUERY.format(', '.join('?' * len(selected))), selected).fetchall()
+            ids = [rng.randint(1, max_id) for _ in range(30)]
+            db.execute(FETCH_QUERY.format(', '.join('?' * len(ids))), ids).fetchall()
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    db.close()
+    results.put(('read', latencies, errors))
+
+
+def _writer(path, profile, timeout, seconds, seed, batch, results):
+    '''Uploads of `batch` chants and single volpiano updates, each in its own transaction.'''
+    rng = random.Random(seed)
+    rows = _rows(batch, seed, 100 + seed)
+    db = _connect(path, profile, timeout)
+    max_id = db.execute('SELECT MAX(id) FROM chant').fetchone()[0]
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            if rng.random() < 0.5:
+                db.executemany(INSERT_QUERY, rows)
+            else:
+                db.execute(UPDATE_QUERY, ('1---g---4', rng.randint(1, max_id)))
+            db.execute('COMMIT')
+        except sqlite3.OperationalError:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    db.close()
+    results.put(('write', latencies, errors))
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(max(math.ceil(len(ordered) * percent / 100) - 1, 0), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Compare SQLite profiles (settings.SQLITE_PROFILES) under mixed load: reader processes '
+            'run list and fetch queries while writer processes upload and update chants in a '
+            'synthetic copy of the chant table.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', default=','.join(settings.SQLITE_PROFILES),
+                            help='Comma-separated profile names.')
+        parser.add_argument('--readers', type=int, default=4, help='Reading processes.')
+        parser.add_argument('--writers', type=int, default=1, help='Writing processes.')
+        parser.add_argument('--seconds', type=float, default=10, help='Duration of every run.')
+        parser.add_argument('--rows', type=int, default=50000, help='Chants in the benchmark table.')
+        parser.add_argument('--batch', type=int, default=200, help='Chants per upload transaction.')
+        parser.add_argument('--timeout', type=float,
+                            default=settings.DATABASES['default'].get('OPTIONS', {}).get('timeout', 30),
+                            help='Busy timeout in seconds.')
+        parser.add_argument('--seed', type=int, default=0, help='Generation seed.')
+
+    def handle(self, *args, **options):
+        profiles = [name for name in options['profiles'].split(',') if name]
+        unknown = [name for name in profiles if name not in settings.SQLITE_PROFILES]
+        if unknown:
+            raise CommandError('Unknown profiles: {}'.format(', '.join(unknown)))
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark compares SQLite profiles')
+
+        temp_dir = tempfile.mkdtemp(prefix='chantlab-db-benchmark-')
+        try:
+            template = os.path.join(temp_dir, 'template.db')
+            self._build(template, options['rows'], options['seed'])
+            self.stdout.write('{:<10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+                'profile', 'reads/s', 'p50 ms', 'p95 ms', 'writes/s', 'p50 ms', 'p95 ms', 'errors'))
+            for profile in profiles:
+                path = os.path.join(temp_dir, '{}.db'.format(profile))
+                shutil.copyfile(template, path)
+                self._report(profile, self._run(path, profile, options))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _build(self, path, rows, seed):
+        '''The chant table with its indexes and `rows` synthetic chants in dataset 0.'''
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'chant' AND sql IS NOT NULL "
+                           "ORDER BY type = 'index'")
+            schema = [sql for sql, in cursor.fetchall()]
+        db = sqlite3.connect(path)
+        for sql in schema:
+            db.execute(sql)
+        db.executemany(INSERT_QUERY, _rows(rows, seed, 0))
+        db.commit()
+        db.close()
+
+    def _run(self, path, profile, options):
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_reader, args=(
+            path, profile, options['timeout'], options['seconds'], options['seed'] + i, results))
+            for i in range(options['readers'])]
+        workers += [multiprocessing.Process(target=_writer, args=(
+            path, profile, options['timeout'], options['seconds'], options['seed'] + i, options['batch'], results))
+            for i in range(options['writers'])]
+        for worker in workers:
+            worker.start()
+        totals = {'read': ([], 0), 'write': ([], 0)}
+        for _ in workers:
+            kind, latencies, errors = results.get()
+            totals[kind] = (totals[kind][0] + latencies, totals[kind][1] + errors)
+        for worker in workers:
+            worker.join()
+        return {kind: {'per_second': len(latencies) / options['seconds'],
+                       'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95), 'errors': errors}
+                for kind, (latencies, errors) in totals.items()}
+
+    def _report(self, profile, result):
+        def ms(value):
+            return '{:>9.1f}'.format(value * 1000) if value is not None else '{:>9}'.format('-')
+
+        read, write = result['read'], result['write']
+        self.stdout.write('{:<10} {:>9.1f} {} {} {:>9.1f} {} {} {:>7}'.format(
+            profile, read['per_second'], ms(read['p50']), ms(read['p95']),
+            write['per_second'], ms(write['p50']), ms(write['p95']), read['errors'] + write['errors']))
@@ -0,0 +1,149 @@
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.chant_processor import ChantProcessor
+from core.distances import load_score_matrix
+from core.mafft import MAFFT_STRATEGIES, Mafft
+from melodies.management.commands.seed_default_datasets import SEED_FILES, seed_dir
+
+TEXT_MATRIX = 'resources/00_textmatrix_complete'
+
+
+def sum_of_pairs_score(aligned, matrix):
+    '''Sum of the matrix scores of all residue pairs in every column.
+
+    Pairs involving a gap score zero. The value is only meaningful for
+    comparing alignments of the same input.
+    '''
+    score = 0
+    for column in zip(*aligned):
+        counts = Counter(char for char in column if char != '-')
+        symbols = list(counts)
+        for i, first in enumerate(symbols):
+            same = counts[first]
+            score += matrix.get((first, first), 0) * same * (same - 1) // 2
+            for second in symbols[i + 1:]:
+                score += matrix.get((first, second), 0) * same * counts[second]
+    return score
+
+
+class Command(BaseCommand):
+    help = ('Time every MAFFT strategy on samples of the seed corpus, score the '
+            'alignments and suggest MAFFT_STRATEGY_THRESHOLDS.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='5,10,25,50,100,200',
+                            help='Comma-separated numbers of chants per sample.')
+        parser.add_argument('--strategies', default=','.join(MAFFT_STRATEGIES),
+                            help='Comma-separated strategy names to compare.')
+        parser.add_argument('--repeats', type=int, default=3,
+                            help='Timed runs per strategy and size; the fastest counts.')
+        parser.add_argument('--tolerance', type=float, default=0.01,
+                            help='Accepted relative score loss against the best strategy.')
+        parser.add_argument('--seed', type=int, default=0, help='Sampling seed.')
+        parser.add_argument('--output', default=None, help='Write the results as JSON.')
+
+    def handle(self, *args, **options):
+        strategies = [name for name in options['strategies'].split(',') if name]
+        unknown = [name for name in strategies if name not in MAFFT_STRATEGIES]
+        if unknown:
+            raise CommandError('Unknown strategies: {}'.format(', '.join(unknown)))
+        sizes = sorted(int(size) for size in options['sizes'].split(',') if size)
+        matrix = load_score_matrix(os.path.join(settings.BASE_DIR, TEXT_MATRIX))
+        volpianos = self._load_volpianos()
+        rng = random.Random(options['seed'])
+
+        results = []
+        recommendations = []
+        for size in sizes:
+            if size <= len(volpianos):
+                sample = rng.sample(volpianos, size)
+            else:
+                sample = rng.choices(volpianos, k=size)
+            total_length = sum(len(volpiano) for volpiano in sample)
+
+            measured = []
+            for strategy in strategies:
+                seconds = None
+                aligned = None
+                for _ in range(max(options['repeats'], 1)):
+                    started = time.perf_counter()
+                    aligned = self._align(sample, strategy)
+                    elapsed = time.perf_counter() - started
+                    seconds = elapsed if seconds is None else min(seconds, elapsed)
+                measured.append({
+                    'size': size,
+                    'total_length': total_length,
+                    'strategy': strategy,
+                    'seconds': round(seconds, 4),
+                    'score': sum_of_pairs_score(aligned, matrix),
+                    'columns': len(aligned[0]) if aligned else 0,
+                })
+                self.stdout.write('{size:>6} {strategy:>9} {seconds:>9.3f}s score={score}'.format(**measured[-1]))
+
+            best = max(item['score'] for item in measured)
+            accepted = [item for item in measured if item['score'] >= best * (1 - options['tolerance'])]
+            chosen = min(accepted, key=lambda item: item['seconds'])
+            recommendations.append((size, total_length, chosen['strategy']))
+            results.extend(measured)
+
+        thresholds = []
+        for size, total_length, strategy in recommendations:
+            if thresholds and thresholds[-1][2] == strategy:
+                thresholds[-1] = (size, total_length, strategy)
+            else:
+                thresholds.append((size, total_length, strategy))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Suggested MAFFT_STRATEGY_THRESHOLDS = {}'.format(tuple(thresholds))
+        ))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'results': results, 'thresholds': thresholds}, output, indent=2)
+
+    def _load_volpianos(self):
+        import pandas as pd
+
+        volpianos = []
+        for _, filename in SEED_FILES:
+            path = os.path.join(seed_dir(), filename)
+            if not os.path.exists(path):
+                continue
+            seed = pd.read_csv(path, compression='gzip')
+            for volpiano in seed['volpiano'].dropna():
+                if volpiano.strip():
+                    volpianos.append(ChantProcessor.process_volpiano_flats(
+                        ChantProcessor.fix_volpiano_beginnings_and_ends(volpiano)))
+        if len(volpianos) < 2:
+            raise CommandError('The seed corpus has fewer than two melodies')
+        return volpianos
+
+    def _align(self, volpianos, strategy):
+        os.makedirs(settings.TEMP_DIR, exist_ok=True)
+        input_path = os.path.join(settings.TEMP_DIR, uuid.uuid4().hex + '_mafft-inputs.txt')
+        mafft = Mafft(collapse_duplicates=False)
+        mafft.set_input(input_path)
+        mafft.add_option('--text')
+        mafft.add_option('--textmatrix ' + TEXT_MATRIX)
+        mafft.set_strategy(strategy)
+        for i, volpiano in enumerate(volpianos):
+            mafft.add_volpiano(volpiano, i, '', '')
+        try:
+            mafft.run()
+            aligned = mafft.get_aligned_sequences()
+        except RuntimeError as exc:
+            raise CommandError('MAFFT failed with strategy {}: {}'.format(strategy, exc))
+        finally:
+            for path in (input_path, input_path + '.tree'):
+                if os.path.exists(path):
+                    os.remove(path)
+        if not aligned:
+            raise CommandError('MAFFT produced no alignment with strategy {}'.format(strategy))
+        return aligned
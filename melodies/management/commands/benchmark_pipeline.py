@@ -0,0 +1,220 @@
+import json
+import os
+import random
+import shutil
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.http.response import JsonResponse
+from pycantus.volpiano.utils import clean_volpiano
+
+from core.aligner import Aligner
+from core.chant_processor import ChantProcessor
+from core.interval_processor import IntervalProcessor
+from core.mafft import MAFFT_PATH, Mafft
+from melodies.management.commands.seed_default_datasets import SEED_FILES, seed_dir
+from melodies.models import Chant
+from melodies.synthetic import synthetic_melodies
+
+CORPORA = ('synthetic', 'seed')
+BENCHMARK_DATASET = 'benchmark'
+# Chants per Cantus ID group in the concatenated alignments.
+GROUP_SIZE = 5
+
+
+def _text_syllables(chants):
+    for chant in chants:
+        ChantProcessor.get_syllables_from_text(chant['full_text'])
+
+
+def _volpiano_syllables(chants):
+    for chant in chants:
+        words = ChantProcessor.get_syllables_from_alpiano(ChantProcessor.insert_separator_chars(chant['volpiano']))
+        ChantProcessor.strip_barlines_from_volpiano_words(ChantProcessor.strip_clef_and_end_words(words))
+
+
+def _flats(chants):
+    for chant in chants:
+        ChantProcessor.process_volpiano_flats(chant['volpiano'])
+
+
+def _intervals(chants):
+    for chant in chants:
+        intervals = IntervalProcessor.transform_volpiano_to_intervals(
+            ChantProcessor.process_volpiano_flats(chant['volpiano']))
+        IntervalProcessor.transform_intervals_to_volpiano(intervals)
+
+
+def _text_boundaries(chants):
+    # unaligned melodies padded with gaps stand in for a MAFFT alignment
+    volpianos = [chant['volpiano'] for chant in chants]
+    melodies = [clean_volpiano(volpiano, keep_boundaries=False, keep_bars=False) for volpiano in volpianos]
+    length = max(len(melody) for melody in melodies)
+    Mafft.add_text_boundaries([melody.ljust(length, '-') for melody in melodies], volpianos,
+                              list(range(len(melodies))))
+
+
+def _aligner(method, concatenated):
+    def benchmark(chants):
+        result = method([chant['id'] for chant in chants], concatenated)
+        if isinstance(result, JsonResponse):
+            raise RuntimeError(json.loads(result.content)['message'])
+    return benchmark
+
+
+# name: (function, needs MAFFT)
+BENCHMARKS = {
+    'text_syllables': (_text_syllables, False),
+    'volpiano_syllables': (_volpiano_syllables, False),
+    'flats': (_flats, False),
+    'intervals': (_intervals, False),
+    'add_text_boundaries': (_text_boundaries, False),
+    'alignment_syllables': (_aligner(Aligner.alignment_syllables, False), False),
+    'alignment_syllables_concatenated': (_aligner(Aligner.alignment_syllables, True), False),
+    'alignment_pitches': (_aligner(Aligner.alignment_pitches, False), True),
+    'alignment_pitches_concatenated': (_aligner(Aligner.alignment_pitches, True), True),
+    'alignment_intervals': (_aligner(Aligner.alignment_intervals, False), True),
+    'alignment_intervals_concatenated': (_aligner(Aligner.alignment_intervals, True), True),
+}
+
+
+def mafft_available():
+    return os.path.exists(MAFFT_PATH) or shutil.which(MAFFT_PATH) is not None
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    '''Results slower than the baseline by more than `tolerance` (relative) and `min_seconds`.'''
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None or result.get('seconds') is None or before.get('seconds') is None:
+            continue
+        if result['seconds'] > before['seconds'] * (1 + tolerance) and \
+                result['seconds'] - before['seconds'] > min_seconds:
+            regressions.append((key, before['seconds'], result['seconds']))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = ('Time the alignment pipeline on synthetic and seed chants, store the '
+            'timings as a JSON baseline and fail on regressions against one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,50,200', help='Comma-separated numbers of chants.')
+        parser.add_argument('--corpora', default=','.join(CORPORA),
+                            help='Comma-separated inputs: synthetic, seed (netvor-0.3).')
+        parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                            help='Comma-separated benchmark names.')
+        parser.add_argument('--repeats', type=int, default=3, help='Timed runs per benchmark; the fastest counts.')
+        parser.add_argument('--seed', type=int, default=0, help='Sampling and generation seed.')
+        parser.add_argument('--baseline', default=None, help='JSON baseline to compare with.')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Write the results to --baseline instead of comparing.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Accepted relative slowdown against the baseline.')
+        parser.add_argument('--min-seconds', type=float, default=0.01,
+                            help='Slowdowns below this many seconds are noise.')
+
+    def handle(self, *args, **options):
+        names = [name for name in options['benchmarks'].split(',') if name]
+        corpora = [name for name in options['corpora'].split(',') if name]
+        unknown = [name for name in names if name not in BENCHMARKS] + [name for name in corpora if name not in CORPORA]
+        if unknown:
+            raise CommandError('Unknown benchmarks or corpora: {}'.format(', '.join(unknown)))
+        if options['save_baseline'] and not options['baseline']:
+            raise CommandError('--save-baseline needs --baseline')
+        sizes = sorted(int(size) for size in options['sizes'].split(',') if size)
+        has_mafft = mafft_available()
+
+        results = {}
+        for corpus in corpora:
+            for size in sizes:
+                chants = self._chants(corpus, size, options['seed'])
+                with transaction.atomic():
+                    # the chants only exist for the alignment benchmarks
+                    self._insert(chants)
+                    for name in names:
+                        function, needs_mafft = BENCHMARKS[name]
+                        key = '{}/{}/{}'.format(name, corpus, size)
+                        if needs_mafft and not has_mafft:
+                            results[key] = {'seconds': None, 'skipped': 'MAFFT not found'}
+                        else:
+                            results[key] = self._time(function, chants, options['repeats'])
+                        self._report(key, results[key])
+                    transaction.set_rollback(True)
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS('Wrote the baseline to {}.'.format(options['baseline'])))
+        elif options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = compare(results, baseline, options['tolerance'], options['min_seconds'])
+            if regressions:
+                raise CommandError('Regressions against {}:\n{}'.format(options['baseline'], '\n'.join(
+                    '  {}: {:.4f}s -> {:.4f}s'.format(*regression) for regression in regressions)))
+            self.stdout.write(self.style.SUCCESS('No regressions against {}.'.format(options['baseline'])))
+
+    def _time(self, function, chants, repeats):
+        seconds = None
+        try:
+            for _ in range(max(repeats, 1)):
+                started = time.perf_counter()
+                function(chants)
+                elapsed = time.perf_counter() - started
+                seconds = elapsed if seconds is None else min(seconds, elapsed)
+        except Exception as e:
+            return {'seconds': None, 'error': str(e)}
+        return {'seconds': round(seconds, 5)}
+
+    def _report(self, key, result):
+        if result['seconds'] is not None:
+            self.stdout.write('{:<55} {:>9.4f}s'.format(key, result['seconds']))
+        else:
+            self.stdout.write('{:<55} {}'.format(key, result.get('skipped') or result.get('error')))
+
+    def _chants(self, corpus, size, seed):
+        if corpus == 'synthetic':
+            melodies = synthetic_melodies(size, seed=seed)
+        else:
+            melodies = self._seed_melodies()
+            rng = random.Random(seed)
+            melodies = rng.sample(melodies, size) if size <= len(melodies) else rng.choices(melodies, k=size)
+        groups = max(size // GROUP_SIZE, 1)
+        return [{
+            'full_text': text,
+            'volpiano': volpiano,
+            'cantus_id': 'bench{:04d}'.format(i % groups),
+            'siglum': 'BENCH {}'.format(i // groups),
+        } for i, (text, volpiano) in enumerate(melodies)]
+
+    def _seed_melodies(self):
+        import pandas as pd
+
+        melodies = []
+        for _, filename in SEED_FILES:
+            path = os.path.join(seed_dir(), filename)
+            if not os.path.exists(path):
+                continue
+            seed = pd.read_csv(path, compression='gzip')
+            for text, volpiano in seed[['full_text', 'volpiano']].dropna().itertuples(index=False):
+                if volpiano.strip():
+                    melodies.append((text, volpiano))
+        if not melodies:
+            raise CommandError('The seed corpus has no melodies')
+        return melodies
+
+    def _insert(self, chants):
+        created = Chant.objects.bulk_create([
+            Chant(incipit=chant['full_text'][:40], full_text=chant['full_text'], volpiano=chant['volpiano'],
+                  cantus_id=chant['cantus_id'], siglum=chant['siglum'], dataset_name=BENCHMARK_DATASET)
+            for chant in chants
+        ])
+        ids = [chant.id for chant in created]
+        if None in ids:
+            ids = list(Chant.objects.filter(dataset_name=BENCHMARK_DATASET).order_by('id')
+                       .values_list('id', flat=True))[-len(chants):]
+        for chant, chant_id in zip(chants, ids):
+            chant['id'] = chant_id
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+
+from core.uploader import Uploader
+from melodies.access import DEFAULT_DATASET_NAMES, default_dataset_filter
+from melodies.management.commands.seed_default_datasets import default_dataset_sources, format_counts
+from melodies.models import Chant, VisibleChant
+from melodies.snapshot import mark_default_datasets_changed, snapshot_path, write_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Build the default datasets into a separate SQLite file, rename it over '
+            'settings.DEFAULT_DATABASE_PATH and remove the default rows from the main database. '
+            'Chants still in the seeds keep their ids (see Uploader.diff_rows). '
+            'Running workers attach the new file on their next request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from-database',
+            action='store_true',
+            help='Copy the default datasets currently in the databases, keeping their ids, '
+                 'instead of loading the seeds (e.g. to move them out of the main database).',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('A separate default datasets database needs SQLite')
+        path = settings.DEFAULT_DATABASE_PATH
+
+        datasets = self._load(options['from_database'])
+        if not datasets:
+            raise CommandError('No default dataset to build')
+        self._assign_dataset_indexes(datasets)
+        self._assign_ids(datasets)
+
+        temp_path = self._write(path, datasets)
+        try:
+            with transaction.atomic():
+                removed, _ = Chant.objects.filter(default_dataset_filter()).delete()
+                mark_default_datasets_changed()
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # reconnect to attach the new file
+        connection.close()
+
+        for name, rows in datasets:
+            self.stdout.write('{}: {} rows (dataset_idx={}).'.format(name, len(rows), rows[0]['dataset_idx']))
+        if removed:
+            self.stdout.write('Removed {} default rows from the main database.'.format(removed))
+        self.stdout.write(self.style.SUCCESS('Built {}.'.format(path)))
+
+        if os.path.exists(snapshot_path()):
+            rows = write_snapshot()
+            self.stdout.write('Rebuilt default dataset snapshot ({} rows).'.format(rows))
+
+    def _current_rows(self, name):
+        fields = [field.attname for field in Chant._meta.concrete_fields]
+        chants = VisibleChant.objects.filter(default_dataset_filter(), dataset_name=name).order_by('id')
+        return list(chants.values(*fields))
+
+    def _load(self, from_database):
+        '''(name, rows) of every default dataset; rows are dicts keyed by Chant attnames.'''
+        datasets = []
+        if from_database:
+            for name in DEFAULT_DATASET_NAMES:
+                rows = self._current_rows(name)
+                if rows:
+                    datasets.append((name, rows))
+            return datasets
+
+        for name, source_label, load_df in default_dataset_sources():
+            self.stdout.write('Loading {} from {} ...'.format(name, source_label))
+            df = load_df()
+            current = self._current_rows(name)
+            if df is None:
+                rows = current
+                self.stderr.write('{} is missing, keeping the {} current rows of {}.'.format(
+                    source_label, len(rows), name))
+            else:
+                # chants that are still there keep their ids
+                diff = Uploader.diff_rows(current, Uploader._rows_from_dataframe(df, name, None))
+                rows = sorted(diff['unchanged'] + diff['update'], key=lambda row: row['id']) + diff['insert']
+                self.stdout.write('{}: {}.'.format(name, format_counts(Uploader.diff_counts(diff))))
+            if rows:
+                datasets.append((name, rows))
+        return datasets
+
+    def _assign_dataset_indexes(self, datasets):
+        '''Keep the dataset_idx of every dataset that exists, so that saved selections stay valid.'''
+        current = dict(VisibleChant.objects.filter(default_dataset_filter())
+                       .values_list('dataset_name', 'dataset_idx').distinct())
+        max_dataset_idx = VisibleChant.objects.aggregate(Max('dataset_idx'))['dataset_idx__max']
+        next_idx = 0 if max_dataset_idx is None else max_dataset_idx + 1
+        for name, rows in datasets:
+            dataset_idx = current.get(name)
+            if dataset_idx is None:
+                dataset_idx, next_idx = next_idx, next_idx + 1
+            for row in rows:
+                row['dataset_idx'] = dataset_idx
+
+    def _assign_ids(self, datasets):
+        '''
+        Ids for the new rows, reserved in the AUTOINCREMENT sequence of the
+        main chant table so that later uploads never reuse them
+        '''
+        new_rows = [row for _, rows in datasets for row in rows if row.get('id') is None]
+        if not new_rows:
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chant'")
+            sequence = cursor.fetchone()
+            cursor.execute('SELECT MAX(id) FROM chant_visible')
+            first = max(sequence[0] if sequence else 0, cursor.fetchone()[0] or 0) + 1
+            last = first + len(new_rows) - 1
+            if sequence:
+                cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = 'chant'", [last])
+            else:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('chant', %s)", [last])
+        for id, row in enumerate(new_rows, start=first):
+            row['id'] = id
+
+    def _write(self, path, datasets):
+        '''Write the chant table with its indexes and the rows to a temporary file next to `path`.'''
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM main.sqlite_master WHERE tbl_name = 'chant' AND sql IS NOT NULL "
+                           "ORDER BY type = 'index'")
+            schema = [sql for sql, in cursor.fetchall()]
+        fields = Chant._meta.concrete_fields
+        insert = 'INSERT INTO chant ({}) VALUES ({})'.format(
+            ', '.join(connection.ops.quote_name(field.column) for field in fields), ', '.join('?' * len(fields)))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.default_datasets-', suffix='.db', dir=directory)
+        os.close(fd)
+        try:
+            db = sqlite3.connect(temp_path)
+            try:
+                for sql in schema:
+                    db.execute(sql)
+                for _, rows in datasets:
+                    db.executemany(insert, ([row.get(field.attname) for field in fields] for row in rows))
+                db.commit()
+                db.execute('ANALYZE')
+                db.commit()
+            finally:
+                db.close()
+            os.chmod(temp_path, 0o644)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from melodies.snapshot import snapshot_path, write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write the memory-mapped columnar snapshot of the shared default datasets.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=None,
+            help='Snapshot file to write (defaults to settings.DEFAULT_SNAPSHOT_PATH).',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path'] or snapshot_path()
+        rows = write_snapshot(path)
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote {} default chants to {}.'.format(rows, path)
+        ))
@@ -0,0 +1,64 @@
+import itertools
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.uploader import Uploader
+from melodies.access import is_default_dataset_name
+from melodies.models import Chant
+from melodies.synthetic import synthetic_chant_rows
+
+
+class Command(BaseCommand):
+    help = ('Load a synthetic corpus of N chants (realistic volpiano, Latin text, sigla, '
+            'genres, offices and Cantus IDs) for benchmarks and scale tests.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Number of chants to generate.')
+        parser.add_argument('--dataset-name', default='synthetic', help='Name of the new dataset.')
+        parser.add_argument('--owner', default=None,
+                            help='Username owning the dataset, so it shows in the app; '
+                                 'without it the rows are only reachable through SQL.')
+        parser.add_argument('--seed', type=int, default=0, help='Generation seed.')
+        parser.add_argument('--sources', type=int, default=None, help='Number of sigla (default N/400).')
+        parser.add_argument('--cantus-ids', type=int, default=None, help='Number of Cantus IDs (default N/20).')
+        parser.add_argument('--batch-size', type=int, default=20000, help='Chants uploaded per batch.')
+        parser.add_argument('--replace', action='store_true',
+                            help='Delete an existing dataset of the same name and owner first.')
+
+    def handle(self, *args, **options):
+        import pandas as pd
+
+        name = options['dataset_name']
+        if is_default_dataset_name(name):
+            raise CommandError('{} is a default dataset name'.format(name))
+        owner = None
+        if options['owner']:
+            owner = User.objects.filter(username=options['owner']).first()
+            if owner is None:
+                raise CommandError('No user {}'.format(options['owner']))
+        existing = Chant.objects.filter(dataset_name=name, owner=owner)
+        if existing.exists():
+            if not options['replace']:
+                raise CommandError('Dataset {} exists, use --replace to overwrite it'.format(name))
+            existing.delete()
+
+        rows = synthetic_chant_rows(options['count'], seed=options['seed'],
+                                    sources=options['sources'], cantus_ids=options['cantus_ids'])
+        started = time.perf_counter()
+        loaded = 0
+        dataset_idx = None
+        with transaction.atomic():
+            while True:
+                batch = list(itertools.islice(rows, max(options['batch_size'], 1)))
+                if not batch:
+                    break
+                dataset_idx = Uploader.upload_dataframe(pd.DataFrame(batch), name, owner=owner,
+                                                        dataset_idx=dataset_idx)
+                loaded += len(batch)
+                self.stdout.write('{} chants ({:.0f}/s)'.format(
+                    loaded, loaded / max(time.perf_counter() - started, 1e-9)))
+        self.stdout.write(self.style.SUCCESS('Loaded {} synthetic chants into {} (dataset_idx {}).'.format(
+            loaded, name, dataset_idx)))
@@ -0,0 +1,23 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from melodies.middleware import profiling_enabled
+
+
+class Command(BaseCommand):
+    help = 'Switch request profiling (Server-Timing headers and timing logs) on or off in all workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('state', nargs='?', choices=('on', 'off', 'status'), default='status')
+
+    def handle(self, *args, **options):
+        path = settings.PROFILING_FLAG_FILE
+        if options['state'] == 'on':
+            open(path, 'a').close()
+        elif options['state'] == 'off' and os.path.exists(path):
+            os.remove(path)
+        if options['state'] == 'off' and settings.PROFILING:
+            self.stdout.write(self.style.WARNING('PROFILING is set in the environment and keeps profiling on.'))
+        self.stdout.write('Profiling is {}.'.format('on' if profiling_enabled() else 'off'))
@@ -1,7 +1,9 @@
 import os
 
 from django.conf import settings
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db import connection
 import pandas as pd
 
 from core.cantus_schema import UploadError
@@ -12,6 +14,7 @@ from melodies.management.cantuscorpus import (
     load_cantuscorpus,
 )
 from melodies.models import Chant
+from melodies.snapshot import snapshot_path, write_snapshot
 
 SEED_FILES = (
     ('netvor-0.3', 'netvor-0.3.csv.gz'),
@@ -22,6 +25,28 @@ def seed_dir():
     return os.path.join(settings.BASE_DIR, 'seeds', 'default_datasets')
 
 
+def read_seed_csv(path):
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, compression='gzip')
+
+
+def default_dataset_sources():
+    '''(name, source label, loader) of the default datasets; a loader returns None when its source is missing.'''
+    sources = []
+    if CANTUS_DATASET_NAME in DEFAULT_DATASET_NAMES:
+        sources.append((CANTUS_DATASET_NAME, 'PyCantus', load_cantuscorpus))
+    for name, filename in SEED_FILES:
+        if name in DEFAULT_DATASET_NAMES:
+            path = os.path.join(seed_dir(), filename)
+            sources.append((name, filename, lambda seed_path=path: read_seed_csv(seed_path)))
+    return sources
+
+
+def format_counts(counts):
+    return '{insert} inserted, {update} updated, {delete} deleted, {unchanged} unchanged'.format(**counts)
+
+
 class Command(BaseCommand):
     help = 'Load shared default datasets into the runtime database if they are missing.'
 
@@ -29,36 +54,30 @@ class Command(BaseCommand):
         parser.add_argument(
             '--force',
             action='store_true',
-            help='Replace existing default datasets, keeping their dataset_idx values.',
+            help='Update existing default datasets to their sources, changing only the chants '
+                 'that differ; chants keep their ids and datasets their dataset_idx values.',
         )
 
     def handle(self, *args, **options):
         force = options['force']
+        changed = False
 
-        if CANTUS_DATASET_NAME in DEFAULT_DATASET_NAMES:
-            self._seed_dataset(
-                CANTUS_DATASET_NAME,
-                lambda: load_cantuscorpus(),
-                force,
-                source_label='PyCantus',
-            )
+        # A separate default datasets database is rebuilt as a whole.
+        if connection.vendor == 'sqlite' and os.path.exists(settings.DEFAULT_DATABASE_PATH):
+            if not force:
+                self.stdout.write('Default datasets are in {}, skipping.'.format(
+                    settings.DEFAULT_DATABASE_PATH))
+                return
+            call_command('build_default_database', stdout=self.stdout, stderr=self.stderr)
+            return
 
-        for name, filename in SEED_FILES:
-            if name not in DEFAULT_DATASET_NAMES:
-                continue
-            path = os.path.join(seed_dir(), filename)
-            self._seed_dataset(
-                name,
-                lambda seed_path=path: self._read_seed_csv(seed_path),
-                force,
-                source_label=filename,
-            )
+        for name, source_label, load_df in default_dataset_sources():
+            changed |= self._seed_dataset(name, load_df, force, source_label=source_label)
 
-    def _read_seed_csv(self, path):
-        if not os.path.exists(path):
-            self.stderr.write('Seed file missing: {}'.format(path))
-            return None
-        return pd.read_csv(path, compression='gzip')
+        # Keep an existing snapshot in step with the rows it mirrors.
+        if changed and os.path.exists(snapshot_path()):
+            rows = write_snapshot()
+            self.stdout.write('Rebuilt default dataset snapshot ({} rows).'.format(rows))
 
     def _seed_dataset(self, name, load_df, force, source_label):
         existing = Chant.objects.filter(dataset_name=name, owner__isnull=True)
@@ -66,25 +85,28 @@ class Command(BaseCommand):
         if existing.exists():
             if not force:
                 self.stdout.write('{} already present, skipping.'.format(name))
-                return
+                return False
             old_idx = existing.values_list('dataset_idx', flat=True).first()
 
         self.stdout.write('Loading {} from {} ...'.format(name, source_label))
         df = load_df()
         if df is None:
-            return
-
-        if existing.exists():
-            deleted, _ = existing.delete()
-            self.stdout.write('Removed {} existing {} rows.'.format(deleted, name))
+            self.stderr.write('Seed file missing: {}'.format(source_label))
+            return False
 
         try:
-            new_idx = Uploader.upload_dataframe(df, name, owner=None, dataset_idx=old_idx)
+            if old_idx is not None:
+                counts = Uploader.sync_dataframe(df, name, owner=None, dataset_idx=old_idx)
+                self.stdout.write(self.style.SUCCESS('Updated {} from {} ({}, dataset_idx={}).'.format(
+                    name, source_label, format_counts(counts), old_idx)))
+                return counts['insert'] + counts['update'] + counts['delete'] > 0
+            new_idx = Uploader.upload_dataframe(df, name, owner=None)
         except UploadError as exc:
             self.stderr.write('Failed to load {}: {}'.format(name, exc))
-            return
+            return True
         self.stdout.write(self.style.SUCCESS(
             'Loaded {} from {} ({} rows, dataset_idx={}).'.format(
                 name, source_label, len(df), new_idx
             )
         ))
+        return True
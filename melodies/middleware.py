@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from core import metrics, profiling
+
+logger = logging.getLogger('melodies.profiling')
+
+
+def profiling_enabled():
+    '''
+    Profiling is on with settings.PROFILING or while the flag file exists,
+    so it can be switched at runtime (`manage.py profiling on|off`).
+    '''
+    return settings.PROFILING or os.path.exists(settings.PROFILING_FLAG_FILE)
+
+
+class QueryTimer():
+    '''connection.execute_wrapper counting SQL queries and their time'''
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+def _server_timing(name, seconds, description=None):
+    entry = '{};dur={:.1f}'.format(name, seconds * 1000)
+    if description:
+        entry += ';desc="{}"'.format(description)
+    return entry
+
+
+class ProfilingMiddleware():
+    '''
+    Time the stages marked with core.profiling, the SQL queries and the
+    whole request; report them in the Server-Timing header and one JSON
+    log line per request.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiling_enabled():
+            return self.get_response(request)
+
+        queries = QueryTimer()
+        started = time.perf_counter()
+        with profiling.profiled() as profile, connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        total = time.perf_counter() - started
+
+        timings = [_server_timing(name, seconds, '{} calls'.format(count) if count > 1 else None)
+                   for name, (seconds, count) in profile.stages.items()]
+        timings.append(_server_timing('db', queries.seconds, '{} queries'.format(queries.count)))
+        timings.append(_server_timing('total', total))
+        response['Server-Timing'] = ', '.join(timings)
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'totalMs': round(total * 1000, 1),
+            'queries': queries.count,
+            'queryMs': round(queries.seconds * 1000, 1),
+            'stages': {name: {'ms': round(seconds * 1000, 1), 'calls': count}
+                       for name, (seconds, count) in profile.stages.items()},
+        }))
+        return response
+
+
+class MetricsMiddleware():
+    '''
+    Count requests and observe their latency per view in the metrics
+    registry, then write this worker's metrics for the metrics endpoint.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        seconds = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.func.__name__) if match is not None else 'unmatched'
+        metrics.inc('chantlab_requests_total', view=view, method=request.method, status=response.status_code)
+        metrics.observe('chantlab_request_seconds', seconds, view=view)
+        try:
+            metrics.flush(settings.METRICS_DIR, settings.METRICS_FLUSH_SECONDS)
+        except OSError as e:
+            logging.warning('Cannot write metrics: {}'.format(e))
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.7 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0006_cantuscorpus_v1_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComputeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('client', models.CharField(max_length=255)),
+                ('state', models.CharField(default='queued', max_length=16)),
+                ('cost', models.BigIntegerField(default=0)),
+                ('hostname', models.CharField(max_length=255)),
+                ('pid', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'compute_job',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='computejob',
+            index=models.Index(fields=['kind', 'state'], name='compute_job_kind_a1f458_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.7 on 2026-10-19 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0007_compute_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComputeRuntime',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('mode', models.CharField(blank=True, default='', max_length=32)),
+                ('sequences', models.IntegerField()),
+                ('mean_length', models.FloatField()),
+                ('concatenated', models.BooleanField(default=False)),
+                ('ngen', models.BigIntegerField(blank=True, null=True)),
+                ('seconds', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'compute_runtime',
+            },
+        ),
+        migrations.AddField(
+            model_name='computejob',
+            name='estimated_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='computeruntime',
+            index=models.Index(fields=['kind', 'mode'], name='compute_run_kind_04d798_idx'),
+        ),
+    ]
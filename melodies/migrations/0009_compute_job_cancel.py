@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-19 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0008_compute_runtime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='computejob',
+            name='job_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='computejob',
+            name='pgid',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='computejob',
+            name='temp_paths',
+            field=models.TextField(default='[]'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+import logging
+
+from django.db import DatabaseError, migrations, transaction
+
+# incipit__icontains filters on UPPER(incipit) LIKE UPPER('%...%') in
+# PostgreSQL; a trigram index on the same expression serves them.
+CREATE_INDEX = ('CREATE INDEX IF NOT EXISTS chant_incipit_trgm ON chant '
+                'USING gin (UPPER(incipit) gin_trgm_ops)')
+DROP_INDEX = 'DROP INDEX IF EXISTS chant_incipit_trgm'
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # the index only speeds up searches; servers without the pg_trgm
+    # contrib module (or the right to create it) work without it
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            schema_editor.execute(CREATE_INDEX)
+    except DatabaseError as e:
+        logging.warning('No trigram index on chant.incipit: {}'.format(e))
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0009_compute_job_cancel'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
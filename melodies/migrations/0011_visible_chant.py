@@ -0,0 +1,54 @@
+# Generated by Django 3.1.7 on 2026-10-19 12:08
+
+from django.db import migrations, models
+
+# No database object: SQLite connections get chant_visible as a TEMP view
+# when they are opened (melodies/database.py), since a view in the main
+# schema would break the table rebuilds of later chant migrations, and on
+# PostgreSQL VisibleChant reads the chant table itself.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0010_incipit_trigram_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisibleChant',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('corpus_id', models.TextField(blank=True, null=True)),
+                ('incipit', models.TextField(blank=True, null=True)),
+                ('cantus_id', models.TextField(blank=True, null=True)),
+                ('mode', models.TextField(blank=True, null=True)),
+                ('finalis', models.TextField(blank=True, null=True)),
+                ('differentia', models.TextField(blank=True, null=True)),
+                ('siglum', models.TextField(blank=True, null=True)),
+                ('position', models.TextField(blank=True, null=True)),
+                ('folio', models.TextField(blank=True, null=True)),
+                ('sequence', models.FloatField(blank=True, null=True)),
+                ('marginalia', models.TextField(blank=True, null=True)),
+                ('cao_concordances', models.FloatField(blank=True, null=True)),
+                ('feast_id', models.TextField(blank=True, null=True)),
+                ('genre_id', models.TextField(blank=True, null=True)),
+                ('office_id', models.TextField(blank=True, null=True)),
+                ('srclink', models.TextField(blank=True, null=True)),
+                ('melody_id', models.TextField(blank=True, null=True)),
+                ('chantlink', models.TextField(blank=True, null=True)),
+                ('db', models.TextField(blank=True, null=True)),
+                ('full_text', models.TextField(blank=True, null=True)),
+                ('full_text_manuscript', models.TextField(blank=True, null=True)),
+                ('volpiano', models.TextField(blank=True, null=True)),
+                ('image', models.TextField(blank=True, null=True)),
+                ('dataset_name', models.TextField(blank=True, null=True)),
+                ('dataset_idx', models.IntegerField(blank=True, null=True)),
+                ('century_code', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'chant_visible',
+                'managed': False,
+            },
+        ),
+    ]
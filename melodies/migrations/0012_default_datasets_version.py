@@ -0,0 +1,24 @@
+# Generated by Django 3.1.7 on 2026-10-19 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('melodies', '0011_visible_chant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DefaultDatasetsVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'default_datasets_version',
+            },
+        ),
+    ]
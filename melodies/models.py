@@ -2,7 +2,7 @@ from django.conf import settings
 from django.db import models
 
 
-class Chant(models.Model):
+class ChantFields(models.Model):
     id = models.AutoField(primary_key=True)
     corpus_id = models.TextField(blank=True, null=True)
     incipit = models.TextField(blank=True, null=True)
@@ -30,6 +30,13 @@ class Chant(models.Model):
     dataset_name = models.TextField(blank=True, null=True)
     dataset_idx = models.IntegerField(blank=True, null=True)
     century_code = models.TextField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+
+
+class Chant(ChantFields):
+    '''Chants of the main database: users' datasets, and the default ones unless they are attached.'''
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -43,6 +50,28 @@ class Chant(models.Model):
         db_table = 'chant'
 
 
+class VisibleChant(ChantFields):
+    '''
+    Read-only view of the main chants plus the default datasets of the
+    attached database (melodies/database.py); the same rows as Chant
+    while no default database is attached. PostgreSQL keeps the default
+    datasets in the chant table, so there it reads the table directly;
+    a view would block later column changes of chant.
+    '''
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        related_name='+',
+        blank=True,
+        null=True,
+        db_constraint=False,
+    )
+
+    class Meta:
+        managed = False
+        db_table = 'chant_visible' if settings.DATABASE_ENGINE == 'sqlite' else 'chant'
+
+
 class SavedAlignment(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -69,3 +98,55 @@ class UserSettings(models.Model):
 
     class Meta:
         db_table = 'user_settings'
+
+
+class ComputeJob(models.Model):
+    '''A heavy computation (alignment, MrBayes run) admitted or waiting to run.'''
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    CANCELLED = 'cancelled'
+
+    kind = models.CharField(max_length=32)
+    client = models.CharField(max_length=255)
+    state = models.CharField(max_length=16, default=QUEUED)
+    cost = models.BigIntegerField(default=0)
+    hostname = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    estimated_seconds = models.FloatField(blank=True, null=True)
+    # client-chosen id to cancel the job with
+    job_id = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # process group of the running MAFFT/MrBayes subprocess
+    pgid = models.IntegerField(blank=True, null=True)
+    # JSON list of [path, keep_on_interrupt] pairs
+    temp_paths = models.TextField(default='[]')
+
+    class Meta:
+        db_table = 'compute_job'
+        indexes = [models.Index(fields=['kind', 'state'])]
+
+
+class ComputeRuntime(models.Model):
+    '''Measured duration of a computation, with the features the runtime model uses.'''
+    kind = models.CharField(max_length=32)
+    mode = models.CharField(max_length=32, blank=True, default='')
+    sequences = models.IntegerField()
+    mean_length = models.FloatField()
+    concatenated = models.BooleanField(default=False)
+    ngen = models.BigIntegerField(blank=True, null=True)
+    seconds = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'compute_runtime'
+        indexes = [models.Index(fields=['kind', 'mode'])]
+
+
+class DefaultDatasetsVersion(models.Model):
+    '''Single row counting the changes of the default datasets (see melodies/snapshot.py).'''
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'default_datasets_version'
@@ -0,0 +1,96 @@
+'''Runtime model for heavy computations.
+
+Every admitted computation records its duration with a few features in the
+compute_runtime table. Estimates come from a least-squares fit of
+log(seconds) on the log features of the latest samples of the same kind
+and mode, or from a rough default until enough samples exist.
+'''
+import logging
+import math
+import threading
+import time
+
+from django.db import DatabaseError
+
+from melodies.models import ComputeRuntime
+
+# Samples used for a fit, newest first.
+MAX_SAMPLES = 500
+# Fitted models are reused for this many seconds.
+FIT_TTL_SECONDS = 60
+# Rough seconds per unit of the cost used before any fit is possible.
+DEFAULT_SECONDS_PER_UNIT = {
+    'align': 2e-5,      # per note of the aligned volpianos
+    'mrbayes': 5e-8,    # per generation x taxon x character
+}
+
+_fits = {}
+_fits_lock = threading.Lock()
+
+
+def _design_row(kind, sequences, mean_length, concatenated, ngen):
+    row = [1.0, math.log(max(sequences, 1)), math.log(max(mean_length, 1.0))]
+    if kind == 'mrbayes':
+        row.append(math.log(max(ngen or 1, 1)))
+    else:
+        row.append(1.0 if concatenated else 0.0)
+    return row
+
+
+def record_runtime(kind, seconds, sequences, mean_length, mode='', concatenated=False, ngen=None):
+    try:
+        ComputeRuntime.objects.create(kind=kind, mode=mode or '', sequences=sequences,
+                                      mean_length=mean_length, concatenated=concatenated,
+                                      ngen=ngen, seconds=seconds)
+    except DatabaseError as e:
+        logging.warning('Cannot record {} runtime: {}'.format(kind, e))
+
+
+def _fit(kind, mode):
+    import numpy as np
+
+    samples = list(ComputeRuntime.objects.filter(kind=kind, mode=mode or '')
+                   .order_by('-created_at', '-pk')
+                   .values_list('sequences', 'mean_length', 'concatenated', 'ngen', 'seconds')[:MAX_SAMPLES])
+    if not samples:
+        return None, 0
+    design = np.array([_design_row(kind, *sample[:4]) for sample in samples])
+    target = np.log(np.maximum([sample[4] for sample in samples], 1e-3))
+    if len(samples) < design.shape[1] + 2:
+        return None, len(samples)
+    # minimum-norm solution: a feature that never varied (e.g. no
+    # concatenated samples yet) simply gets no weight
+    coefficients = np.linalg.lstsq(design, target, rcond=None)[0]
+    return coefficients, len(samples)
+
+
+def _cached_fit(kind, mode):
+    key = (kind, mode or '')
+    now = time.monotonic()
+    with _fits_lock:
+        cached = _fits.get(key)
+        if cached is not None and now - cached[0] < FIT_TTL_SECONDS:
+            return cached[1], cached[2]
+    coefficients, samples = _fit(kind, mode)
+    with _fits_lock:
+        _fits[key] = (now, coefficients, samples)
+    return coefficients, samples
+
+
+def estimate_runtime(kind, sequences, mean_length, mode='', concatenated=False, ngen=None):
+    '''Return {'seconds', 'samples', 'fitted'} for a computation with these features.'''
+    coefficients, samples = _cached_fit(kind, mode)
+    if coefficients is None:
+        units = sequences * mean_length * (ngen or 1)
+        seconds = units * DEFAULT_SECONDS_PER_UNIT[kind]
+        fitted = False
+    else:
+        row = _design_row(kind, sequences, mean_length, concatenated, ngen)
+        seconds = math.exp(sum(c * x for c, x in zip(coefficients, row)))
+        fitted = True
+    return {'seconds': round(seconds, 2), 'samples': samples, 'fitted': fitted}
+
+
+def clear_cache():
+    with _fits_lock:
+        _fits.clear()
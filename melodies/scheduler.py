@@ -0,0 +1,251 @@
+'''Admission control for heavy computations (alignments, MrBayes runs).
+
+Every gunicorn worker records the jobs it runs or waits for in the
+compute_job table, so limits hold across workers. A job is admitted when
+its kind is below the global limit, its client below the per-client limit,
+and no fairer job waits: waiting jobs of clients with fewer running jobs go
+first, then the oldest. Durations are recorded for the runtime model, whose
+estimates let requests that could not start in time be turned away at once.
+
+A job also records the process group and temporary files of its MAFFT or
+MrBayes subprocess, so it can be cancelled by the client and cleaned up
+after its worker was killed.
+'''
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from rest_framework import status
+
+from core import processes
+from melodies.models import ComputeJob
+from melodies.runtime_model import estimate_runtime, record_runtime
+
+ALIGN = 'align'
+MRBAYES = 'mrbayes'
+# Retry-After of busy answers when no running job has a runtime estimate
+DEFAULT_RETRY_AFTER = 5
+
+
+class AdmissionError(Exception):
+    '''
+    The computation cannot be admitted; `status` is the HTTP status to
+    answer with and `retry_after` the seconds to send in Retry-After.
+    '''
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+def limits(kind):
+    return settings.COMPUTE_LIMITS[kind]
+
+
+def client_address(request):
+    '''
+    Address of the client. X-Forwarded-For is only believed when the
+    request comes from one of settings.TRUSTED_PROXIES; the client is then
+    the last address in it that is not a trusted proxy itself.
+    '''
+    address = request.META.get('REMOTE_ADDR', '')
+    if address not in settings.TRUSTED_PROXIES:
+        return address
+    forwarded = [item.strip() for item in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if item.strip()]
+    for item in reversed(forwarded):
+        if item not in settings.TRUSTED_PROXIES:
+            return item
+    return forwarded[0] if forwarded else address
+
+
+def client_key(request):
+    '''Per-user key; anonymous users are told apart by address.'''
+    if request.user.is_authenticated:
+        return 'user:{}'.format(request.user.pk)
+    return 'ip:{}'.format(client_address(request))
+
+
+def alignment_cost(volpiano_lengths):
+    '''Estimated cost of an alignment: sequence count x mean length.'''
+    return sum(volpiano_lengths)
+
+
+def mrbayes_cost(taxa, ngen):
+    '''Estimated cost of a MrBayes run: generations x taxa.'''
+    return taxa * ngen
+
+
+def alignment_features(volpiano_lengths, mode, concatenated):
+    '''Runtime model features of an alignment.'''
+    count = len(volpiano_lengths)
+    return {
+        'sequences': count,
+        'mean_length': sum(volpiano_lengths) / count if count else 0.0,
+        'mode': mode,
+        'concatenated': bool(concatenated),
+    }
+
+
+def mrbayes_features(alpianos, ngen):
+    '''Runtime model features of a MrBayes run: taxa, characters and generations.'''
+    return {
+        'sequences': len(alpianos),
+        'mean_length': float(max((len(alpiano) for alpiano in alpianos), default=0)),
+        'ngen': ngen,
+    }
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _stop(job, keep_resumable=False):
+    '''Kill the subprocesses of a job run on this host and remove its temporary files.'''
+    if job.pgid:
+        processes.kill_process_group(job.pgid)
+    processes.remove_temp_paths(json.loads(job.temp_paths or '[]'), keep_resumable=keep_resumable)
+
+
+def reap_dead_jobs():
+    '''
+    Forget jobs of workers on this host that no longer exist, killing the
+    subprocesses they left behind. Resumable MrBayes directories are kept.
+    '''
+    hostname = socket.gethostname()
+    dead = [job for job in ComputeJob.objects.filter(hostname=hostname).only('pk', 'pid', 'pgid', 'temp_paths')
+            if not _process_alive(job.pid)]
+    for job in dead:
+        _stop(job, keep_resumable=True)
+    if dead:
+        ComputeJob.objects.filter(pk__in=[job.pk for job in dead]).delete()
+
+
+def cancel_job(job_id, client):
+    '''
+    Cancel the client's jobs with this id: waiting jobs give up, running
+    ones have their subprocesses killed and temporary files removed.
+    Return the number of jobs cancelled.
+    '''
+    hostname = socket.gethostname()
+    jobs = list(ComputeJob.objects.filter(job_id=job_id, client=client).exclude(state=ComputeJob.CANCELLED))
+    ComputeJob.objects.filter(pk__in=[job.pk for job in jobs]).update(state=ComputeJob.CANCELLED)
+    for job in jobs:
+        if job.hostname == hostname:
+            _stop(job)
+    return len(jobs)
+
+
+def _expected_wait(kind):
+    '''Seconds until the first running job of this kind should finish, if known.'''
+    now = timezone.now()
+    remaining = [job.estimated_seconds - (now - job.started_at).total_seconds()
+                 for job in ComputeJob.objects.filter(kind=kind, state=ComputeJob.RUNNING)
+                 if job.estimated_seconds is not None and job.started_at is not None]
+    return max(min(remaining), 0) if remaining else None
+
+
+def _retry_after(wait):
+    return int(wait) + 1 if wait is not None else DEFAULT_RETRY_AFTER
+
+
+def _try_start(job, kind_limits):
+    with transaction.atomic():
+        # writing first takes the database write lock (SQLite), so the
+        # decision below cannot interleave with another worker's
+        ComputeJob.objects.filter(pk=job.pk).update(pid=job.pid)
+        jobs = list(ComputeJob.objects.select_for_update().filter(kind=job.kind).order_by('created_at', 'pk'))
+        if any(other.pk == job.pk and other.state == ComputeJob.CANCELLED for other in jobs):
+            raise AdmissionError('The computation was cancelled.', status.HTTP_409_CONFLICT)
+        running = [other for other in jobs if other.state == ComputeJob.RUNNING]
+        if len(running) >= kind_limits['global']:
+            return False
+        running_by_client = {}
+        for other in running:
+            running_by_client[other.client] = running_by_client.get(other.client, 0) + 1
+        waiting = [other for other in jobs if other.state == ComputeJob.QUEUED
+                   and running_by_client.get(other.client, 0) < kind_limits['per_client']]
+        if not waiting:
+            return False
+        first = min(waiting, key=lambda other: running_by_client.get(other.client, 0))
+        if first.pk != job.pk:
+            return False
+        ComputeJob.objects.filter(pk=job.pk).update(state=ComputeJob.RUNNING, started_at=timezone.now())
+        return True
+
+
+def _job_listener(job):
+    '''Record the process group and temporary paths of the job's subprocesses.'''
+    temp_paths = []
+
+    def listener(event, value):
+        if event == 'process':
+            if not ComputeJob.objects.filter(pk=job.pk, state=ComputeJob.RUNNING).update(pgid=value):
+                # cancelled before the subprocess started
+                processes.kill_process_group(value)
+        elif event == 'temp_path':
+            temp_paths.append(value)
+            ComputeJob.objects.filter(pk=job.pk).update(temp_paths=json.dumps(temp_paths))
+    return listener
+
+
+@contextmanager
+def admitted(kind, client, cost, features=None, job_id=None):
+    '''
+    Run the body once the computation is admitted. Raises AdmissionError
+    when the cost is over budget, the queue is full or waiting times out.
+    With runtime model `features` the duration is recorded afterwards if
+    the body sets `job.ran`, i.e. the computation really ran (not a cached
+    result or an error). A `job_id` lets the client cancel the computation
+    with cancel_job().
+    '''
+    kind_limits = limits(kind)
+    if kind_limits.get('budget') and cost > kind_limits['budget']:
+        raise AdmissionError(
+            'This request is too large to compute: its estimated cost {} exceeds the limit of {}. '
+            'Please select fewer or shorter chants{}.'.format(
+                cost, kind_limits['budget'], ' or fewer generations' if kind == MRBAYES else ''),
+            status.HTTP_400_BAD_REQUEST)
+
+    reap_dead_jobs()
+    counts = dict(ComputeJob.objects.filter(kind=kind).values_list('state').annotate(count=Count('pk')))
+    if counts.get(ComputeJob.RUNNING, 0) >= kind_limits['global']:
+        wait = _expected_wait(kind)
+        if counts.get(ComputeJob.QUEUED, 0) >= kind_limits['max_queued']:
+            raise AdmissionError('The server is busy, please try again in a moment.',
+                                 status.HTTP_429_TOO_MANY_REQUESTS, _retry_after(wait))
+        if wait is not None and wait > kind_limits['queue_timeout']:
+            raise AdmissionError('The server is busy, please try again in about {} seconds.'.format(int(wait) + 1),
+                                 status.HTTP_429_TOO_MANY_REQUESTS, _retry_after(wait))
+
+    estimated_seconds = estimate_runtime(kind, **features)['seconds'] if features else None
+    job = ComputeJob.objects.create(kind=kind, client=client, cost=cost, estimated_seconds=estimated_seconds,
+                                    job_id=job_id or '', hostname=socket.gethostname(), pid=os.getpid())
+    job.ran = False
+    try:
+        deadline = time.monotonic() + kind_limits['queue_timeout']
+        while not _try_start(job, kind_limits):
+            if time.monotonic() > deadline:
+                raise AdmissionError('The server is busy, please try again in a moment.',
+                                     status.HTTP_429_TOO_MANY_REQUESTS, _retry_after(_expected_wait(kind)))
+            time.sleep(settings.COMPUTE_POLL_SECONDS)
+        started = time.monotonic()
+        with processes.tracked(_job_listener(job)):
+            yield job
+        cancelled = ComputeJob.objects.filter(pk=job.pk, state=ComputeJob.CANCELLED).exists()
+        if features and job.ran and not cancelled:
+            record_runtime(kind, time.monotonic() - started, **features)
+    finally:
+        ComputeJob.objects.filter(pk=job.pk).delete()
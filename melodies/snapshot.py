@@ -0,0 +1,388 @@
+'''Read-only columnar snapshot of the shared default datasets.
+
+Default datasets only change when they are seeded or rebuilt, so their
+hot columns can be written once to a single file and memory-mapped by every
+gunicorn worker. The operating system shares the mapped pages between
+processes, so the corpus is held in memory once instead of once per worker,
+and list/filter/search requests over the default rows run as NumPy
+operations instead of SQLite scans. Rows owned by users are never part of
+the snapshot and keep going to SQL.
+
+Every change of the default rows bumps the DefaultDatasetsVersion row in
+the same transaction (mark_default_datasets_changed). A snapshot records
+the version it was written at and is only served while the database is
+still at that version, so a reseed or sync without a rebuild falls back
+to SQL instead of serving stale rows.
+
+File layout: an 8 byte magic, an 8 byte little-endian header length, a JSON
+header and then the raw arrays, each aligned to 64 bytes. Text columns are
+stored as UTF-8 bytes plus ``n + 1`` int64 offsets and a null mask;
+low-cardinality columns are dictionary encoded as int32 codes.
+'''
+
+import json
+import logging
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F
+
+from melodies.access import default_dataset_filter
+from melodies.models import DefaultDatasetsVersion, VisibleChant
+
+SNAPSHOT_MAGIC = b'CHNTSNP1'
+SNAPSHOT_VERSION = 2
+
+# Columns needed by the chant list and by alignment metadata lookups.
+SNAPSHOT_FIELDS = (
+    'id', 'corpus_id', 'incipit', 'cantus_id', 'mode', 'finalis', 'differentia',
+    'siglum', 'position', 'folio', 'feast_id', 'genre_id', 'office_id',
+    'srclink', 'chantlink', 'full_text', 'volpiano', 'dataset_name', 'dataset_idx',
+)
+_INT_FIELDS = frozenset({'id', 'dataset_idx'})
+_CATEGORY_FIELDS = frozenset({
+    'mode', 'finalis', 'differentia', 'siglum', 'feast_id', 'genre_id',
+    'office_id', 'dataset_name',
+})
+_ALIGNMENT = 64
+_ITERATOR_CHUNK = 10000
+
+_lock = threading.Lock()
+_loaded = {'key': None, 'version': None, 'snapshot': None}
+
+
+def snapshot_path():
+    return settings.DEFAULT_SNAPSHOT_PATH
+
+
+def default_datasets_version():
+    '''The current version of the default datasets, or None when it cannot be read.'''
+    try:
+        version = DefaultDatasetsVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+    except DatabaseError:
+        return None
+    return version or 0
+
+
+def mark_default_datasets_changed():
+    '''Bump the default datasets version; call it in the transaction changing default rows.'''
+    if not DefaultDatasetsVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        DefaultDatasetsVersion.objects.create(pk=1, version=1)
+
+
+def _fold_ascii(data):
+    '''Lower-case ASCII letters only, which is what SQLite LIKE ignores.'''
+    folded = data.copy()
+    upper = (folded >= ord('A')) & (folded <= ord('Z'))
+    folded[upper] += 32
+    return folded
+
+
+def _encode_text(values):
+    import numpy as np
+
+    encoded = [b'' if value is None else value.encode('utf-8') for value in values]
+    lengths = np.fromiter((len(item) for item in encoded), dtype=np.int64, count=len(encoded))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    nulls = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+    return offsets, data, nulls
+
+
+def _encode_category(values):
+    import numpy as np
+
+    categories = sorted({value for value in values if value is not None})
+    index = {value: code for code, value in enumerate(categories)}
+    codes = np.fromiter(
+        (-1 if value is None else index[value] for value in values),
+        dtype=np.int32,
+        count=len(values),
+    )
+    return codes, categories
+
+
+def _incipit_order(incipits, ids):
+    '''Row order of the chant list query (views.CHANT_LIST_ORDER): NULLs first, then binary.'''
+    import numpy as np
+
+    order = sorted(
+        range(len(incipits)),
+        key=lambda row: (incipits[row] is not None, incipits[row] or '', ids[row]),
+    )
+    return np.asarray(order, dtype=np.int64)
+
+
+def write_snapshot(path=None):
+    '''Write the default datasets to ``path`` and return the number of rows.
+
+    The file is written next to the target and renamed into place, so
+    workers that still map the previous snapshot keep a consistent view.
+    '''
+    import numpy as np
+
+    path = path or snapshot_path()
+    # read before the rows: a change in between leaves the file stale, not wrong
+    defaults_version = default_datasets_version()
+    columns = {name: [] for name in SNAPSHOT_FIELDS}
+    queryset = VisibleChant.objects.filter(default_dataset_filter()).order_by('id')
+    for row in queryset.values_list(*SNAPSHOT_FIELDS).iterator(chunk_size=_ITERATOR_CHUNK):
+        for name, value in zip(SNAPSHOT_FIELDS, row):
+            columns[name].append(value)
+    row_count = len(columns['id'])
+
+    arrays = {}
+    categories = {}
+    for name in SNAPSHOT_FIELDS:
+        values = columns[name]
+        if name in _INT_FIELDS:
+            arrays[name + '.nulls'] = np.fromiter(
+                (value is None for value in values), dtype=bool, count=row_count)
+            arrays[name] = np.fromiter(
+                (-1 if value is None else value for value in values),
+                dtype=np.int64, count=row_count)
+        elif name in _CATEGORY_FIELDS:
+            arrays[name], categories[name] = _encode_category(values)
+        else:
+            offsets, data, nulls = _encode_text(values)
+            arrays[name + '.offsets'] = offsets
+            arrays[name + '.data'] = data
+            arrays[name + '.nulls'] = nulls
+    arrays['incipit.folded'] = _fold_ascii(arrays['incipit.data'])
+    arrays['incipit.order'] = _incipit_order(columns['incipit'], columns['id'])
+
+    layout = {}
+    position = 0
+    for name, array in arrays.items():
+        layout[name] = {
+            'offset': position,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+        }
+        position += array.nbytes
+        position += -position % _ALIGNMENT
+
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'rows': row_count,
+        'defaults_version': defaults_version,
+        'categories': categories,
+        'arrays': layout,
+    }).encode('utf-8')
+    data_start = len(SNAPSHOT_MAGIC) + 8 + len(header)
+    data_start += -data_start % _ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_MAGIC)
+        snapshot_file.write(len(header).to_bytes(8, 'little'))
+        snapshot_file.write(header)
+        for name, array in arrays.items():
+            snapshot_file.seek(data_start + layout[name]['offset'])
+            snapshot_file.write(array.tobytes())
+        snapshot_file.truncate(data_start + position)
+    os.replace(temp_path, path)
+    return row_count
+
+
+class ChantSnapshot():
+    '''
+    The ChantSnapshot class answers list, filter and lookup queries over a
+    memory-mapped snapshot of the default datasets
+    '''
+
+    def __init__(self, path):
+        import numpy as np
+
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError('{} is not a chant snapshot'.format(path))
+            header_length = int.from_bytes(snapshot_file.read(8), 'little')
+            header = json.loads(snapshot_file.read(header_length).decode('utf-8'))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {}'.format(header.get('version')))
+
+        data_start = len(SNAPSHOT_MAGIC) + 8 + header_length
+        data_start += -data_start % _ALIGNMENT
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+        self.path = path
+        self.rows = header['rows']
+        self.defaults_version = header.get('defaults_version')
+        self._categories = header['categories']
+        self._category_index = {
+            name: {value: code for code, value in enumerate(values)}
+            for name, values in self._categories.items()
+        }
+        self._arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = 1
+            for size in spec['shape']:
+                count *= size
+            start = data_start + spec['offset']
+            self._arrays[name] = np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=start
+            ).reshape(spec['shape'])
+        self._views = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _data_view(self, name):
+        view = self._views.get(name)
+        if view is None:
+            view = memoryview(self._arrays[name + '.data'])
+            self._views[name] = view
+        return view
+
+    def rows_for_ids(self, ids):
+        '''Return snapshot row indices for ``ids``; -1 where an id is absent.'''
+        import numpy as np
+
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.rows == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        id_column = self._arrays['id']
+        rows = np.minimum(np.searchsorted(id_column, ids), self.rows - 1)
+        return np.where(id_column[rows] == ids, rows, -1)
+
+    def values(self, name, rows):
+        '''Decode column ``name`` for the given row indices.'''
+        import numpy as np
+
+        rows = np.asarray(rows, dtype=np.int64)
+        if name in _INT_FIELDS:
+            values = self._arrays[name][rows].tolist()
+            nulls = self._arrays[name + '.nulls'][rows].tolist()
+            return [None if null else value for value, null in zip(values, nulls)]
+        if name in _CATEGORY_FIELDS:
+            categories = self._categories[name]
+            return [None if code < 0 else categories[code]
+                    for code in self._arrays[name][rows].tolist()]
+
+        offsets = self._arrays[name + '.offsets']
+        starts = offsets[rows].tolist()
+        ends = offsets[rows + 1].tolist()
+        nulls = self._arrays[name + '.nulls'][rows].tolist()
+        data = self._data_view(name)
+        return [
+            None if null else str(data[start:end], 'utf-8')
+            for start, end, null in zip(starts, ends, nulls)
+        ]
+
+    def records(self, rows, fields):
+        '''Return one dict per row, like ``QuerySet.values(*fields)``.'''
+        columns = [self.values(name, rows) for name in fields]
+        return [dict(zip(fields, values)) for values in zip(*columns)]
+
+    def _category_mask(self, name, wanted):
+        import numpy as np
+
+        index = self._category_index[name]
+        codes = [index[str(value)] for value in wanted
+                 if value is not None and str(value) in index]
+        return np.isin(self._arrays[name], np.asarray(codes, dtype=np.int32))
+
+    def _lengths(self, name):
+        offsets = self._arrays[name + '.offsets']
+        return offsets[1:] - offsets[:-1]
+
+    def _contains_mask(self, needle):
+        '''Case-insensitive (ASCII only) substring match on the incipit.'''
+        import numpy as np
+
+        mask = np.zeros(self.rows, dtype=bool)
+        pattern = bytes(_fold_ascii(np.frombuffer(needle.encode('utf-8'), dtype=np.uint8)))
+        if not pattern:
+            return ~self._arrays['incipit.nulls']
+        offsets = self._arrays['incipit.offsets']
+        folded = memoryview(self._arrays['incipit.folded'])
+        lookahead = re.compile(b'(?=' + re.escape(pattern) + b')')
+        starts = np.fromiter(
+            (match.start() for match in lookahead.finditer(folded)), dtype=np.int64)
+        if len(starts):
+            rows = np.searchsorted(offsets, starts, side='right') - 1
+            inside = starts + len(pattern) <= offsets[rows + 1]
+            mask[rows[inside]] = True
+        return mask
+
+    def filter_rows(self, data_sources=None, genres=None, offices=None, fontes=None,
+                    incipit=None, hide_incomplete=False, hide_without_volpiano=False):
+        '''Return row indices matching the chant list filters, ordered by incipit.'''
+        import numpy as np
+
+        mask = np.ones(self.rows, dtype=bool)
+        if data_sources:
+            wanted = np.asarray([int(item) for item in data_sources], dtype=np.int64)
+            mask &= np.isin(self._arrays['dataset_idx'], wanted) & ~self._arrays['dataset_idx.nulls']
+        if genres:
+            mask &= self._category_mask('genre_id', genres)
+        if offices:
+            mask &= self._category_mask('office_id', offices)
+        if fontes:
+            mask &= self._category_mask('siglum', fontes)
+        if incipit:
+            mask &= self._contains_mask(incipit)
+        if hide_incomplete:
+            non_empty = self._lengths('incipit') > 0
+            last_bytes = self._arrays['incipit.offsets'][1:][non_empty] - 1
+            incomplete = np.zeros(self.rows, dtype=bool)
+            incomplete[non_empty] = self._arrays['incipit.data'][last_bytes] == ord('*')
+            mask &= ~incomplete
+        if hide_without_volpiano:
+            mask &= self._lengths('volpiano') > 0
+
+        order = self._arrays['incipit.order']
+        return order[mask[order]]
+
+    def distinct(self, name, rows):
+        '''Distinct non-empty values of a dictionary-encoded column.'''
+        import numpy as np
+
+        codes = np.unique(self._arrays[name][rows])
+        categories = self._categories[name]
+        return [categories[code] for code in codes.tolist() if code >= 0 and categories[code]]
+
+
+def get_snapshot():
+    '''Return the current worker's snapshot, or None to fall back to SQL.
+
+    The file is re-mapped when it is replaced on disk. Every call reads the
+    default datasets version (one primary key lookup); a snapshot written
+    at another version is ignored until it is rebuilt.
+    '''
+    path = snapshot_path()
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    version = default_datasets_version()
+    if version is None:
+        return None
+    if _loaded['key'] == key and _loaded['version'] == version:
+        return _loaded['snapshot']
+
+    with _lock:
+        if _loaded['key'] != key or _loaded['version'] != version:
+            snapshot = None
+            try:
+                snapshot = ChantSnapshot(path)
+                if snapshot.defaults_version != version:
+                    logging.warning('Ignoring stale default dataset snapshot %s', path)
+                    snapshot = None
+            except (OSError, ValueError) as exc:
+                logging.error('Cannot load default dataset snapshot %s: %s', path, exc)
+            _loaded['snapshot'] = snapshot
+            _loaded['key'] = key
+            _loaded['version'] = version
+    return _loaded['snapshot']
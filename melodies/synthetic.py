@@ -0,0 +1,159 @@
+'''Synthetic chants for benchmarks and scale tests.
+
+Melodies are random walks in the G-clef range, one neume per syllable of a
+text drawn from common liturgical words, so melody and text always have the
+same words and syllables. Generation is deterministic for a given seed.
+
+Whole corpora (synthetic_chant_rows) follow the shape of the Cantus data:
+chants of one Cantus ID share their text and vary one melody, and Cantus
+IDs and sources are Zipf-distributed, so a few are very common.
+'''
+import itertools
+import random
+from functools import lru_cache
+
+from core.chant_processor import ChantProcessor
+
+WORDS = (
+    'alleluia', 'dominus', 'deus', 'domine', 'gloria', 'patri', 'filio', 'spiritui', 'sancto',
+    'sicut', 'erat', 'in', 'principio', 'et', 'nunc', 'semper', 'saecula', 'saeculorum', 'amen',
+    'ave', 'maria', 'gratia', 'plena', 'tecum', 'benedicta', 'tu', 'mulieribus', 'virgo',
+    'mater', 'christi', 'lux', 'mundi', 'rex', 'gloriae', 'caeli', 'terra', 'laudate', 'eum',
+    'omnes', 'gentes', 'exsultate', 'jubilate', 'sanctus', 'sancta', 'misericordia', 'tua',
+    'veni', 'creator', 'spiritus', 'mentes', 'tuorum', 'visita', 'imple', 'superna', 'quae',
+    'creasti', 'pectora', 'ecce', 'ancilla', 'fiat', 'mihi', 'secundum', 'verbum', 'tuum',
+    'hodie', 'natus', 'est', 'nobis', 'salvator', 'qui', 'venit', 'nomine', 'populum', 'suum',
+    'angelus', 'annuntiavit', 'pastoribus', 'gaudium', 'magnum', 'pax', 'hominibus', 'bonae',
+    'voluntatis', 'apostoli', 'martyres', 'confessores', 'beati', 'pauperes', 'regnum',
+)
+
+# Notes of the G-clef range the melodies move in, low to high.
+PITCHES = 'defghjklm'
+# Probabilities of neumes of 1..4 notes per syllable.
+NEUME_SIZES = (1, 2, 3, 4)
+NEUME_WEIGHTS = (0.55, 0.25, 0.13, 0.07)
+LIQUESCENT_RATE = 0.03
+FLAT_RATE = 0.2
+# Share of notes changed in the melody variants of one Cantus ID.
+VARIANT_RATE = 0.1
+
+# Genre and office shares, roughly as in the Cantus database.
+GENRES = (('genre_a', 0.50), ('genre_r', 0.22), ('genre_v', 0.14), ('genre_w', 0.05),
+          ('genre_h', 0.03), ('genre_in', 0.02), ('genre_i', 0.02), ('genre_tp', 0.02))
+OFFICES = (('office_m', 0.35), ('office_l', 0.20), ('office_v', 0.18), ('office_v2', 0.07),
+           ('office_mi', 0.06), ('office_p', 0.04), ('office_t', 0.03), ('office_s', 0.03),
+           ('office_n', 0.02), ('office_c', 0.02))
+COUNTRIES = ('A', 'CH', 'CZ', 'D', 'E', 'F', 'GB', 'I', 'NL', 'PL', 'SK')
+CITIES = ('Gu', 'KN', 'Wn', 'E', 'SGs', 'Pu', 'Pak', 'KA', 'Mbs', 'Tc', 'Pn', 'AS', 'Lbl', 'Rvat', 'BAu')
+CHANTS_PER_SOURCE = 400
+CHANTS_PER_CANTUS_ID = 20
+
+
+@lru_cache(maxsize=None)
+def syllable_count(word):
+    return len(ChantProcessor.get_syllables_from_text(word)[0])
+
+
+def synthetic_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def synthetic_volpiano(rng, text):
+    '''A volpiano with one neume per syllable of `text`.'''
+    position = rng.randrange(len(PITCHES))
+    volpiano_words = []
+    for word in text.split():
+        syllables = []
+        for _ in range(syllable_count(word)):
+            neume = ''
+            for _ in range(rng.choices(NEUME_SIZES, NEUME_WEIGHTS)[0]):
+                position = min(max(position + rng.choice((-2, -1, -1, 0, 1, 1, 2)), 0), len(PITCHES) - 1)
+                note = PITCHES[position]
+                if note == 'j' and rng.random() < FLAT_RATE:
+                    neume += 'i'
+                neume += note
+            if rng.random() < LIQUESCENT_RATE:
+                neume = neume[:-1] + neume[-1].upper()
+            syllables.append(neume)
+        volpiano_words.append('--'.join(syllables))
+    return '1---' + '---'.join(volpiano_words) + '---4'
+
+
+def synthetic_melodies(count, seed=0, min_words=6, max_words=30):
+    '''(full_text, volpiano) pairs of `count` synthetic chants.'''
+    rng = random.Random(seed)
+    melodies = []
+    for _ in range(count):
+        text = synthetic_text(rng, rng.randint(min_words, max_words))
+        melodies.append((text, synthetic_volpiano(rng, text)))
+    return melodies
+
+
+def _zipf_cumulative(size, exponent=1.1):
+    return list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(size)))
+
+
+def _variant(rng, volpiano):
+    '''The melody with some notes moved by a step; separators and flats stay.'''
+    notes = []
+    for char in volpiano:
+        if char in PITCHES and rng.random() < VARIANT_RATE:
+            position = min(max(PITCHES.index(char) + rng.choice((-1, 1)), 0), len(PITCHES) - 1)
+            char = PITCHES[position]
+        notes.append(char)
+    return ''.join(notes)
+
+
+def _siglum(rng):
+    return '{}-{} {}'.format(rng.choice(COUNTRIES), rng.choice(CITIES), rng.randint(1, 2000))
+
+
+def synthetic_chant_rows(count, seed=0, sources=None, cantus_ids=None):
+    '''
+    Yield `count` chant rows (dicts of v0.2 CSV columns) of a synthetic
+    corpus with `sources` sigla and `cantus_ids` Cantus IDs.
+    '''
+    rng = random.Random(seed)
+    sources = sources or max(count // CHANTS_PER_SOURCE, 1)
+    cantus_ids = cantus_ids or max(count // CHANTS_PER_CANTUS_ID, 1)
+    sigla = set()
+    while len(sigla) < sources:
+        sigla.add(_siglum(rng))
+    sigla = sorted(sigla)
+    rng.shuffle(sigla)
+    source_weights = _zipf_cumulative(sources)
+    cantus_weights = _zipf_cumulative(cantus_ids)
+    genres, genre_weights = zip(*GENRES)
+    offices, office_weights = zip(*OFFICES)
+
+    # text, melody, genre, office and mode of every Cantus ID, created on first use
+    originals = {}
+    folios = {}
+    for _ in range(count):
+        cantus_index = rng.choices(range(cantus_ids), cum_weights=cantus_weights)[0]
+        original = originals.get(cantus_index)
+        if original is None:
+            original_rng = random.Random('{}-{}'.format(seed, cantus_index))
+            text = synthetic_text(original_rng, original_rng.randint(6, 30))
+            original = originals[cantus_index] = (
+                text, synthetic_volpiano(original_rng, text),
+                original_rng.choices(genres, genre_weights)[0],
+                original_rng.choices(offices, office_weights)[0],
+                str(original_rng.randint(1, 8)),
+            )
+        text, volpiano, genre, office, mode = original
+        siglum = sigla[rng.choices(range(sources), cum_weights=source_weights)[0]]
+        folio = folios[siglum] = folios.get(siglum, 0) + (rng.random() < 0.3)
+        yield {
+            'incipit': ' '.join(text.split()[:4]),
+            'cantus_id': '{:06d}'.format(cantus_index + 1),
+            'mode': mode,
+            'siglum': siglum,
+            'position': str(rng.randint(1, 12)),
+            'folio': '{:03d}{}'.format(folio // 2 + 1, 'rv'[folio % 2]),
+            'feast_id': 'feast_{:04d}'.format(cantus_index % 500 + 1),
+            'genre_id': genre,
+            'office_id': office,
+            'full_text': text,
+            'volpiano': _variant(rng, volpiano),
+        }
@@ -1,18 +1,67 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
 from io import StringIO
+from unittest import mock, skipUnless
 
 import pandas as pd
-from django.contrib.auth.models import User
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+from backend import settings as default_settings
+from rest_framework.authtoken.models import Token
+
+from core.aligner import Aligner
+from core.alignment_analysis import AlignmentAnalyzer
 from core.cantus_schema import (
     V1_EXPORT_FIELDS,
     chant_to_v1_row,
     normalize_chant_dataframe,
     safe_link,
 )
+from core.distances import DistanceCalculator
+from core.interval_processor import IntervalProcessor
 from core.exporter import Exporter
+from core import metrics
+from core import mrbayes
+from core import processes
+from core import profiling
+from core.mafft import MAFFT_STRATEGIES, Mafft, select_strategy
+from core.mrbayes import MrBayesVolpiano
+from core.tree_builder import TreeBuilder
 from core.uploader import Uploader
-from melodies.models import Chant
+from melodies.access import DEFAULT_DATASET_NAMES, all_ids_visible, default_dataset_filter, visible_chants
+from melodies.database import (
+    _file_key, attach_default_database, create_visible_view, pragma_statements, reattach_default_database,
+)
+from melodies.management.commands.benchmark_mafft_strategies import sum_of_pairs_score
+from melodies.management.commands.benchmark_pipeline import compare
+from melodies.middleware import profiling_enabled
+from melodies.models import Chant, ComputeJob, ComputeRuntime, SavedAlignment, UserSettings, VisibleChant
+from melodies import runtime_model
+from melodies.scheduler import (
+    DEFAULT_RETRY_AFTER, AdmissionError, _try_start, admitted, client_key, reap_dead_jobs,
+)
+from melodies import synthetic
+from melodies.synthetic import synthetic_melodies
+from melodies.snapshot import ChantSnapshot, get_snapshot, mark_default_datasets_changed, write_snapshot
+from melodies.views import CHANT_LIST_FIELDS, CHANT_LIST_ORDER, _chant_list_filters
 
 
 class CantusSchemaTests(TestCase):
@@ -140,6 +189,50 @@ class UploaderExporterTests(TestCase):
         self.assertNotEqual(chant.dataset_idx, 777)
         self.assertEqual(chant.owner_id, self.user.id)
 
+    def test_sync_changes_only_what_differs_and_keeps_ids(self):
+        def chant(number, volpiano, **fields):
+            return dict({'incipit': 'Chant {}'.format(number), 'volpiano': volpiano,
+                         'chantlink': 'https://example.org/chant/{}'.format(number)}, **fields)
+
+        first = pd.DataFrame([chant(1, '1---g---4'), chant(2, '1---h---4'), chant(3, '1---j---4'),
+                              {'incipit': 'Unlinked', 'volpiano': '1---f---4'}])
+        dataset_idx = Uploader.upload_dataframe(first, 'netvor-0.3')
+        ids = dict(Chant.objects.values_list('incipit', 'id'))
+
+        second = pd.DataFrame([chant(1, '1---g---4'), chant(3, '1---k---4'), chant(4, '1---l---4'),
+                               {'incipit': 'Unlinked', 'volpiano': '1---f---4'}])
+        with CaptureQueriesContext(connection) as queries:
+            counts = Uploader.sync_dataframe(second, 'netvor-0.3')
+        self.assertEqual(counts, {'insert': 1, 'update': 1, 'delete': 1, 'unchanged': 2})
+        self.assertFalse(any(query['sql'].startswith('UPDATE') and '"incipit"' in query['sql']
+                             for query in queries.captured_queries))
+        chants = {chant.incipit: chant for chant in Chant.objects.filter(dataset_name='netvor-0.3')}
+        self.assertEqual(sorted(chants), ['Chant 1', 'Chant 3', 'Chant 4', 'Unlinked'])
+        for incipit in ('Chant 1', 'Chant 3', 'Unlinked'):
+            self.assertEqual(chants[incipit].id, ids[incipit])
+        self.assertEqual(chants['Chant 3'].volpiano, '1---k---4')
+        self.assertGreater(chants['Chant 4'].id, max(ids.values()))
+        self.assertEqual({chant.dataset_idx for chant in chants.values()}, {dataset_idx})
+
+        self.assertEqual(Uploader.sync_dataframe(second, 'netvor-0.3'),
+                         {'insert': 0, 'update': 0, 'delete': 0, 'unchanged': 4})
+
+    @override_settings(DEFAULT_DATABASE_PATH='', DEFAULT_SNAPSHOT_PATH='')
+    def test_forced_seed_updates_default_datasets_in_place(self):
+        chants = pd.DataFrame({'incipit': ['Ave', 'Salve'], 'volpiano': ['1---g---4', '1---h---4'],
+                               'chantlink': ['https://example.org/chant/1', 'https://example.org/chant/2']})
+        sources = [('netvor-0.3', 'netvor.csv', lambda: chants)]
+        with mock.patch('melodies.management.commands.seed_default_datasets.default_dataset_sources',
+                        return_value=sources):
+            call_command('seed_default_datasets', stdout=StringIO())
+            ids = list(Chant.objects.order_by('id').values_list('id', flat=True))
+            chants.loc[1, 'volpiano'] = '1---j---4'
+            output = StringIO()
+            call_command('seed_default_datasets', '--force', stdout=output)
+        self.assertIn('1 updated', output.getvalue())
+        self.assertEqual(list(Chant.objects.order_by('id').values_list('id', 'volpiano')),
+                         [(ids[0], '1---g---4'), (ids[1], '1---j---4')])
+
     def test_export_uses_cantuscorpus_v1_header(self):
         chant = Chant.objects.create(
             incipit='Ave Maria',
@@ -180,3 +273,1328 @@ class UploaderExporterTests(TestCase):
         self.assertEqual(row['feast'], 'Abdonis, Sennis')
         self.assertEqual(row['feast_code'], '14073000')
         self.assertEqual(row['chantlink'], 'https://example.org/chant/1')
+
+
+class ImportTimeTests(SimpleTestCase):
+    '''Guard worker start-up against heavy imports creeping back in.
+
+    Runs ``python -X importtime`` in a fresh interpreter so that modules
+    already loaded by the test runner do not hide regressions.
+    '''
+    HEAVY_MODULES = ('chant21', 'music21', 'ete3', 'pandas')
+    IMPORT_BUDGET_MS = float(os.getenv('CHANTLAB_IMPORT_BUDGET_MS', '3000'))
+
+    def _import_times(self, statement):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='backend.settings')
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import django; django.setup(); ' + statement],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+        times = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            parts = line[len('import time:'):].split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            times[parts[2].strip()] = int(parts[1]) / 1000.0
+        return times
+
+    def test_views_do_not_import_heavy_libraries(self):
+        times = self._import_times('import melodies.urls')
+        loaded = [name for name in self.HEAVY_MODULES if name in times]
+        self.assertEqual(loaded, [], 'Imported at start-up: {}'.format(loaded))
+
+    def test_views_import_within_budget(self):
+        times = self._import_times('import melodies.urls')
+        self.assertIn('melodies.urls', times)
+        self.assertLess(times['melodies.urls'], self.IMPORT_BUDGET_MS)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('snapshot', 'snapshot@example.com', 'password')
+        rows = [
+            ('Ave Maria', 'A-Wn 1799', 'genre_a', '1---g---4'),
+            ('ave regina*', 'CH-E 611', 'genre_r', '1---h---4'),
+            ('Ángelus', 'A-Wn 1799', 'genre_a', ''),
+            (None, None, None, None),
+            ('Gaude Maria', 'CH-E 611', 'genre_r', '1---f---4'),
+        ]
+        for index, (incipit, siglum, genre, volpiano) in enumerate(rows):
+            Chant.objects.create(
+                incipit=incipit, siglum=siglum, genre_id=genre, volpiano=volpiano,
+                cantus_id=str(index), dataset_name='netvor-0.3', dataset_idx=0,
+            )
+        Chant.objects.create(incipit='Ave mine', dataset_name='mine', dataset_idx=1, owner=self.user)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'defaults.snapshot')
+        write_snapshot(self.path)
+        self.snapshot = ChantSnapshot(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertMatchesSql(self, **filters):
+        arguments = dict(data_sources=None, genres=None, offices=None, fontes=None,
+                         incipit=None, hide_incomplete=False, hide_without_volpiano=False)
+        arguments.update(filters)
+        expected = list(
+            Chant.objects.filter(default_dataset_filter())
+            .filter(_chant_list_filters(**arguments))
+            .order_by(*CHANT_LIST_ORDER).values(*CHANT_LIST_FIELDS)
+        )
+        rows = self.snapshot.filter_rows(**arguments)
+        self.assertEqual(self.snapshot.records(rows, CHANT_LIST_FIELDS), expected)
+
+    def test_filters_match_sql(self):
+        self.assertMatchesSql()
+        self.assertMatchesSql(data_sources=[0])
+        self.assertMatchesSql(data_sources=[5])
+        self.assertMatchesSql(genres=['genre_a'], fontes=['A-Wn 1799'])
+        self.assertMatchesSql(incipit='AVE')
+        self.assertMatchesSql(incipit='maria')
+        self.assertMatchesSql(incipit='ngel')
+        self.assertMatchesSql(hide_incomplete=True)
+        self.assertMatchesSql(hide_without_volpiano=True)
+
+    def test_rows_for_ids_and_user_rows_are_excluded(self):
+        owned = Chant.objects.get(owner=self.user)
+        default_ids = list(Chant.objects.filter(default_dataset_filter()).values_list('id', flat=True))
+        rows = self.snapshot.rows_for_ids(default_ids + [owned.id]).tolist()
+        self.assertTrue(all(row >= 0 for row in rows[:-1]))
+        self.assertEqual(rows[-1], -1)
+        self.assertEqual(len(self.snapshot), len(default_ids))
+        self.assertEqual(self.snapshot.distinct('siglum', rows[:-1]), ['A-Wn 1799', 'CH-E 611'])
+
+    def test_stale_snapshot_is_ignored(self):
+        with override_settings(DEFAULT_SNAPSHOT_PATH=self.path):
+            self.assertIsNotNone(get_snapshot())
+            owned = Chant.objects.get(owner=self.user)
+            self.assertTrue(all_ids_visible(self.user, [owned.id]))
+            self.assertFalse(all_ids_visible(None, [owned.id]))
+
+            Chant.objects.create(incipit='New', dataset_name='netvor-0.3', dataset_idx=0)
+            mark_default_datasets_changed()
+            self.assertIsNone(get_snapshot())
+            write_snapshot(self.path)
+            self.assertIsNotNone(get_snapshot())
+
+    def test_in_place_sync_invalidates_the_mapped_snapshot(self):
+        with override_settings(DEFAULT_SNAPSHOT_PATH=self.path):
+            self.assertIsNotNone(get_snapshot())
+            for chant in Chant.objects.filter(dataset_name='netvor-0.3'):
+                Chant.objects.filter(pk=chant.pk).update(chantlink='chant/{}'.format(chant.pk))
+            rows = list(Chant.objects.filter(dataset_name='netvor-0.3').order_by('id').values(
+                'incipit', 'siglum', 'genre_id', 'volpiano', 'cantus_id', 'chantlink'))
+            rows[0]['incipit'] = 'Ave Maria gratia plena'
+            counts = Uploader.sync_dataframe(pd.DataFrame(rows), 'netvor-0.3', owner=None, dataset_idx=0)
+            self.assertEqual((counts['insert'], counts['delete']), (0, 0))
+            # same file, same row count and max id, but the rows changed
+            self.assertIsNone(get_snapshot())
+            write_snapshot(self.path)
+            self.assertIsNotNone(get_snapshot())
+
+
+class MafftDuplicateTests(SimpleTestCase):
+    def test_duplicates_are_collapsed_and_expanded(self):
+        mafft = Mafft()
+        unique, duplicates = mafft._collapse(['abc', 'ab', 'abc', 'abc'])
+        self.assertEqual(unique, [0, 1])
+        self.assertEqual(duplicates, {0: [2, 3]})
+
+        mafft._duplicates = duplicates
+        mafft._process = subprocess.CompletedProcess(
+            args='mafft', returncode=0, stdout=b'> 1\nab-\n> 0\nabc\n\n', stderr=b'')
+        self.assertEqual(mafft.get_aligned_sequences(), ['ab-', 'abc', 'abc', 'abc'])
+        self.assertEqual(mafft.get_sequence_order(), [1, 0, 2, 3])
+
+    def test_nothing_is_collapsed_below_two_distinct_sequences(self):
+        self.assertEqual(Mafft()._collapse(['abc', 'abc']), ([0, 1], {}))
+        self.assertEqual(Mafft(collapse_duplicates=False)._collapse(['a', 'a', 'b']), ([0, 1, 2], {}))
+
+    def test_guide_tree_gets_duplicate_leaves(self):
+        with tempfile.TemporaryDirectory() as directory:
+            mafft = Mafft()
+            mafft.set_input(os.path.join(directory, 'input.txt'))
+            with open(mafft._output_guide_tree_file, 'w') as tree_file:
+                tree_file.write('(1__0:0.1,2__1:0.2);\n')
+            mafft._duplicates = {0: [2]}
+            tree = mafft.get_guide_tree(['first', 'second', 'copy'])
+        for name in ('first', 'second', 'copy'):
+            self.assertIn(name, tree)
+
+
+class MafftStrategyTests(SimpleTestCase):
+    def test_strategy_follows_input_size(self):
+        thresholds = ((10, 1000, 'linsi'), (100, 10000, 'fftns2'))
+        self.assertEqual(select_strategy(5, 500, thresholds), 'linsi')
+        self.assertEqual(select_strategy(5, 5000, thresholds), 'fftns2')
+        self.assertEqual(select_strategy(50, 5000, thresholds), 'fftns2')
+        self.assertEqual(select_strategy(500, 5000, thresholds), 'parttree')
+
+    def test_auto_strategy_adds_mafft_options(self):
+        mafft = Mafft()
+        self.assertEqual(mafft._strategy_options(mafft._strategy_for(['abc', 'abd'])), [])
+        mafft.set_strategy('auto')
+        strategy = mafft._strategy_for(['abc', 'abd'])
+        self.assertEqual(mafft._strategy_options(strategy), MAFFT_STRATEGIES[strategy])
+        with self.assertRaises(ValueError):
+            mafft.set_strategy('quickest')
+
+    def test_sum_of_pairs_score(self):
+        matrix = {('a', 'a'): 10, ('a', 'b'): 2, ('b', 'a'): 2, ('b', 'b'): 10}
+        self.assertEqual(sum_of_pairs_score(['ab', 'ab', 'a-'], matrix), 30 + 10)
+        self.assertEqual(sum_of_pairs_score(['a', 'b'], matrix), 2)
+
+
+class ExtendAlignmentViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('extend', 'extend@example.com', 'password')
+        self.chant = Chant.objects.create(
+            incipit='Ave', volpiano='1---g---4', dataset_name='netvor-0.3', dataset_idx=0)
+        self.result = {
+            'chants': [],
+            'success': {'ids': [self.chant.id], 'volpianos': ['g'], 'sources': [], 'urls': []},
+            'alignmentMode': 'full',
+        }
+
+    def test_alignment_without_new_chants_is_returned_unchanged(self):
+        response = self.client.post('/api/chants/align/add/', {
+            'idsToAdd': json.dumps([self.chant.id]),
+            'alignment': json.dumps(self.result),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), self.result)
+
+    def test_syllable_and_concatenated_alignments_are_rejected(self):
+        syllables = dict(self.result, alignmentMode='syllables')
+        concatenated = dict(self.result, success={'ids': [[self.chant.id]], 'volpianos': ['g']})
+        for alignment in (syllables, concatenated):
+            response = self.client.post('/api/chants/align/add/', {
+                'idsToAdd': json.dumps([self.chant.id + 1]),
+                'alignment': json.dumps(alignment),
+            })
+            self.assertEqual(response.status_code, 400)
+
+    def test_saved_alignment_requires_its_owner(self):
+        SavedAlignment.objects.create(user=self.user, name='mine', data=json.dumps({'alignment': self.result}))
+        response = self.client.post('/api/chants/align/add/', {
+            'idsToAdd': json.dumps([self.chant.id]),
+            'alignmentName': 'mine',
+        })
+        self.assertEqual(response.status_code, 403)
+
+
+class MafftInputCleanupTests(TestCase):
+    def setUp(self):
+        self.ids = [Chant.objects.create(incipit=incipit, volpiano=volpiano, dataset_name='netvor-0.3',
+                                         dataset_idx=0).id
+                    for incipit, volpiano in (('Ave', '1---g---h---4'), ('Salve', '1---g---k---4'))]
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+
+    def test_failed_mafft_runs_leave_no_inputs(self):
+        def missing_mafft(command, **kwargs):
+            return subprocess.CompletedProcess(command, 127, '', 'mafft: not found')
+
+        with override_settings(TEMP_DIR=self.temp_dir), mock.patch('core.mafft.processes.run', missing_mafft):
+            for align in (Aligner.alignment_pitches, Aligner.alignment_intervals):
+                for concatenated in (False, True):
+                    try:
+                        align(self.ids, concatenated=concatenated)
+                    except (RuntimeError, IndexError, ValueError):
+                        pass
+            response = Aligner.extend_alignment(self.ids[:1], ['g-h'], self.ids[1:], 'full')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_extended_alignment_has_no_guide_tree(self):
+        commands = []
+
+        def mafft_add(command, **kwargs):
+            commands.append(command)
+            return subprocess.CompletedProcess(command, 0, b'> 0\ng-h\n> 1\ng-k\n', b'')
+
+        with override_settings(TEMP_DIR=self.temp_dir), mock.patch('core.mafft.processes.run', mafft_add):
+            for mode in ('full', 'intervals'):
+                result = Aligner.extend_alignment(self.ids[:1], ['g-h'], self.ids[1:], mode)
+                self.assertIsNone(result['guideTree'])
+                self.assertEqual(result['success']['ids'], self.ids)
+                self.assertEqual(result['success']['volpianos'], ['g-h', 'g-k'])
+                self.assertEqual(len(result['chants']), 2)
+        self.assertTrue(all('--add' in command and '--treeout' not in command for command in commands))
+
+
+class TreeBuilderTests(SimpleTestCase):
+    # additive distances of the classic neighbor-joining example
+    DISTANCES = [
+        [0, 5, 9, 9, 8],
+        [5, 0, 10, 10, 9],
+        [9, 10, 0, 8, 7],
+        [9, 10, 8, 0, 3],
+        [8, 9, 7, 3, 0],
+    ]
+
+    def test_p_distance_ignores_gaps_and_boundaries(self):
+        matrix = DistanceCalculator.encode_alignment(['gh-j', 'gk|j', '----'])
+        distances = DistanceCalculator.p_distance(matrix)
+        self.assertAlmostEqual(distances[0, 1], 1 / 3)
+        self.assertEqual(distances[0, 2], 1.0)
+        self.assertEqual(distances[1, 1], 0.0)
+        with self.assertRaises(ValueError):
+            DistanceCalculator.encode_alignment(['gh', 'g'])
+
+    def test_neighbor_joining_recovers_additive_tree(self):
+        newick = TreeBuilder.neighbor_joining(self.DISTANCES, list('abcde'))
+        self.assertIn('(a:2.000000,b:3.000000)', newick)
+        self.assertIn('d:2.000000,e:1.000000,', newick)
+        self.assertTrue(newick.endswith(');'))
+
+    def test_upgma_joins_closest_pair_first(self):
+        newick = TreeBuilder.upgma(self.DISTANCES, list('abcde'))
+        self.assertIn('(d:1.500000,e:1.500000)', newick)
+        self.assertIn('(a:2.500000,b:2.500000)', newick)
+
+    def test_labels_are_newick_safe(self):
+        newick, labels = TreeBuilder.build(['gh', 'gj'], ['Ave maria (A)', 'x:y'], 'upgma')
+        self.assertEqual(labels, ['Ave_maria__A_', 'x_y'])
+        self.assertEqual(newick, '(Ave_maria__A_:0.250000,x_y:0.250000);')
+
+    def test_labels_colliding_once_sanitized_are_made_unique(self):
+        newick, labels = TreeBuilder.build(['gh', 'gj', 'gk', 'gl'], ['a b', 'a_b', 'a:b', 'a_b_0'], 'upgma')
+        self.assertEqual(labels, ['a_b', 'a_b_0', 'a_b_1', 'a_b_0_0'])
+        for label in labels:
+            self.assertEqual(len(re.findall(r'[(,]{}:'.format(label), newick)), 1)
+
+
+class ChantTreeViewTests(TestCase):
+    def setUp(self):
+        self.chants = [
+            Chant.objects.create(incipit='Ave', siglum='A-Gu', volpiano='1---g---4',
+                                 dataset_name='netvor-0.3', dataset_idx=i)
+            for i in range(3)
+        ]
+        self.ids = [chant.id for chant in self.chants]
+
+    def test_tree_uses_chant_newick_names(self):
+        response = self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(self.ids),
+            'alpianos': json.dumps(['ghj', 'ghk', 'gkk']),
+            'method': 'nj',
+        })
+        self.assertEqual(response.status_code, 200)
+        names = Aligner.get_newick_names(self.ids)
+        labels = [TreeBuilder.newick_label(name) for name in names]
+        self.assertEqual(response.json()['newickNamesDict'], dict(zip(labels, self.ids)))
+        for label in labels:
+            self.assertIn(label, response.json()['newick'])
+
+    def test_names_dict_uses_sanitized_labels(self):
+        response = self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(self.ids),
+            'alpianos': json.dumps(['ghj', 'ghk', 'gkk']),
+            'alignment_names': json.dumps(['Ave maria (A)', 'x:y', 'plain']),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['newickNamesDict'],
+                         {'Ave_maria__A_': self.ids[0], 'x_y': self.ids[1], 'plain': self.ids[2]})
+
+    def test_names_colliding_once_sanitized_keep_their_chants(self):
+        response = self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(self.ids),
+            'alpianos': json.dumps(['ghj', 'ghk', 'gkk']),
+            'alignment_names': json.dumps(['a b', 'a_b', 'a(b']),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['newickNamesDict'],
+                         {'a_b': self.ids[0], 'a_b_0': self.ids[1], 'a_b_1': self.ids[2]})
+        for label in response.json()['newickNamesDict']:
+            self.assertIn(label, response.json()['newick'])
+
+    def test_invalid_requests_are_rejected(self):
+        response = self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(self.ids),
+            'alpianos': json.dumps(['ghj', 'ghk', 'gkk']),
+            'method': 'parsimony',
+        })
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(self.ids),
+            'alpianos': json.dumps(['ghj', 'ghk', 'gk']),
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class DistanceTests(TestCase):
+    ALIGNMENT = ['gh-j', 'gk|j', 'g---']
+
+    def test_hamming_counts_gaps_against_notes(self):
+        matrix = DistanceCalculator.encode_alignment(self.ALIGNMENT)
+        self.assertEqual(DistanceCalculator.hamming(matrix).tolist(),
+                         [[0, 1, 2], [1, 0, 2], [2, 2, 0]])
+
+    def test_weighted_distance_uses_score_matrix(self):
+        matrix = DistanceCalculator.encode_alignment(self.ALIGNMENT)
+        costs = DistanceCalculator.cost_table('full')
+        distances = DistanceCalculator.weighted(matrix)
+        self.assertAlmostEqual(distances[0, 1], costs[ord('h'), ord('k')] / 3)
+        self.assertEqual(distances[0, 2], 0.0)
+        self.assertEqual(costs[ord('g'), ord('g')], 0)
+
+    def test_distance_endpoint_returns_cached_matrix(self):
+        chant = Chant.objects.create(incipit='Ave', volpiano='1---g---4',
+                                     dataset_name='netvor-0.3', dataset_idx=0)
+        data = {
+            'ids': json.dumps([chant.id] * 3),
+            'alpianos': json.dumps(self.ALIGNMENT),
+            'metric': 'hamming',
+        }
+        first = self.client.post('/api/chants/distances/', data)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['distances'], [[0, 1, 2], [1, 0, 2], [2, 2, 0]])
+        self.assertEqual(self.client.post('/api/chants/distances/', data).content, first.content)
+        response = self.client.post('/api/chants/distances/', dict(data, metric='levenshtein'))
+        self.assertEqual(response.status_code, 400)
+
+
+class AlignmentAnalysisTests(TestCase):
+    def test_column_statistics(self):
+        statistics = AlignmentAnalyzer.analyze(['gh-j', 'gk-j', 'gk-l', 'gh-l'])
+        self.assertEqual(statistics['consensus'], 'gh-j')
+        self.assertEqual(statistics['entropy'], [0.0, 1.0, 0.0, 1.0])
+        self.assertEqual(statistics['gapFraction'], [0.0, 0.0, 1.0, 0.0])
+        self.assertEqual(statistics['variableSites'], [1, 3])
+        self.assertEqual(statistics['informativeSites'], [1, 3])
+
+    def test_partitions_are_split_on_cantus_id_separator(self):
+        statistics = AlignmentAnalyzer.analyze(['gh#jk', 'gk#jk'], partitions=True,
+                                               partition_names=['001', '002'])
+        self.assertEqual(statistics['consensus'], 'gh#jk')
+        first, second = statistics['partitions']
+        self.assertEqual((first['name'], first['variableSites']), ('001', [1]))
+        self.assertEqual((second['name'], second['start'], second['variableSites']), ('002', 3, []))
+        with self.assertRaises(ValueError):
+            AlignmentAnalyzer.analyze(['gh#jk', 'gk'], partitions=True)
+
+    def test_stats_endpoint_reads_saved_alignment(self):
+        user = User.objects.create_user('stats', 'stats@example.com', 'password')
+        result = {'success': {'ids': [1, 2], 'volpianos': ['gh', 'gk']}, 'alignmentMode': 'full'}
+        SavedAlignment.objects.create(user=user, name='mine', data=json.dumps({'alignment': result}))
+        response = self.client.post('/api/chants/align/stats/', {'alignmentName': 'mine'})
+        self.assertEqual(response.status_code, 403)
+        token = Token.objects.create(user=user)
+        response = self.client.post('/api/chants/align/stats/', {'alignmentName': 'mine'},
+                                    HTTP_AUTHORIZATION='Token ' + token.key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['variableSites'], [1])
+
+    def test_short_partition_names_are_a_bad_request(self):
+        with self.assertRaises(ValueError):
+            AlignmentAnalyzer.analyze(['gh#jk#g', 'gk#jk#g'], partitions=True, partition_names=['001'])
+        result = {'success': {'ids': [[1], [2]], 'volpianos': ['gh#jk', 'gk#jk']}, 'alignmentMode': 'full'}
+        response = self.client.post('/api/chants/align/stats/', {
+            'alignment': json.dumps(result), 'partitions': 'true', 'partitionNames': json.dumps(['001'])})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('partition names', response.json()['message'])
+
+
+@contextmanager
+def fake_mb(temp_dir, script):
+    '''Put an `mb` shell script first on PATH'''
+    bin_dir = os.path.join(temp_dir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    with open(os.path.join(bin_dir, 'mb'), 'w') as mb_file:
+        mb_file.write('#!/bin/sh\n' + script)
+    os.chmod(os.path.join(bin_dir, 'mb'), 0o755)
+    with mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', '')}):
+        yield
+
+
+class MrBayesConvergenceTests(SimpleTestCase):
+    MCMC = (
+        '[ID: 123]\n'
+        'Gen\tSwap(1<>2)\tAvgStdDev(s)\tMaxStdDev(s)\n'
+        '5000\t0.5\t0.041\t0.1\n'
+        '10000\t0.5\t0.008\t0.02\n'
+    )
+
+    def test_stoprule_is_added_to_mcmcp(self):
+        script = MrBayesVolpiano(ngen=1000, stopval=0.01)._generate_mb(partitions=[10])
+        self.assertIn('mcmcp nruns=4 ngen=1000 nchains=8 samplefreq=1000 printfreq=1000 '
+                      'mcmcdiagn=yes diagnfreq=5000 stoprule=yes stopval=0.01 '
+                      'checkpoint=yes checkfreq=10000;', script)
+        self.assertNotIn('stoprule', MrBayesVolpiano(ngen=1000)._generate_mb(partitions=[10]))
+
+    def test_diagnostics_are_read_from_mcmc_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'chantlab.nexus.mcmc')
+            self.assertIsNone(MrBayesVolpiano._read_diagnostics(path))
+            with open(path, 'w') as mcmc_file:
+                mcmc_file.write(self.MCMC)
+            self.assertEqual(MrBayesVolpiano._read_diagnostics(path),
+                             {'generation': 10000, 'asdsf': 0.008})
+
+    def test_wall_clock_budget_stops_the_run(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            script = 'printf "{}" > chantlab.nexus.mcmc\nexec sleep 30\n'.format(
+                self.MCMC.replace('\n', '\\n').replace('\t', '\\t'))
+            with fake_mb(temp_dir, script), mock.patch.object(mrbayes, 'MONITOR_INTERVAL_SECONDS', 0.1):
+                convergence = MrBayesVolpiano(ngen=100000, stopval=0.001, max_seconds=0.5)._run_monitored(temp_dir)
+        self.assertEqual(convergence['stoppedBy'], 'time')
+        self.assertEqual(convergence['generations'], 10000)
+        self.assertFalse(convergence['converged'])
+        self.assertLess(convergence['seconds'], 30)
+
+
+class MrBayesCompactionTests(SimpleTestCase):
+    def test_gap_and_constant_columns_are_removed(self):
+        with mock.patch.object(mrbayes, 'MIN_PARTITION_SITES', 2):
+            melodies, partitions, report = MrBayesVolpiano._compact(
+                {'A': 'gh-jk-g', 'B': 'gk-jl-g', 'C': 'gk-jm-g'}, [3, 5, 7])
+        self.assertEqual(melodies, {'A': 'hk', 'B': 'kl', 'C': 'km'})
+        self.assertEqual(partitions, [2])
+        self.assertEqual((report['nchar'], report['gapSites'], report['invariantSites']), (2, 2, 3))
+
+    def test_large_partitions_are_kept(self):
+        with mock.patch.object(mrbayes, 'MIN_PARTITION_SITES', 1):
+            _, partitions, report = MrBayesVolpiano._compact({'A': 'ghjk', 'B': 'gkjl'}, [2, 4])
+        self.assertEqual(partitions, [1, 2])
+        self.assertEqual(report['partitions'], [{'sites': 1, 'invariantSites': 1}] * 2)
+
+    def test_compacted_matrix_uses_variable_coding(self):
+        mrbayes_run = MrBayesVolpiano(ngen=1000, compact=True)
+        mrbayes_run.compaction = {'invariantSites': 3, 'partitions': [{'sites': 2, 'invariantSites': 3}]}
+        script = mrbayes_run._generate_mb(partitions=[2])
+        self.assertIn('coding=variable rates=gamma', script)
+        self.assertNotIn('invgamma', script)
+        self.assertNotIn('invgamma', script)
+
+
+class MrBayesScriptTests(SimpleTestCase):
+    # output of the string-concatenating generators this replaced
+    NEXUS = ('#NEXUS\nBEGIN DATA;\n\tDIMENSIONS NTAX=2 NCHAR=4;\n\tFORMAT DATATYPE=STANDARD GAP=- MISSING=?;\n'
+             '\tMATRIX\n\nA_1\tgh-j\nB\tgk-j\n;\nend;')
+    MB = (
+        'begin mrbayes;\n[Script documentation carried out using comments]\n\n[log the analysis]\n'
+        'log start filename=chantlab.log;\n[read the matrix chantlab.nexus]\nexecute chantlab.nexus;\n\n'
+        '[close analysis at end]\nset autoclose=yes;\n'
+        '[This command shows the status of all the taxa, according to the documentation]\ntaxastat;\n\n'
+        '[definition of individual partitions per marker come from partitions.txt]\n'
+        'charset albclv=1-3;\ncharset ykbvcpx=4-7;\n\n[definition of the single partition]\n'
+        'partition chants=2:albclv,ykbvcpx;\n\n[specification of substitution models]\nset partition=chants;\n'
+        'lset applyto=(1) coding=all rates=invgamma; [Mkv+I+G, nstates is automatic for the standard datatype]\n\n'
+        '[show the model just specified for each partition]\nshowmodel;\n'
+        '[set up the MCMC, with this setting the analysis will need not less than 16 threads]\n'
+        'mcmcp nruns=4 ngen=1000 nchains=8 samplefreq=1000 printfreq=1000 mcmcdiagn=yes diagnfreq=5000 '
+        'stoprule=yes stopval=0.01 checkpoint=yes checkfreq=10000;\n[run the MCMC]\nmcmc;\n\n'
+        '[summarize the posterior trees]\nsumt nruns=4 relburnin=yes burninfrac=0.50;\nplot;\n\n'
+        '[summarize parameter posteriors]\nsump;\n\nlog stop;\nend;\n'
+    )
+
+    @staticmethod
+    def _legacy_sequence(alpiano):
+        for symbol in '|~14':
+            alpiano = alpiano.replace(symbol, '-')
+        return ''.join(c if c in 'abcdefghjklmnopqrsyYiIzZ)ABCDEFGHJKLMNOPQRS-#' else '-' for c in alpiano)
+
+    def test_nexus_matches_previous_output(self):
+        self.assertEqual(MrBayesVolpiano._generate_nexus({'A_1': 'gh-j', 'B': 'gk-j'}, 2, 4), self.NEXUS)
+
+    def test_job_key_matches_previous_output(self):
+        # stored results stay valid: the key is still the hash of the NEXUS text and the parameters
+        mrbayes_run = MrBayesVolpiano(ngen=1000)
+        parameters = json.dumps([4, 1000, 8, 1000, 1000, None, 5000, 10000, False, [4]])
+        self.assertEqual(
+            mrbayes_run._job_key({'sequences': {'A_1': 'gh-j', 'B': 'gk-j'}, 'ntax': 2, 'nchar': 4}, [4]),
+            hashlib.sha256((self.NEXUS + '\n' + parameters).encode('utf-8')).hexdigest())
+
+    def test_mb_script_matches_previous_output(self):
+        with mock.patch.object(MrBayesVolpiano, '_partition_codes', return_value=['albclv', 'ykbvcpx']):
+            script = MrBayesVolpiano(ngen=1000, stopval=0.01)._generate_mb([3, 7])
+        self.assertEqual(script, self.MB)
+
+    def test_translation_matches_previous_filtering(self):
+        alpiano = '1---g-h~j|k--4#19l)Yiz?é&n-3'
+        self.assertEqual(MrBayesVolpiano._filter_not_supported_symbols(alpiano), self._legacy_sequence(alpiano))
+
+
+class MrBayesJobTests(SimpleTestCase):
+    CON_TRE = ('#NEXUS\nbegin trees;\n'
+               '   tree con_50_majrule = (1[&prob=1]:0.1,2[&prob=1]:0.2);\nend;\n')
+    WRITE_CON_TRE = 'printf "{}" > chantlab.nexus.con.tre\n'.format(CON_TRE.replace('\n', '\\n'))
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        settings_override = override_settings(
+            MRBAYES_TEMP_DIR=os.path.join(self.temp_dir, 'jobs'),
+            MRBAYES_RESULTS_DIR=os.path.join(self.temp_dir, 'jobs', 'results'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _run(self):
+        return MrBayesVolpiano(ngen=1000).run(alignment_names=['A', 'B'], alpianos=['ghj', 'gkj'])
+
+    def _job_dirs(self):
+        return [name for name in os.listdir(os.path.join(self.temp_dir, 'jobs')) if name != 'results']
+
+    def test_identical_runs_reuse_the_stored_result(self):
+        with fake_mb(self.temp_dir, self.WRITE_CON_TRE):
+            newick, _, _, _, error = self._run()
+        self.assertEqual((newick, error), ('(A[&prob=1]:0.1,B[&prob=1]:0.2)', ''))
+        self.assertEqual(self._job_dirs(), [])
+        with fake_mb(self.temp_dir, 'exit 1\n'):
+            self.assertEqual(self._run()[0], newick)
+
+    def test_failed_run_removes_its_job_directory(self):
+        with fake_mb(self.temp_dir, 'echo failed > chantlab.log\n'):
+            newick, _, _, _, error = self._run()
+        self.assertEqual(newick, '')
+        self.assertIn('failed', error)
+        self.assertEqual(self._job_dirs(), [])
+
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        mrbayes_run = MrBayesVolpiano(ngen=1000)
+        matrix = {'sequences': {'A': 'ghj', 'B': 'gkj'}, 'ntax': 2, 'nchar': 3}
+        job_dir = os.path.join(self.temp_dir, 'jobs', mrbayes_run._job_key(matrix, [3]))
+        os.makedirs(job_dir)
+        open(os.path.join(job_dir, 'chantlab.nexus.ckp'), 'w').close()
+        with fake_mb(self.temp_dir, 'grep -q "append=yes" chantlab.mb && ' + self.WRITE_CON_TRE):
+            newick, _, _, mb_script, error = mrbayes_run.run(alignment_names=['A', 'B'], alpianos=['ghj', 'gkj'])
+        self.assertEqual(error, '')
+        self.assertIn('append=yes', mb_script)
+        self.assertTrue(mrbayes_run.convergence['resumed'])
+
+    def test_failed_summary_keeps_the_checkpoint(self):
+        script = ('if [ "$1" = chantlab.sum.mb ]; then echo no trees > chantlab.sum.log; exit 1; fi\n'
+                  'touch chantlab.nexus.ckp\nexec sleep 30\n')
+        mrbayes_run = MrBayesVolpiano(ngen=1000, max_seconds=0.3)
+        with fake_mb(self.temp_dir, script), mock.patch.object(mrbayes, 'MONITOR_INTERVAL_SECONDS', 0.1):
+            newick, _, _, _, error = mrbayes_run.run(alignment_names=['A', 'B'], alpianos=['ghj', 'gkj'])
+        self.assertEqual(newick, '')
+        self.assertIn('no trees', error)
+        job_dirs = self._job_dirs()
+        self.assertEqual(len(job_dirs), 1)
+        job_dir = os.path.join(self.temp_dir, 'jobs', job_dirs[0])
+        self.assertTrue(os.path.exists(os.path.join(job_dir, 'chantlab.nexus.ckp')))
+        self.assertFalse(os.path.exists(os.path.join(job_dir, 'chantlab.lock')))
+
+
+
+class MrBayesRuntimeTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        settings_override = override_settings(
+            MRBAYES_TEMP_DIR=os.path.join(self.temp_dir, 'jobs'),
+            MRBAYES_RESULTS_DIR=os.path.join(self.temp_dir, 'jobs', 'results'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.ids = [Chant.objects.create(incipit='Ave', volpiano='1---g---4', dataset_name='netvor-0.3',
+                                         dataset_idx=0).id for _ in range(2)]
+
+    def _submit(self):
+        return self.client.post('/api/chants/mrbayes-volpiano/', {
+            'ids': json.dumps(self.ids), 'alpianos': json.dumps(['ghj', 'gkj']),
+            'alignment_names': json.dumps(['A', 'B']), 'numberOfGenerations': '1000'})
+
+    def test_cached_resubmission_records_no_runtime(self):
+        with fake_mb(self.temp_dir, MrBayesJobTests.WRITE_CON_TRE):
+            self.assertEqual(self._submit().json()['error'], '')
+        self.assertEqual(ComputeRuntime.objects.filter(kind='mrbayes').count(), 1)
+        with fake_mb(self.temp_dir, 'exit 1\n'):
+            response = self._submit()
+        self.assertEqual(response.json()['error'], '')
+        self.assertEqual(ComputeRuntime.objects.filter(kind='mrbayes').count(), 1)
+
+    def test_failed_run_records_no_runtime(self):
+        with fake_mb(self.temp_dir, 'echo failed > chantlab.log\n'):
+            self.assertIn('failed', self._submit().json()['error'])
+        self.assertFalse(ComputeRuntime.objects.filter(kind='mrbayes').exists())
+
+@override_settings(
+    COMPUTE_LIMITS={'align': {'global': 2, 'per_client': 1, 'max_queued': 1, 'queue_timeout': 0, 'budget': 100}},
+    COMPUTE_POLL_SECONDS=0)
+class AdmissionTests(TestCase):
+    def _job(self, client, state=ComputeJob.RUNNING, pid=None):
+        return ComputeJob.objects.create(kind='align', client=client, state=state,
+                                         hostname=socket.gethostname(), pid=pid or os.getpid())
+
+    def test_over_budget_requests_are_rejected(self):
+        with self.assertRaises(AdmissionError) as raised:
+            with admitted('align', 'user:1', 101):
+                pass
+        self.assertEqual(raised.exception.status, 400)
+        self.assertIn('101', raised.exception.message)
+
+    def test_per_client_and_global_limits(self):
+        self._job('user:1')
+        with self.assertRaises(AdmissionError) as raised:
+            with admitted('align', 'user:1', 10):
+                pass
+        self.assertEqual(raised.exception.status, 429)
+        with admitted('align', 'user:2', 10) as job:
+            self.assertEqual(ComputeJob.objects.get(pk=job.pk).state, ComputeJob.RUNNING)
+            with self.assertRaises(AdmissionError):
+                with admitted('align', 'user:3', 10):
+                    pass
+        self.assertEqual(ComputeJob.objects.count(), 1)
+
+    def test_clients_without_running_jobs_go_first(self):
+        self._job('user:1')
+        self._job('user:1', state=ComputeJob.QUEUED)
+        with admitted('align', 'user:2', 10) as job:
+            self.assertEqual(ComputeJob.objects.get(pk=job.pk).state, ComputeJob.RUNNING)
+
+    def test_jobs_of_dead_workers_are_forgotten(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        self._job('user:1', pid=process.pid)
+        with admitted('align', 'user:1', 10):
+            pass
+
+    def test_alignment_view_reports_budget(self):
+        chant = Chant.objects.create(incipit='Ave', volpiano='1---' + 'g' * 200,
+                                     dataset_name='netvor-0.3', dataset_idx=0)
+        response = self.client.post('/api/chants/align/', {
+            'idsToAlign': json.dumps([chant.id]), 'mode': 'full',
+            'keepLiquescents': 'true', 'concatenated': 'false',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('too large', response.json()['message'])
+
+    def test_expected_wait_turns_requests_away(self):
+        job = self._job('user:1')
+        ComputeJob.objects.filter(pk=job.pk).update(started_at=timezone.now(), estimated_seconds=3600)
+        self._job('user:2')
+        with self.assertRaises(AdmissionError) as raised:
+            with admitted('align', 'user:3', 10):
+                pass
+        self.assertIn('seconds', raised.exception.message)
+
+    def test_busy_answers_carry_retry_after(self):
+        self._job('user:1')
+        self._job('user:2')
+        with self.assertRaises(AdmissionError) as raised:
+            with admitted('align', 'user:3', 10):
+                pass
+        self.assertEqual(raised.exception.retry_after, DEFAULT_RETRY_AFTER)
+
+    def test_forwarded_address_is_only_trusted_from_proxies(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='203.0.113.5', HTTP_X_FORWARDED_FOR='198.51.100.1')
+        request.user = AnonymousUser()
+        self.assertEqual(client_key(request), 'ip:203.0.113.5')
+        with override_settings(TRUSTED_PROXIES=['203.0.113.5', '10.0.0.2']):
+            self.assertEqual(client_key(request), 'ip:198.51.100.1')
+            request.META['HTTP_X_FORWARDED_FOR'] = '192.0.2.9, 198.51.100.1, 10.0.0.2'
+            self.assertEqual(client_key(request), 'ip:198.51.100.1')
+
+    def test_default_limits_leave_a_worker_free(self):
+        # the class overrides COMPUTE_LIMITS; check the shipped defaults
+        held = sum(kind['global'] + kind['max_queued'] for kind in default_settings.COMPUTE_LIMITS.values())
+        self.assertLess(held, 4)
+
+    def test_admitted_runs_are_recorded(self):
+        features = {'sequences': 3, 'mean_length': 20.0, 'mode': 'full', 'concatenated': False}
+        with admitted('align', 'user:1', 10, features) as job:
+            self.assertIsNotNone(ComputeJob.objects.get(pk=job.pk).estimated_seconds)
+            job.ran = True
+        self.assertEqual(ComputeRuntime.objects.filter(kind='align', sequences=3).count(), 1)
+
+    def test_runs_that_computed_nothing_are_not_recorded(self):
+        features = {'sequences': 4, 'mean_length': 20.0, 'mode': 'full', 'concatenated': False}
+        with admitted('align', 'user:1', 10, features):
+            pass
+        self.assertFalse(ComputeRuntime.objects.filter(kind='align', sequences=4).exists())
+
+
+@override_settings(
+    COMPUTE_LIMITS={'align': {'global': 2, 'per_client': 1, 'max_queued': 1, 'queue_timeout': 0, 'budget': 100}},
+    COMPUTE_POLL_SECONDS=0)
+class CancellationTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+
+    def _temp_file(self, name):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as file:
+            file.write('>1\ng\n')
+        return path
+
+    def test_cancel_kills_subprocess_and_removes_temp_files(self):
+        path = self._temp_file('input.txt')
+        with admitted('align', 'ip:127.0.0.1', 10, job_id='job-1') as job:
+            processes.register_temp_path(path)
+            process = processes.popen(['sleep', '60'])
+            self.assertEqual(ComputeJob.objects.get(pk=job.pk).pgid, process.pid)
+
+            self.assertEqual(self.client.post('/api/chants/cancel/', {'jobId': 'other'}).status_code, 404)
+            response = self.client.post('/api/chants/cancel/', {'jobId': 'job-1'})
+            self.assertEqual(response.json(), {'cancelled': True})
+            self.assertIsNotNone(process.wait(timeout=10))
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(ComputeJob.objects.exists())
+
+    def test_cancelled_queued_job_gives_up(self):
+        job = ComputeJob.objects.create(kind='align', client='user:1', state=ComputeJob.CANCELLED,
+                                        job_id='job-2', hostname=socket.gethostname(), pid=os.getpid())
+        with self.assertRaises(AdmissionError) as raised:
+            _try_start(job, settings.COMPUTE_LIMITS['align'])
+        self.assertEqual(raised.exception.status, 409)
+
+    def test_orphans_of_dead_workers_are_killed(self):
+        worker = subprocess.Popen([sys.executable, '-c', ''])
+        worker.wait()
+        orphan = subprocess.Popen(['sleep', '60'], start_new_session=True)
+        path = self._temp_file('input.txt')
+        resumable = os.path.join(self.temp_dir, 'mrbayes-job')
+        os.mkdir(resumable)
+        ComputeJob.objects.create(kind='mrbayes', client='user:1', state=ComputeJob.RUNNING,
+                                  hostname=socket.gethostname(), pid=worker.pid, pgid=orphan.pid,
+                                  temp_paths=json.dumps([[path, False], [resumable, True]]))
+        reap_dead_jobs()
+        self.assertIsNotNone(orphan.wait(timeout=10))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.isdir(resumable))
+        self.assertFalse(ComputeJob.objects.exists())
+
+
+class ProfilingTests(TestCase):
+    def test_stages_are_only_timed_in_a_profile(self):
+        @profiling.staged('work')
+        def work():
+            return 42
+
+        self.assertEqual(work(), 42)
+        with profiling.profiled() as profile:
+            work()
+            with profiling.stage('other'):
+                work()
+        self.assertEqual(profile.stages['work'][1], 2)
+        self.assertEqual(set(profile.stages), {'work', 'other'})
+
+    @override_settings(PROFILING=True)
+    def test_server_timing_header(self):
+        Chant.objects.create(incipit='Ave', volpiano='1---g---4', dataset_name='netvor-0.3', dataset_idx=0)
+        response = self.client.post('/api/chants/', {'dataSources': json.dumps([0])})
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[0-9]+ queries"')
+        self.assertIn('total;dur=', timing)
+
+    def test_flag_file_switches_profiling(self):
+        flag = os.path.join(tempfile.mkdtemp(), 'profiling.enabled')
+        self.addCleanup(shutil.rmtree, os.path.dirname(flag))
+        with override_settings(PROFILING=False, PROFILING_FLAG_FILE=flag):
+            self.assertFalse(profiling_enabled())
+            self.assertNotIn('Server-Timing', self.client.post('/api/chants/', {}))
+            call_command('profiling', 'on', stdout=StringIO())
+            self.assertTrue(profiling_enabled())
+            self.assertIn('Server-Timing', self.client.post('/api/chants/', {}))
+            call_command('profiling', 'off', stdout=StringIO())
+            self.assertFalse(profiling_enabled())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_workers_are_merged(self):
+        with open(os.path.join(self.metrics_dir, 'metrics-other-1.json'), 'w') as file:
+            json.dump({'counters': {'chantlab_subprocess_launches_total|[["program", "mafft"]]': 2},
+                       'histograms': {}}, file)
+        processes.run(['true'], name='mafft')
+        processes.run(['false'], name='mafft')
+        metrics.flush(self.metrics_dir)
+        text = metrics.render(*metrics.collect(self.metrics_dir))
+        self.assertIn('chantlab_subprocess_launches_total{program="mafft"} 4', text)
+        self.assertIn('chantlab_subprocess_failures_total{program="mafft"} 1', text)
+
+    def _write_worker(self, pid, launches, host=None):
+        name = 'metrics-{}-{}.json'.format(host or socket.gethostname(), pid)
+        with open(os.path.join(self.metrics_dir, name), 'w') as file:
+            json.dump({'counters': {'chantlab_subprocess_launches_total|[["program", "mafft"]]': launches},
+                       'histograms': {}}, file)
+        return name
+
+    def test_files_of_dead_workers_are_folded(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        dead = self._write_worker(exited.pid, 2)
+        live = self._write_worker(os.getppid(), 3)
+        other_host = self._write_worker(exited.pid, 5, host='elsewhere')
+        for _ in range(2):
+            text = metrics.render(*metrics.collect(self.metrics_dir))
+            self.assertIn('chantlab_subprocess_launches_total{program="mafft"} 10', text)
+        names = os.listdir(self.metrics_dir)
+        self.assertNotIn(dead, names)
+        self.assertIn(live, names)
+        self.assertIn(other_host, names)
+        self.assertIn('metrics-{}-archive.json'.format(socket.gethostname()), names)
+
+    def test_file_left_under_own_pid_is_folded_before_first_write(self):
+        self._write_worker(os.getpid(), 4)
+        processes.run(['true'], name='mafft')
+        metrics.flush(self.metrics_dir)
+        text = metrics.render(*metrics.collect(self.metrics_dir))
+        self.assertIn('chantlab_subprocess_launches_total{program="mafft"} 5', text)
+
+    def test_metrics_endpoint(self):
+        with override_settings(METRICS_DIR=self.metrics_dir, METRICS_FLUSH_SECONDS=0):
+            self.client.post('/api/chants/', {})
+            response = self.client.get('/api/chants/metrics/')
+            self.assertEqual(response.status_code, 200)
+            text = response.content.decode()
+            self.assertIn('chantlab_requests_total{method="POST",status="200",view="chant_list"} 1', text)
+            self.assertIn('chantlab_request_seconds_bucket{view="chant_list",le="+Inf"} 1', text)
+            self.assertIn('chantlab_compute_jobs{kind="align",state="running"} 0', text)
+            self.assertIn('# TYPE chantlab_temp_dir_bytes gauge', text)
+            with override_settings(METRICS_ALLOWED_ADDRESSES=[]):
+                self.assertEqual(self.client.get('/api/chants/metrics/').status_code, 403)
+
+
+class BenchmarkPipelineTests(TestCase):
+    def test_synthetic_melodies_are_deterministic_and_valid(self):
+        melodies = synthetic_melodies(20, seed=3)
+        self.assertEqual(melodies, synthetic_melodies(20, seed=3))
+        for text, volpiano in melodies:
+            self.assertTrue(volpiano.startswith('1---') and volpiano.endswith('---4'))
+            self.assertEqual(len(volpiano[4:-4].split('---')), len(text.split()))
+
+    def test_baseline_round_trip_and_regressions(self):
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(baseline))
+        arguments = ['--sizes', '5', '--repeats', '1', '--corpora', 'synthetic',
+                     '--benchmarks', 'flats,intervals,alignment_syllables', '--baseline', baseline]
+        call_command('benchmark_pipeline', *arguments, '--save-baseline', stdout=StringIO())
+        with open(baseline) as baseline_file:
+            results = json.load(baseline_file)
+        self.assertEqual(set(results), {'flats/synthetic/5', 'intervals/synthetic/5', 'alignment_syllables/synthetic/5'})
+        self.assertFalse(Chant.objects.exists())
+
+        self.assertEqual(compare({'a': {'seconds': 1.3}}, {'a': {'seconds': 1.0}}, 0.25, 0.01),
+                         [('a', 1.0, 1.3)])
+        self.assertEqual(compare({'a': {'seconds': 0.004}}, {'a': {'seconds': 0.001}}, 0.25, 0.01), [])
+        results['flats/synthetic/5']['seconds'] = -1.0
+        with open(baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file)
+        with self.assertRaises(CommandError):
+            call_command('benchmark_pipeline', *arguments, '--min-seconds', '0', stdout=StringIO())
+
+
+class SyntheticCorpusTests(TestCase):
+    def test_generate_corpus(self):
+        owner = User.objects.create_user('scale', password='pw-scale-1')
+        call_command('generate_synthetic_corpus', '300', '--owner', 'scale', '--batch-size', '120',
+                     stdout=StringIO())
+        chants = Chant.objects.filter(dataset_name='synthetic', owner=owner)
+        self.assertEqual(chants.count(), 300)
+        self.assertEqual(chants.values('dataset_idx').distinct().count(), 1)
+        self.assertTrue(set(chants.values_list('genre_id', flat=True)) <= {genre for genre, _ in synthetic.GENRES})
+        for cantus_id in chants.values_list('cantus_id', flat=True).distinct()[:5]:
+            self.assertEqual(chants.filter(cantus_id=cantus_id).values('full_text').distinct().count(), 1)
+
+        with self.assertRaises(CommandError):
+            call_command('generate_synthetic_corpus', '10', '--owner', 'scale', stdout=StringIO())
+        call_command('generate_synthetic_corpus', '10', '--owner', 'scale', '--replace', stdout=StringIO())
+        self.assertEqual(Chant.objects.filter(dataset_name='synthetic').count(), 10)
+
+
+class RuntimeModelTests(TestCase):
+    def setUp(self):
+        runtime_model.clear_cache()
+        self.addCleanup(runtime_model.clear_cache)
+
+    def test_fit_follows_recorded_runtimes(self):
+        for sequences in (5, 10, 20, 40, 80, 160):
+            for mean_length in (50, 100, 200):
+                runtime_model.record_runtime('align', 1e-4 * sequences * mean_length, sequences,
+                                             mean_length, mode='full')
+        estimate = runtime_model.estimate_runtime('align', 320, 100, mode='full')
+        self.assertTrue(estimate['fitted'])
+        self.assertEqual(estimate['samples'], 18)
+        self.assertAlmostEqual(estimate['seconds'], 3.2, places=1)
+
+    def test_default_estimate_without_samples(self):
+        estimate = runtime_model.estimate_runtime('mrbayes', 10, 100, ngen=1000)
+        self.assertFalse(estimate['fitted'])
+        self.assertEqual(estimate['samples'], 0)
+
+    def test_estimate_endpoint(self):
+        chant = Chant.objects.create(incipit='Ave', volpiano='1---g---4',
+                                     dataset_name='netvor-0.3', dataset_idx=0)
+        response = self.client.post('/api/chants/estimate/', {
+            'kind': 'align', 'idsToAlign': json.dumps([chant.id]), 'mode': 'full'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('seconds', response.json())
+        response = self.client.post('/api/chants/estimate/', {'kind': 'mrbayes'})
+        self.assertEqual(response.status_code, 400)
+
+
+
+_QUOTED = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b')
+_SAVEPOINT = re.compile(r'SAVEPOINT "[^"]*"')
+_LIST = re.compile(r'\((?:\?|NULL)(?:, (?:\?|NULL))*\)')
+_ROWS = re.compile(r'\(\.\.\.\)(?:, \(\.\.\.\))+')
+_UNION_ROWS = re.compile(r'SELECT ((?:\?|NULL)(?:, (?:\?|NULL))*)(?: UNION ALL SELECT \1)+')
+
+
+def _query_shape(sql):
+    '''The SQL with literals and IN/VALUES lists collapsed, so it does not depend on the input size'''
+    sql = _SAVEPOINT.sub('SAVEPOINT ?', sql)
+    sql = _NUMBER.sub('?', _QUOTED.sub('?', sql))
+    sql = _UNION_ROWS.sub(r'SELECT \1', sql)
+    return _ROWS.sub('(...)', _LIST.sub('(...)', sql))
+
+
+def _fake_mafft(command, **kwargs):
+    '''Stand-in for MAFFT: return the input and --add sequences padded to one length'''
+    tokens = command.split()
+    paths = [tokens[i + 1] for i, token in enumerate(tokens) if token in ('--add', '--addfragments')]
+    records = []
+    for path in [tokens[-1]] + paths:
+        with open(path) as file:
+            for line in file.read().splitlines():
+                if line.startswith('>'):
+                    records.append([line, ''])
+                elif records:
+                    records[-1][1] += line
+    length = max(len(sequence) for _, sequence in records)
+    stdout = ''.join('{}\n{}\n'.format(name, sequence.ljust(length, '-')) for name, sequence in records)
+    return subprocess.CompletedProcess(command, 0, stdout.encode(), b'')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite profiles')
+class DatabaseProfileTests(TestCase):
+    def test_pragmas_of_the_profile_are_applied(self):
+        self.assertEqual(pragma_statements({'temp_store': 'memory', 'journal_mode': 'wal'}),
+                         ['PRAGMA journal_mode=wal', 'PRAGMA temp_store=memory'])
+        new_connection = connection.copy()
+        self.addCleanup(new_connection.close)
+        with override_settings(SQLITE_PROFILE='wal'), new_connection.cursor() as cursor:
+            cursor.execute('PRAGMA temp_store')
+            self.assertEqual(cursor.fetchone()[0], 2)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PROFILES['wal']['cache_size'])
+
+    def test_benchmark_compares_profiles(self):
+        output = StringIO()
+        call_command('benchmark_database', '--seconds', '0.2', '--rows', '100', '--readers', '1',
+                     '--batch', '10', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['profile'] + list(settings.SQLITE_PROFILES))
+        with self.assertRaises(CommandError):
+            call_command('benchmark_database', '--profiles', 'fast', stdout=StringIO())
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite default datasets database')
+class DefaultDatabaseTests(TransactionTestCase):
+    '''Committed rows, so that a second connection to the test database sees them.'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'default_datasets.db')
+        settings_override = override_settings(
+            DEFAULT_DATABASE_PATH=self.path,
+            DEFAULT_SNAPSHOT_PATH=os.path.join(self.directory.name, 'missing.snapshot'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('owner')
+        chants = pd.DataFrame({'incipit': ['Ave', 'Salve'], 'volpiano': ['1---g---4', '1---h---4']})
+        self.default_idx = Uploader.upload_dataframe(chants, 'netvor-0.3')
+        self.owned_idx = Uploader.upload_dataframe(chants, 'mine', owner=self.user)
+        self.default_ids = sorted(Chant.objects.filter(dataset_idx=self.default_idx).values_list('id', flat=True))
+        self.owned_ids = sorted(Chant.objects.filter(owner=self.user).values_list('id', flat=True))
+
+    def build(self, *arguments):
+        call_command('build_default_database', *arguments, stdout=StringIO(), stderr=StringIO())
+
+    def attached_connection(self):
+        attached = connection.copy()
+        self.addCleanup(attached.close)
+        attach_default_database(attached, self.path)
+        return attached
+
+    def test_build_moves_default_datasets_out_of_the_main_database(self):
+        self.build('--from-database')
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        self.assertEqual(db.execute('SELECT id, dataset_name, dataset_idx, owner_id FROM chant ORDER BY id').fetchall(),
+                         [(id, 'netvor-0.3', self.default_idx, None) for id in self.default_ids])
+        self.assertEqual(sorted(Chant.objects.values_list('id', flat=True)), self.owned_ids)
+
+        attached = self.attached_connection()
+        sql, params = visible_chants(self.user).order_by('id').values_list('id', 'dataset_name').query.sql_with_params()
+        with attached.cursor() as cursor:
+            cursor.execute(sql, params)
+            self.assertEqual([id for id, _ in cursor.fetchall()], sorted(self.default_ids + self.owned_ids))
+            with self.assertRaisesRegex(DatabaseError, 'readonly'):
+                cursor.execute("UPDATE defaults.chant SET incipit = 'Vale'")
+
+    def test_build_from_seeds_keeps_dataset_indexes_and_reserves_ids(self):
+        chants = pd.DataFrame({'incipit': ['Gaude', 'Laudate', 'Veni'], 'volpiano': ['1---f---4'] * 3})
+        sources = [('netvor-0.3', 'netvor.csv', lambda: chants)]
+        with mock.patch('melodies.management.commands.build_default_database.default_dataset_sources',
+                        return_value=sources):
+            self.build()
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        rows = db.execute('SELECT id, incipit, dataset_idx FROM chant ORDER BY id').fetchall()
+        self.assertEqual([(incipit, idx) for _, incipit, idx in rows],
+                         [('Gaude', self.default_idx), ('Laudate', self.default_idx), ('Veni', self.default_idx)])
+        self.assertGreater(rows[0][0], max(self.default_ids + self.owned_ids))
+        self.assertFalse(Chant.objects.filter(dataset_name='netvor-0.3').exists())
+
+        # later uploads neither reuse the ids nor the dataset indexes of the file
+        Uploader.upload_dataframe(chants, 'mine too', owner=self.user)
+        uploaded = Chant.objects.filter(dataset_name='mine too')
+        self.assertGreater(min(uploaded.values_list('id', flat=True)), rows[-1][0])
+
+    def test_rebuild_from_seeds_keeps_the_ids_of_matching_chants(self):
+        Chant.objects.filter(dataset_idx=self.default_idx).update(chantlink=None)
+        for number, id in enumerate(self.default_ids):
+            Chant.objects.filter(pk=id).update(chantlink='https://example.org/chant/{}'.format(number))
+        self.build('--from-database')
+        # the in-memory test database is not attached automatically
+        attach_default_database(connection, self.path)
+        self.addCleanup(create_visible_view, connection)
+        self.addCleanup(setattr, connection, 'default_database_key', None)
+        self.addCleanup(connection.cursor().execute, 'DETACH DATABASE defaults')
+        chants = pd.DataFrame({'incipit': ['Ave', 'Salve regina', 'Veni'], 'volpiano': ['1---g---4'] * 3,
+                               'chantlink': ['https://example.org/chant/{}'.format(number) for number in (0, 1, 9)]})
+        output = StringIO()
+        with mock.patch('melodies.management.commands.build_default_database.default_dataset_sources',
+                        return_value=[('netvor-0.3', 'netvor.csv', lambda: chants)]):
+            call_command('build_default_database', stdout=output, stderr=StringIO())
+        self.assertIn('netvor-0.3: 1 inserted, 1 updated, 0 deleted, 1 unchanged.', output.getvalue())
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        rows = db.execute('SELECT id, incipit FROM chant ORDER BY id').fetchall()
+        self.assertEqual(rows[:2], [(self.default_ids[0], 'Ave'), (self.default_ids[1], 'Salve regina')])
+        self.assertEqual(rows[2][1], 'Veni')
+        self.assertEqual(db.execute('SELECT DISTINCT dataset_idx FROM chant').fetchall(), [(self.default_idx,)])
+
+    def test_replaced_file_closes_the_connection(self):
+        self.build('--from-database')
+        connection.ensure_connection()
+        self.addCleanup(setattr, connection, 'default_database_key', None)
+        connection.default_database_key = _file_key(self.path)
+        with mock.patch('melodies.database.default_database_path', return_value=self.path), \
+                mock.patch.object(connection, 'close') as close:
+            reattach_default_database(None)
+            close.assert_not_called()
+            replacement = self.path + '.new'
+            shutil.copyfile(self.path, replacement)
+            os.replace(replacement, self.path)
+            reattach_default_database(None)
+            close.assert_called_once_with()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'PostgreSQL only (scripts/test_postgres.py)')
+class PostgresTests(TestCase):
+    def test_copy_insert_keeps_nulls_and_special_characters(self):
+        df = pd.DataFrame([
+            {'incipit': 'Ave\tmaria', 'full_text': 'line\nbreak \\ slash', 'volpiano': None, 'sequence': '1.5'},
+            {'incipit': 'Salve', 'full_text': None, 'volpiano': '1---g---4', 'sequence': None},
+        ])
+        user = User.objects.create_user('copy')
+        index = Uploader.upload_dataframe(df, 'copied', owner=user)
+        chants = list(Chant.objects.filter(dataset_idx=index).order_by('incipit')
+                      .values_list('incipit', 'full_text', 'volpiano', 'sequence', 'owner_id'))
+        self.assertEqual(chants, [('Ave\tmaria', 'line\nbreak \\ slash', None, 1.5, user.id),
+                                  ('Salve', None, '1---g---4', None, user.id)])
+
+    def test_incipit_search_uses_the_trigram_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest('pg_trgm is not installed')
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'chant_incipit_trgm'")
+            self.assertIn('gin_trgm_ops', cursor.fetchone()[0])
+            cursor.execute('SET enable_seqscan = off')
+            sql, params = Chant.objects.filter(incipit__icontains='ave').values('id').query.sql_with_params()
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('chant_incipit_trgm', plan, sql)
+
+
+class QueryCountTests(TestCase):
+    '''
+    Every endpoint of melodies/urls.py must issue the same SQL queries for a
+    small and a large selection of chants; a query run per chant shows up
+    as a query whose count grows with the input. The large selection still
+    fits one bulk insert batch (SQLite binds at most 999 parameters).
+    '''
+    SIZES = (3, 15)
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        settings_override = override_settings(
+            DEFAULT_SNAPSHOT_PATH=os.path.join(self.temp_dir, 'missing.snapshot'),
+            TEMP_DIR=self.temp_dir,
+            MRBAYES_TEMP_DIR=os.path.join(self.temp_dir, 'mrbayes'),
+            MRBAYES_RESULTS_DIR=os.path.join(self.temp_dir, 'mrbayes', 'results'),
+            METRICS_DIR=os.path.join(self.temp_dir, 'metrics'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(runtime_model.clear_cache)
+
+        self.user = User.objects.create_user('queries', 'queries@example.com', 'password')
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token ' + Token.objects.create(user=self.user).key
+        self.fixtures = [self._fixture(i, size) for i, size in enumerate(self.SIZES)]
+        # the first request of the process reaps computations of dead workers
+        self.client.get('/api/chants/auth/me/')
+
+    def _fixture(self, i, size):
+        '''`size` chants of a default dataset and `size` chants of a dataset of the user'''
+        default_name = DEFAULT_DATASET_NAMES[i]
+        chants = []
+        for j, (text, volpiano) in enumerate(synthetic_melodies(2 * size, seed=i)):
+            owned = j >= size
+            chants.append(Chant(
+                incipit=text[:30], full_text=text, volpiano=volpiano, cantus_id='c{}'.format(j % 2),
+                siglum='S{}-{}'.format(i, j // 2), folio='{:03d}r'.format(j), position=str(j),
+                dataset_name='mine-{}'.format(size) if owned else default_name,
+                dataset_idx=10 + i if owned else i, owner=self.user if owned else None))
+        Chant.objects.bulk_create(chants)
+        ids = list(Chant.objects.filter(dataset_idx__in=[i, 10 + i]).order_by('id').values_list('id', flat=True))
+        alpianos = [melody.ljust(40, '-')[:40] for _, melody in synthetic_melodies(2 * size, seed=i)]
+        intervals = [IntervalProcessor.transform_volpiano_to_intervals(melody)
+                     for _, melody in synthetic_melodies(2 * size, seed=i)]
+        intervals = [row.ljust(max(map(len, intervals)), '-') for row in intervals]
+        result = {'success': {'ids': ids, 'volpianos': alpianos}, 'alignmentMode': 'full'}
+        SavedAlignment.objects.create(user=self.user, name='alignment-{}'.format(size),
+                                      data=json.dumps({'alignment': result}))
+        return {'size': size, 'ids': ids, 'owned_ids': ids[size:], 'sources': [i, 10 + i], 'idx': 10 + i,
+                'name': 'mine-{}'.format(size), 'alpianos': alpianos, 'intervals': intervals, 'result': result,
+                'alignment': 'alignment-{}'.format(size)}
+
+    def assertConstantQueries(self, name, request):
+        shapes = []
+        for fixture in self.fixtures:
+            runtime_model.clear_cache()
+            with CaptureQueriesContext(connection) as captured:
+                response = request(fixture)
+            self.assertLess(response.status_code, 300, '{}: {}'.format(name, response.content[:500]))
+            shapes.append(Counter(_query_shape(query['sql']) for query in captured.captured_queries))
+        small, large = shapes
+        if small != large:
+            growing = ['  {} -> {}  {}'.format(small[shape], large[shape], shape)
+                       for shape in sorted(set(small) | set(large)) if small[shape] != large[shape]]
+            self.fail('{}: {} queries for {} chants, {} for {}; query counts that differ:\n{}'.format(
+                name, sum(small.values()), 2 * self.SIZES[0], sum(large.values()), 2 * self.SIZES[1],
+                '\n'.join(growing)))
+
+    def _align(self, mode, concatenated=False):
+        return lambda fixture: self.client.post('/api/chants/align/', {
+            'idsToAlign': json.dumps(fixture['ids']), 'mode': mode,
+            'keepLiquescents': 'true', 'concatenated': json.dumps(concatenated)})
+
+    def _align_add(self, mode):
+        rows = 'intervals' if mode == 'intervals' else 'alpianos'
+        return lambda fixture: self.client.post('/api/chants/align/add/', {
+            'idsToAdd': json.dumps(fixture['owned_ids']),
+            'alignment': json.dumps({
+                'success': {'ids': fixture['ids'][:fixture['size']],
+                            'volpianos': fixture[rows][:fixture['size']]},
+                'alignmentMode': mode})})
+
+    def test_chant_list_and_display(self):
+        self.assertConstantQueries('chant_list', lambda fixture: self.client.post('/api/chants/', {
+            'dataSources': json.dumps(fixture['sources']), 'hideChantsWithoutVolpiano': 'true'}))
+        self.assertConstantQueries('chant_display', lambda fixture: self.client.get(
+            '/api/chants/{}'.format(fixture['ids'][-1])))
+        self.assertConstantQueries('get_data_sources', lambda fixture: self.client.get('/api/chants/data-sources'))
+        self.assertConstantQueries('get_sigla', lambda fixture: self.client.post('/api/chants/fontes', {
+            'dataSources': json.dumps(fixture['sources'])}))
+
+    def test_alignments(self):
+        self.assertConstantQueries('chant_align syllables', self._align('syllables'))
+        self.assertConstantQueries('chant_align syllables concatenated', self._align('syllables', True))
+        with mock.patch('core.mafft.processes.run', _fake_mafft), \
+                mock.patch.object(Mafft, 'get_guide_tree', return_value=None):
+            for mode in ('full', 'intervals'):
+                self.assertConstantQueries('chant_align ' + mode, self._align(mode))
+                self.assertConstantQueries('chant_align {} concatenated'.format(mode), self._align(mode, True))
+                self.assertConstantQueries('chant_align_add ' + mode, self._align_add(mode))
+        self.assertConstantQueries('compute_estimate', lambda fixture: self.client.post('/api/chants/estimate/', {
+            'kind': 'align', 'idsToAlign': json.dumps(fixture['ids']), 'mode': 'full'}))
+        for fixture in self.fixtures:
+            ComputeJob.objects.create(kind='align', client='user:{}'.format(self.user.pk), state=ComputeJob.QUEUED,
+                                      job_id='job-{}'.format(fixture['size']), hostname=socket.gethostname(),
+                                      pid=os.getpid())
+        self.assertConstantQueries('compute_cancel', lambda fixture: self.client.post('/api/chants/cancel/', {
+            'jobId': 'job-{}'.format(fixture['size'])}))
+
+    def test_alignment_analysis(self):
+        self.assertConstantQueries('chant_align_stats', lambda fixture: self.client.post(
+            '/api/chants/align/stats/', {'alignmentName': fixture['alignment']}))
+        self.assertConstantQueries('chant_tree', lambda fixture: self.client.post('/api/chants/tree/', {
+            'ids': json.dumps(fixture['ids']), 'alpianos': json.dumps(fixture['alpianos'])}))
+        self.assertConstantQueries('chant_distances', lambda fixture: self.client.post('/api/chants/distances/', {
+            'ids': json.dumps(fixture['ids']), 'alpianos': json.dumps(fixture['alpianos'])}))
+        with fake_mb(self.temp_dir, 'exit 1\n'):
+            self.assertConstantQueries('mrbayes_volpiano', lambda fixture: self.client.post(
+                '/api/chants/mrbayes-volpiano/', {
+                    'ids': json.dumps(fixture['ids']), 'alpianos': json.dumps(fixture['alpianos']),
+                    'alignment_names': json.dumps([str(id) for id in fixture['ids']]),
+                    'numberOfGenerations': '1000'}))
+
+    def test_datasets(self):
+        self.assertConstantQueries('export_dataset', lambda fixture: self.client.post('/api/chants/export/', {
+            'idsToExport': json.dumps(fixture['ids'])}))
+        self.assertConstantQueries('create_dataset', lambda fixture: self.client.post(
+            '/api/chants/create-dataset/', {'idsToExport': json.dumps(fixture['ids']),
+                                            'name': 'copy-{}'.format(fixture['size'])}))
+        self.assertConstantQueries('add_to_dataset', lambda fixture: self.client.post(
+            '/api/chants/add-to-dataset/', {'idsToExport': json.dumps(fixture['ids']), 'idx': fixture['idx']}))
+        self.assertConstantQueries('delete_dataset', lambda fixture: self.client.post(
+            '/api/chants/delete-dataset/', {'name': 'copy-{}'.format(fixture['size'])}))
+        self.assertConstantQueries('update_volpiano', lambda fixture: self.client.post(
+            '/api/chants/update-volpiano/', {'id': fixture['owned_ids'][0], 'volpiano': '1---g---4'}))
+
+        def upload(fixture):
+            csv = StringIO()
+            pd.DataFrame([{'incipit': 'Ave {}'.format(i), 'full_text': 'Ave maria', 'volpiano': '1---g---4',
+                           'siglum': 'U{}'.format(i)} for i in range(fixture['size'])]).to_csv(csv, index=False)
+            upload_file = SimpleUploadedFile('upload.csv', csv.getvalue().encode(), content_type='text/csv')
+            return self.client.post('/api/chants/upload/', {'file': upload_file,
+                                                           'name': 'upload-{}'.format(fixture['size'])})
+        self.assertConstantQueries('upload_data', upload)
+
+    def test_accounts(self):
+        for fixture in self.fixtures:
+            for i in range(fixture['size']):
+                SavedAlignment.objects.create(user=self.user, name='extra-{}-{}'.format(fixture['size'], i),
+                                              data='{}')
+        tokens = {fixture['size']: Token.objects.create(user=User.objects.create_user(
+            'leaving-{}'.format(fixture['size']))).key for fixture in self.fixtures}
+        self.assertConstantQueries('register', lambda fixture: self.client.post('/api/chants/auth/register/', {
+            'username': 'new-{}'.format(fixture['size']), 'password': 'a long passphrase 42'}))
+        self.assertConstantQueries('login_view', lambda fixture: self.client.post('/api/chants/auth/login/', {
+            'username': 'queries', 'password': 'password'}))
+        self.assertConstantQueries('logout_view', lambda fixture: self.client.post(
+            '/api/chants/auth/logout/', HTTP_AUTHORIZATION='Token ' + tokens[fixture['size']]))
+        self.assertConstantQueries('me', lambda fixture: self.client.get('/api/chants/auth/me/'))
+        self.assertConstantQueries('alignment_list', lambda fixture: self.client.get('/api/chants/alignments/'))
+        self.assertConstantQueries('alignment_detail', lambda fixture: self.client.get(
+            '/api/chants/alignments/{}/'.format(fixture['alignment'])))
+        UserSettings.objects.create(user=self.user, data='{}')
+        self.assertConstantQueries('user_settings', lambda fixture: self.client.put(
+            '/api/chants/settings/', json.dumps({'settings': {'ids': fixture['ids']}}),
+            content_type='application/json'))
+        self.assertConstantQueries('server_metrics', lambda fixture: self.client.get('/api/chants/metrics/'))
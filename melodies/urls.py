@@ -15,6 +15,13 @@ urlpatterns = [
     url(r'^api/chants/$', views.chant_list),
     url(r'^api/chants/(?P<pk>[0-9]+)$', views.chant_display),
     url(r'^api/chants/align/$', views.chant_align),
+    url(r'^api/chants/align/add/$', views.chant_align_add),
+    url(r'^api/chants/align/stats/$', views.chant_align_stats),
+    url(r'^api/chants/tree/$', views.chant_tree),
+    url(r'^api/chants/distances/$', views.chant_distances),
+    url(r'^api/chants/estimate/$', views.compute_estimate),
+    url(r'^api/chants/cancel/$', views.compute_cancel),
+    url(r'^api/chants/metrics/$', views.server_metrics),
     url(r'^api/chants/upload/$', views.upload_data),
     url(r'^api/chants/data-sources', views.get_data_sources),
     url(r'^api/chants/fontes', views.get_sigla),
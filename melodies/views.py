@@ -1,29 +1,49 @@
-from django.http.response import JsonResponse
+from django.conf import settings
+from django.http.response import HttpResponse, JsonResponse
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 import logging
+import os
 from core.aligner import Aligner
+from core.alignment_analysis import AlignmentAnalyzer
+from core import metrics
 from core import mrbayes
+from core import profiling
 from core.cantus_schema import UploadError
+from core.distances import DistanceCalculator
 from core.chant_processor import ChantProcessor
 from core.exporter import Exporter
+from core.tree_builder import TreeBuilder
 from core.uploader import Uploader
 import json
-import pandas as pd
-from django.db.models import Q
-from pandas.errors import ParserError
+from django.db.models import Count, F, Q
 
 from melodies.access import (
     DEFAULT_DATASET_NAMES,
     all_ids_visible,
     is_default_dataset_name,
     ordered_data_sources,
+    owned_chants,
     user_owns_dataset,
     visible_chants,
 )
-from melodies.models import Chant
+from melodies.models import Chant, ComputeJob, SavedAlignment, VisibleChant
+from melodies.scheduler import (
+    ALIGN,
+    MRBAYES,
+    AdmissionError,
+    admitted,
+    alignment_cost,
+    alignment_features,
+    cancel_job,
+    client_key,
+    mrbayes_cost,
+    mrbayes_features,
+)
+from melodies.runtime_model import estimate_runtime
 from melodies.serializers import ChantSerializer
+from melodies.snapshot import get_snapshot
 
 # List view omits bulky fields (manuscript text, image URLs, etc.) that the table
 # does not display. Volpiano and full_text are kept for the dashboard and
@@ -33,15 +53,22 @@ CHANT_LIST_FIELDS = (
     'siglum', 'position', 'folio', 'feast_id', 'genre_id', 'office_id',
     'srclink', 'full_text', 'volpiano', 'dataset_name', 'dataset_idx',
 )
+# NULL incipits first on every backend, as in SQLite and the snapshot
+CHANT_LIST_ORDER = (F('incipit').asc(nulls_first=True), 'id')
 MAX_UPLOAD_BYTES = 80 * 1024 * 1024
 
 
 def _chants_dataframe(chants):
+    import pandas as pd
+
     field_names = [field.name for field in chants.model._meta.fields]
     return pd.DataFrame.from_records(list(chants.values_list()), columns=field_names)
 
 
 def _read_upload_csv(file):
+    import pandas as pd
+    from pandas.errors import ParserError
+
     if file.size and file.size > MAX_UPLOAD_BYTES:
         return None, JsonResponse(
             {'message': 'File is too large (80 MB maximum)'},
@@ -82,6 +109,13 @@ def _json_post(request, key, default):
     return json.loads(raw)
 
 
+def _admission_error_response(error, data):
+    response = JsonResponse(data, status=error.status)
+    if error.retry_after is not None:
+        response['Retry-After'] = str(error.retry_after)
+    return response
+
+
 @api_view(['POST'])
 def chant_list(request):
     try:
@@ -95,6 +129,23 @@ def chant_list(request):
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return JsonResponse(_snapshot_chant_list(
+            snapshot, request.user, data_sources, genres, offices, fontes,
+            incipit, hide_incomplete, hide_without_volpiano,
+        ), safe=False)
+
+    filters = _chant_list_filters(
+        data_sources, genres, offices, fontes, incipit,
+        hide_incomplete, hide_without_volpiano,
+    )
+    chants = visible_chants(request.user).filter(filters).order_by(*CHANT_LIST_ORDER).values(*CHANT_LIST_FIELDS)
+    return JsonResponse(list(chants), safe=False)
+
+
+def _chant_list_filters(data_sources, genres, offices, fontes, incipit,
+                        hide_incomplete, hide_without_volpiano):
     filters = Q()
 
     if data_sources:
@@ -111,16 +162,36 @@ def chant_list(request):
         filters &= Q(incipit__isnull=True) | ~Q(incipit__endswith='*')
     if hide_without_volpiano:
         filters &= Q(volpiano__isnull=False) & ~Q(volpiano='')
+    return filters
 
-    chants = visible_chants(request.user).filter(filters).order_by('incipit').values(*CHANT_LIST_FIELDS)
-    return JsonResponse(list(chants), safe=False)
+
+def _snapshot_chant_list(snapshot, user, data_sources, genres, offices, fontes,
+                         incipit, hide_incomplete, hide_without_volpiano):
+    '''Default rows come from the snapshot; only the user's own rows hit SQL.'''
+    rows = snapshot.filter_rows(
+        data_sources=data_sources, genres=genres, offices=offices, fontes=fontes,
+        incipit=incipit, hide_incomplete=hide_incomplete,
+        hide_without_volpiano=hide_without_volpiano,
+    )
+    chants = snapshot.records(rows, CHANT_LIST_FIELDS)
+
+    filters = _chant_list_filters(
+        data_sources, genres, offices, fontes, incipit,
+        hide_incomplete, hide_without_volpiano,
+    )
+    owned = list(owned_chants(user).filter(filters).values(*CHANT_LIST_FIELDS))
+    if owned:
+        chants.extend(owned)
+        chants.sort(key=lambda chant: (
+            chant['incipit'] is not None, chant['incipit'] or '', chant['id']))
+    return chants
 
 
 @api_view(['GET'])
 def chant_display(request, pk):
     try:
         chant = visible_chants(request.user).get(id=pk)
-    except Chant.DoesNotExist:
+    except VisibleChant.DoesNotExist:
         return JsonResponse({'message': 'The chant does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
     try:
@@ -190,6 +261,17 @@ def get_data_sources(request):
 @api_view(['POST'])
 def get_sigla(request):
     data_sources = json.loads(request.POST['dataSources'])
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        fontes = set()
+        if data_sources:
+            rows = snapshot.filter_rows(data_sources=data_sources)
+            fontes.update(snapshot.distinct('siglum', rows))
+            fontes.update(owned_chants(request.user).filter(
+                dataset_idx__in=data_sources
+            ).exclude(siglum__isnull=True).exclude(siglum='').values_list('siglum', flat=True).distinct())
+        return JsonResponse({"fontes": sorted(fontes)})
+
     fontes = visible_chants(request.user).filter(
         dataset_idx__in=data_sources
     ).exclude(siglum__isnull=True).exclude(siglum='').values_list('siglum', flat=True).distinct()
@@ -284,12 +366,189 @@ def chant_align(request):
     if not all_ids_visible(request.user, ids):
         return JsonResponse({'message': 'One or more chants are not available'}, status=status.HTTP_403_FORBIDDEN)
 
-    if mode == "full":
-        return JsonResponse(Aligner.alignment_pitches(ids, concatenated, keep_liquescents))
-    elif mode == "intervals":
-        return JsonResponse(Aligner.alignment_intervals(ids, concatenated, keep_liquescents))
-    else:
-        return JsonResponse(Aligner.alignment_syllables(ids, concatenated, keep_liquescents))
+    lengths = Aligner.get_volpiano_lengths(ids)
+    try:
+        with admitted(ALIGN, client_key(request), alignment_cost(lengths),
+                      alignment_features(lengths, mode, concatenated), job_id=request.POST.get('jobId')) as job:
+            if mode == "full":
+                result = Aligner.alignment_pitches(ids, concatenated, keep_liquescents)
+            elif mode == "intervals":
+                result = Aligner.alignment_intervals(ids, concatenated, keep_liquescents)
+            else:
+                result = Aligner.alignment_syllables(ids, concatenated, keep_liquescents)
+            # MAFFT errors come back as responses; they say nothing about its runtime
+            job.ran = not isinstance(result, JsonResponse)
+            if isinstance(result, JsonResponse):
+                return result
+            with profiling.stage('json'):
+                return JsonResponse(result)
+    except AdmissionError as e:
+        return _admission_error_response(e, {'message': e.message})
+
+
+def _find_alignment_result(payload):
+    '''Return the Aligner result stored in a saved alignment payload.'''
+    if not isinstance(payload, dict):
+        return None
+    if 'success' in payload and 'alignmentMode' in payload:
+        return payload
+    for value in payload.values():
+        if isinstance(value, dict) and 'success' in value and 'alignmentMode' in value:
+            return value
+    return None
+
+
+def _saved_alignment_payload(request, alignment_name):
+    '''Return (payload, error response) for a saved alignment of the logged-in user.'''
+    if not request.user.is_authenticated:
+        return None, JsonResponse({'message': 'Log in to use a saved alignment'},
+                                  status=status.HTTP_403_FORBIDDEN)
+    try:
+        saved = SavedAlignment.objects.get(user=request.user, name=alignment_name)
+    except SavedAlignment.DoesNotExist:
+        return None, JsonResponse({'message': 'Alignment not found'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        return json.loads(saved.data), None
+    except json.JSONDecodeError:
+        return None, None
+
+
+@api_view(['POST'])
+def chant_align_add(request):
+    try:
+        new_ids = json.loads(request.POST['idsToAdd'])
+        keep_liquescents = bool(_json_post(request, 'keepLiquescents', True))
+        fragments = bool(_json_post(request, 'fragments', False))
+        payload = _json_post(request, 'alignment', None)
+    except (KeyError, json.JSONDecodeError):
+        return JsonResponse({'message': 'idsToAdd and a valid alignment are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    alignment_name = request.POST.get('alignmentName')
+    if alignment_name:
+        payload, error = _saved_alignment_payload(request, alignment_name)
+        if error is not None:
+            return error
+
+    result = _find_alignment_result(payload)
+    success = (result.get('success') or {}) if result else {}
+    ids = success.get('ids') or []
+    aligned = success.get('volpianos') or []
+    if (result is None or result.get('alignmentMode') not in ('full', 'intervals')
+            or len(ids) != len(aligned) or any(isinstance(id, list) for id in ids)):
+        return JsonResponse({'message': 'Only non-concatenated full or interval alignments can be extended'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    existing = set(ids)
+    new_ids = [id for id in new_ids if id not in existing]
+    if not new_ids:
+        return JsonResponse(result)
+    if not all_ids_visible(request.user, ids + new_ids):
+        return JsonResponse({'message': 'One or more chants are not available'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        with admitted(ALIGN, client_key(request), alignment_cost(Aligner.get_volpiano_lengths(ids + new_ids)),
+                      job_id=request.POST.get('jobId')):
+            extended = Aligner.extend_alignment(ids, aligned, new_ids, result['alignmentMode'],
+                                                keep_liquescents=keep_liquescents, fragments=fragments)
+    except AdmissionError as e:
+        return _admission_error_response(e, {'message': e.message})
+    if isinstance(extended, JsonResponse):
+        return extended
+    return JsonResponse(extended)
+
+
+@api_view(['POST'])
+def chant_align_stats(request):
+    try:
+        payload = _json_post(request, 'alignment', None)
+        partitions = bool(_json_post(request, 'partitions', False))
+        partition_names = _json_post(request, 'partitionNames', None)
+    except json.JSONDecodeError:
+        return JsonResponse({'message': 'A valid alignment is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    alignment_name = request.POST.get('alignmentName')
+    if alignment_name:
+        payload, error = _saved_alignment_payload(request, alignment_name)
+        if error is not None:
+            return error
+
+    result = _find_alignment_result(payload)
+    alpianos = ((result.get('success') or {}).get('volpianos') or []) if result else []
+    if not alpianos:
+        return JsonResponse({'message': 'A valid alignment is required'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return JsonResponse(AlignmentAnalyzer.analyze(alpianos, partitions, partition_names))
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['POST'])
+def compute_estimate(request):
+    try:
+        kind = request.POST.get('kind', ALIGN)
+        if kind == MRBAYES:
+            alpianos = json.loads(request.POST['alpianos'])
+            features = mrbayes_features(alpianos, int(request.POST['numberOfGenerations']))
+        elif kind == ALIGN:
+            ids = json.loads(request.POST['idsToAlign'])
+            if not all_ids_visible(request.user, ids):
+                return JsonResponse({'message': 'One or more chants are not available'},
+                                    status=status.HTTP_403_FORBIDDEN)
+            features = alignment_features(Aligner.get_volpiano_lengths(ids), request.POST.get('mode', 'full'),
+                                          bool(_json_post(request, 'concatenated', False)))
+        else:
+            return JsonResponse({'message': 'Unknown computation'}, status=status.HTTP_400_BAD_REQUEST)
+    except (KeyError, ValueError):
+        return JsonResponse({'message': 'Invalid estimate request'}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse(estimate_runtime(kind, **features))
+
+
+@api_view(['POST'])
+def compute_cancel(request):
+    '''Cancel the client's alignment or MrBayes run started with this jobId.'''
+    job_id = request.POST.get('jobId')
+    if not job_id:
+        return JsonResponse({'message': 'A jobId is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not cancel_job(job_id, client_key(request)):
+        return JsonResponse({'message': 'No such running computation'}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse({'cancelled': True})
+
+
+def _directory_usage(path):
+    '''(bytes, files) under a directory'''
+    size, files = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass
+    return size, files
+
+
+@api_view(['GET'])
+def server_metrics(request):
+    '''Metrics of all workers in the Prometheus text format.'''
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_ADDRESSES and not request.user.is_staff:
+        return JsonResponse({'message': 'Not allowed'}, status=status.HTTP_403_FORBIDDEN)
+
+    gauges = []
+    jobs = dict(((kind, state), count) for kind, state, count in
+                ComputeJob.objects.values_list('kind', 'state').annotate(count=Count('pk')))
+    for kind in settings.COMPUTE_LIMITS:
+        for state in (ComputeJob.RUNNING, ComputeJob.QUEUED):
+            gauges.append(('chantlab_compute_jobs', {'kind': kind, 'state': state}, jobs.get((kind, state), 0)))
+    for name, path in (('mafft', settings.TEMP_DIR), ('mrbayes', settings.MRBAYES_TEMP_DIR)):
+        size, files = _directory_usage(path)
+        gauges.append(('chantlab_temp_dir_bytes', {'dir': name}, size))
+        gauges.append(('chantlab_temp_dir_files', {'dir': name}, files))
+
+    metrics.flush(settings.METRICS_DIR)
+    counters, histograms = metrics.collect(settings.METRICS_DIR)
+    return HttpResponse(metrics.render(counters, histograms, gauges),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @api_view(['POST'])
@@ -304,6 +563,13 @@ def mrbayes_volpiano(request):
         alpianos = json.loads(request.POST['alpianos'])
         alignment_names = json.loads(request.POST['alignment_names'])
         number_of_generations = int(request.POST['numberOfGenerations'])
+        stopval = float(request.POST.get('stopval') or settings.MRBAYES_STOPVAL or 0) or None
+        compact = bool(_json_post(request, 'compact', False))
+        max_seconds = settings.MRBAYES_MAX_SECONDS
+        if request.POST.get('maxSeconds'):
+            # callers may shorten the server's budget, not extend it
+            requested = float(request.POST['maxSeconds'])
+            max_seconds = min(requested, max_seconds) if max_seconds else requested
         if not all_ids_visible(request.user, ids):
             return JsonResponse({
                 'newick': "",
@@ -312,7 +578,19 @@ def mrbayes_volpiano(request):
                 'nexusConTre': "",
                 'error': 'One or more chants are not available'
             }, status=status.HTTP_403_FORBIDDEN)
-        return JsonResponse(mrbayes.mrbayes_analyzis(ids, alpianos, number_of_generations, alignment_names))
+        with admitted(MRBAYES, client_key(request), mrbayes_cost(len(alpianos), number_of_generations),
+                      mrbayes_features(alpianos, number_of_generations), job_id=request.POST.get('jobId')) as job:
+            result, job.ran = mrbayes.mrbayes_analyzis(ids, alpianos, number_of_generations, alignment_names,
+                                                       stopval=stopval, max_seconds=max_seconds, compact=compact)
+            return JsonResponse(result)
+    except AdmissionError as e:
+        return _admission_error_response(e, {
+            'newick': "",
+            'mbScript': "",
+            'nexusAlignment': "",
+            'nexusConTre': "",
+            'error': e.message
+        })
     except Exception as e:
         logging.error("mrbayes volpiano error: {}".format(e))
         return JsonResponse({
@@ -322,3 +600,65 @@ def mrbayes_volpiano(request):
             'nexusConTre': "",
             'error': str(e)
         })
+
+
+@api_view(['POST'])
+def chant_tree(request):
+    try:
+        ids = json.loads(request.POST['ids'])
+        alpianos = json.loads(request.POST['alpianos'])
+        alignment_names = _json_post(request, 'alignment_names', None)
+    except (KeyError, json.JSONDecodeError):
+        return JsonResponse({'newick': "", 'newickNamesDict': {}, 'error': 'ids and alpianos are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    method = request.POST.get('method', 'nj')
+    if method not in TreeBuilder.METHODS or len(ids) != len(alpianos):
+        return JsonResponse({'newick': "", 'newickNamesDict': {}, 'error': 'Invalid tree request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    if not all_ids_visible(request.user, ids):
+        return JsonResponse({'newick': "", 'newickNamesDict': {}, 'error': 'One or more chants are not available'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+    # concatenated alignments have one row per source, named by the caller
+    if alignment_names is None and any(isinstance(id, list) for id in ids):
+        alignment_names = [str(i) for i in range(len(ids))]
+    if alignment_names is None:
+        names = Aligner.get_newick_names(ids)
+        if isinstance(names, JsonResponse):
+            return names
+    else:
+        names = [str(name) for name in alignment_names]
+
+    try:
+        newick, labels = TreeBuilder.build(alpianos, names, method)
+    except ValueError as e:
+        return JsonResponse({'newick': "", 'newickNamesDict': {}, 'error': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse({
+        'newick': newick,
+        # keyed by the labels in the Newick string, not the raw names
+        'newickNamesDict': {label: id for label, id in zip(labels, ids)},
+        'method': method,
+        'error': ""
+    })
+
+
+@api_view(['POST'])
+def chant_distances(request):
+    try:
+        ids = json.loads(request.POST['ids'])
+        alpianos = json.loads(request.POST['alpianos'])
+    except (KeyError, json.JSONDecodeError):
+        return JsonResponse({'message': 'ids and alpianos are required'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(ids) != len(alpianos):
+        return JsonResponse({'message': 'Every aligned melody needs an id'}, status=status.HTTP_400_BAD_REQUEST)
+    if not all_ids_visible(request.user, ids):
+        return JsonResponse({'message': 'One or more chants are not available'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        content = DistanceCalculator.distance_json(
+            alpianos, request.POST.get('metric', 'p'), request.POST.get('mode', 'full'))
+    except ValueError as e:
+        return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return HttpResponse(content, content_type='application/json')
+
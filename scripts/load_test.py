@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""Load test of a running ChantLab server.
+
+Replays weighted request scenarios (list, filter, display, small and large
+alignments, upload, export) with a number of concurrent clients and reports
+throughput and latency percentiles per scenario. The requests are planned
+from a seed before the run; --save-plan stores the plan and --plan replays
+it, so runs against different worker/thread configurations send the same
+requests. --output stores the results, --compare prints stored results side
+by side.
+
+Examples:
+    python scripts/load_test.py --url http://localhost:8000 --concurrency 8 \\
+        --requests 200 --label "4 workers" --output 4workers.json
+    python scripts/load_test.py --compare 4workers.json 8workers.json
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+__version__ = "0.0.1"
+
+# scenario: relative weight in the default mix
+DEFAULT_WEIGHTS = {
+    'list': 20,
+    'filter': 20,
+    'display': 30,
+    'align_small': 15,
+    'align_large': 3,
+    'upload': 2,
+    'export': 10,
+}
+ALIGN_SMALL = 5
+ALIGN_LARGE = 50
+EXPORT_SIZE = 100
+UPLOAD_ROWS = 50
+GENRES = ['genre_a', 'genre_r', 'genre_v', 'genre_h']
+UPLOAD_CSV_HEADER = 'incipit,siglum,full_text,volpiano,genre_id,office_id\n'
+
+
+class Client(object):
+    def __init__(self, url, token=None, timeout=600):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method, path, data=None, files=None):
+        """Return (status, body); HTTP errors are returned, not raised."""
+        headers = {}
+        body = None
+        if self.token:
+            headers['Authorization'] = 'Token ' + self.token
+        if files:
+            body, content_type = _multipart(data or {}, files)
+            headers['Content-Type'] = content_type
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(self.url + path, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def json(self, method, path, data=None):
+        status, body = self.request(method, path, data)
+        if status != 200:
+            raise RuntimeError('{} {} returned {}: {}'.format(method, path, status, body[:200]))
+        return json.loads(body)
+
+
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode('utf-8'))
+    for name, (filename, content) in files.items():
+        lines.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: text/csv\r\n\r\n'.format(boundary, name, filename).encode('utf-8'))
+        lines.append(content + b'\r\n')
+    lines.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+    return b''.join(lines), 'multipart/form-data; boundary=' + boundary
+
+
+def login(client, username, password):
+    payload = client.json('POST', '/api/chants/auth/login/', {'username': username, 'password': password})
+    return payload['token']
+
+
+def fetch_corpus(client):
+    """Data source indexes and ids of the chants with a melody."""
+    sources = [idx for idx, _ in client.json('GET', '/api/chants/data-sources')['dataSources']]
+    chants = client.json('POST', '/api/chants/', {'dataSources': json.dumps(sources),
+                                                  'hideChantsWithoutVolpiano': 'true'})
+    ids = [chant['id'] for chant in chants]
+    if not ids:
+        raise RuntimeError('The server has no chants with a melody')
+    return sources, ids
+
+
+def plan_requests(scenarios, count, sources, ids, seed):
+    """A list of `count` (scenario, parameters) requests drawn by weight."""
+    rng = random.Random(seed)
+    names = sorted(scenarios)
+    weights = [scenarios[name] for name in names]
+    plan = []
+    for _ in range(count):
+        name = rng.choices(names, weights)[0]
+        if name == 'list':
+            params = {'dataSources': sources}
+        elif name == 'filter':
+            params = {'dataSources': sources, 'genres': rng.sample(GENRES, 2),
+                      'incipit': rng.choice('abcdefgilmnoprstuv')}
+        elif name == 'display':
+            params = {'id': rng.choice(ids)}
+        elif name in ('align_small', 'align_large'):
+            size = ALIGN_SMALL if name == 'align_small' else ALIGN_LARGE
+            params = {'ids': rng.sample(ids, min(size, len(ids)))}
+        elif name == 'export':
+            params = {'ids': rng.sample(ids, min(EXPORT_SIZE, len(ids)))}
+        elif name == 'upload':
+            params = {'rows': UPLOAD_ROWS}
+        else:
+            raise ValueError('Unknown scenario: {}'.format(name))
+        plan.append([name, params])
+    return plan
+
+
+def _upload_csv(rows):
+    lines = [UPLOAD_CSV_HEADER]
+    for i in range(rows):
+        lines.append('Load test {0},LT {1},Ave maria gratia plena,1---g--h---g---4,genre_a,office_v\n'.format(
+            i, i % 5))
+    return ''.join(lines).encode('utf-8')
+
+
+def send(client, name, params):
+    """Send one planned request; return its (HTTP status, seconds)."""
+    if name in ('list', 'filter'):
+        data = {'dataSources': json.dumps(params['dataSources'])}
+        if name == 'filter':
+            data['genres'] = json.dumps(params['genres'])
+            data['incipit'] = params['incipit']
+        request = ('POST', '/api/chants/', data, None)
+    elif name == 'display':
+        request = ('GET', '/api/chants/{}'.format(params['id']), None, None)
+    elif name in ('align_small', 'align_large'):
+        request = ('POST', '/api/chants/align/', {
+            'idsToAlign': json.dumps(params['ids']), 'mode': 'full',
+            'keepLiquescents': 'true', 'concatenated': 'false'}, None)
+    elif name == 'export':
+        request = ('POST', '/api/chants/export/', {'idsToExport': json.dumps(params['ids'])}, None)
+    elif name == 'upload':
+        if not client.token:
+            return None, 0.0
+        dataset_name = 'load-test-' + uuid.uuid4().hex[:12]
+        request = ('POST', '/api/chants/upload/', {'name': dataset_name},
+                   {'file': ('load-test.csv', _upload_csv(params['rows']))})
+    else:
+        raise ValueError('Unknown scenario: {}'.format(name))
+
+    started = time.perf_counter()
+    try:
+        status, _ = client.request(*request)
+    except OSError as e:
+        logging.info('{} failed: {}'.format(name, e))
+        status = 0
+    seconds = time.perf_counter() - started
+    if name == 'upload' and status == 200:
+        client.request('POST', '/api/chants/delete-dataset/', {'name': dataset_name})
+    return status, seconds
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return round(sorted_values[rank], 4)
+
+
+def summarize(samples, wall_seconds):
+    """Throughput and latency percentiles of (status, seconds) samples."""
+    latencies = sorted(seconds for status, seconds in samples if status == 200)
+    return {
+        'count': len(samples),
+        'ok': len(latencies),
+        'rejected': sum(1 for status, _ in samples if status == 429),
+        'errors': sum(1 for status, _ in samples if status not in (200, 429)),
+        'throughput': round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+        'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+        'p50': percentile(latencies, 0.50),
+        'p90': percentile(latencies, 0.90),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': round(latencies[-1], 4) if latencies else None,
+    }
+
+
+def run(client, plan, concurrency):
+    """Send the plan with `concurrency` clients; return per-scenario samples and the wall time."""
+    lock = threading.Lock()
+    position = [0]
+    samples = {}
+
+    def worker():
+        while True:
+            with lock:
+                if position[0] >= len(plan):
+                    return
+                name, params = plan[position[0]]
+                position[0] += 1
+            status, seconds = send(client, name, params)
+            if status is None:
+                continue
+            with lock:
+                samples.setdefault(name, []).append((status, seconds))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def _format(value, pattern='{:.3f}'):
+    return '-' if value is None else pattern.format(value)
+
+
+def print_results(results):
+    print('{:<12} {:>6} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'scenario', 'ok', '429', 'errors', 'req/s', 'p50', 'p95', 'p99', 'max'))
+    for name, result in sorted(results['scenarios'].items()) + [('TOTAL', results['total'])]:
+        print('{:<12} {:>6} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+            name, result['ok'], result['rejected'], result['errors'], _format(result['throughput']),
+            _format(result['p50']), _format(result['p95']), _format(result['p99']), _format(result['max'])))
+
+
+def compare(paths):
+    """Print throughput and p95 latency of stored runs side by side."""
+    runs = []
+    for path in paths:
+        with open(path) as input_fh:
+            runs.append(json.load(input_fh))
+    names = sorted(set(name for run_results in runs for name in run_results['scenarios'])) + ['TOTAL']
+    print('{:<12} '.format('scenario') + ' '.join('{:>24}'.format(run_results['label'][:24]) for run_results in runs))
+    print('{:<12} '.format('') + ' '.join('{:>24}'.format('req/s    p95    429') for _ in runs))
+    for name in names:
+        cells = []
+        for run_results in runs:
+            result = run_results['total'] if name == 'TOTAL' else run_results['scenarios'].get(name)
+            if result is None:
+                cells.append('{:>24}'.format('-'))
+            else:
+                cells.append('{:>24}'.format('{:>8} {:>6} {:>6}'.format(
+                    _format(result['throughput'], '{:.2f}'), _format(result['p95'], '{:.2f}'),
+                    result['rejected'])))
+        print('{:<12} '.format(name) + ' '.join(cells))
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__, add_help=True,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--url', action='store', default='http://localhost:8000',
+                        help='Base URL of the server (including a FORCE_SCRIPT_NAME prefix).')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='Number of concurrent clients.')
+    parser.add_argument('-n', '--requests', type=int, default=100,
+                        help='Number of requests to plan.')
+    parser.add_argument('--weights', action='store', default=None,
+                        help='JSON object of scenario weights, e.g. \'{"align_small": 1}\'.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the request plan.')
+    parser.add_argument('--plan', action='store', default=None,
+                        help='Replay a plan stored with --save-plan instead of planning.')
+    parser.add_argument('--save-plan', action='store', default=None,
+                        help='Store the request plan to this file.')
+    parser.add_argument('--username', action='store', default=None,
+                        help='Log in as this user (needed for the upload scenario).')
+    parser.add_argument('--password', action='store', default=None)
+    parser.add_argument('--token', action='store', default=None, help='API token instead of a login.')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Request timeout in seconds (gunicorn kills workers after 600).')
+    parser.add_argument('--label', action='store', default=None,
+                        help='Name of the server configuration, e.g. "4 workers, 2 threads".')
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help='Store the results as JSON.')
+    parser.add_argument('--compare', nargs='+', default=None,
+                        help='Print stored results side by side and exit.')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on INFO messages.')
+    parser.add_argument('--debug', action='store_true',
+                        help='Turn on DEBUG messages.')
+
+    return parser
+
+
+def main(args):
+    if args.compare:
+        compare(args.compare)
+        return
+
+    client = Client(args.url, token=args.token, timeout=args.timeout)
+    if args.username and not client.token:
+        client.token = login(client, args.username, args.password or '')
+
+    if args.plan:
+        with open(args.plan) as input_fh:
+            plan = json.load(input_fh)
+    else:
+        scenarios = dict(DEFAULT_WEIGHTS)
+        if args.weights:
+            scenarios = json.loads(args.weights)
+        sources, ids = fetch_corpus(client)
+        plan = plan_requests(scenarios, args.requests, sources, ids, args.seed)
+    if args.save_plan:
+        with open(args.save_plan, 'w') as output_fh:
+            json.dump(plan, output_fh)
+    if not client.token and any(name == 'upload' for name, _ in plan):
+        logging.warning('Skipping the upload scenario: it needs --username/--password or --token')
+
+    logging.info('Sending {} requests with {} clients to {}'.format(len(plan), args.concurrency, args.url))
+    samples, wall_seconds = run(client, plan, args.concurrency)
+    results = {
+        'label': args.label or '{} clients'.format(args.concurrency),
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'requests': len(plan),
+        'seconds': round(wall_seconds, 3),
+        'scenarios': {name: summarize(scenario_samples, wall_seconds)
+                      for name, scenario_samples in samples.items()},
+        'total': summarize([sample for scenario_samples in samples.values() for sample in scenario_samples],
+                           wall_seconds),
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output_fh:
+            json.dump(results, output_fh, indent=2)
+
+
+if __name__ == '__main__':
+    parser = build_argument_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    if args.debug:
+        logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
+
+    main(args)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Run the Django tests against PostgreSQL.
+
+Starts a throwaway PostgreSQL server, either a temporary cluster made with
+initdb/pg_ctl (found on PATH, with pg_config or in --bindir) or a docker
+container when those are missing, runs `manage.py test` with
+DATABASE_ENGINE=postgresql and removes the server again.
+
+Examples:
+    python scripts/test_postgres.py
+    python scripts/test_postgres.py --bindir /usr/lib/postgresql/16/bin melodies.tests.QueryCountTests
+    python scripts/test_postgres.py --docker --image postgres:16
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+__version__ = "0.0.1"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER = 'chantlab'
+PASSWORD = 'chantlab'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def find_bindir(bindir=None):
+    '''Directory with initdb and pg_ctl, or None.'''
+    candidates = [bindir] if bindir else []
+    if shutil.which('initdb'):
+        candidates.append(os.path.dirname(shutil.which('initdb')))
+    if shutil.which('pg_config'):
+        candidates.append(subprocess.check_output(['pg_config', '--bindir']).decode().strip())
+    for candidate in candidates:
+        if os.path.exists(os.path.join(candidate, 'initdb')) and os.path.exists(os.path.join(candidate, 'pg_ctl')):
+            return candidate
+    return None
+
+
+def wait_for_server(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError('PostgreSQL did not start on port {} within {} s'.format(port, timeout))
+
+
+class TemporaryCluster():
+    '''A cluster in a temporary directory, run by the current user.'''
+
+    def __init__(self, bindir, port):
+        self.bindir = bindir
+        self.port = port
+        self.directory = tempfile.mkdtemp(prefix='chantlab-postgres-')
+        self.data = os.path.join(self.directory, 'data')
+
+    def start(self):
+        password_file = os.path.join(self.directory, 'password')
+        with open(password_file, 'w') as password_fh:
+            password_fh.write(PASSWORD)
+        subprocess.check_call([os.path.join(self.bindir, 'initdb'), '-D', self.data, '-U', USER, '-A', 'md5',
+                               '--pwfile', password_file, '-E', 'UTF8'], stdout=subprocess.DEVNULL)
+        subprocess.check_call([os.path.join(self.bindir, 'pg_ctl'), '-D', self.data, '-w', '-l',
+                               os.path.join(self.directory, 'server.log'), '-o',
+                               '-p {} -k {} -c listen_addresses=127.0.0.1 -c fsync=off'.format(
+                                   self.port, self.directory), 'start'], stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.call([os.path.join(self.bindir, 'pg_ctl'), '-D', self.data, '-m', 'immediate', 'stop'],
+                        stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class DockerServer():
+    '''A postgres container removed when it stops.'''
+
+    def __init__(self, image, port):
+        self.image = image
+        self.port = port
+        self.name = 'chantlab-test-{}'.format(uuid.uuid4().hex[:8])
+
+    def start(self):
+        subprocess.check_call(['docker', 'run', '--rm', '-d', '--name', self.name, '-p',
+                               '127.0.0.1:{}:5432'.format(self.port), '-e', 'POSTGRES_USER=' + USER,
+                               '-e', 'POSTGRES_PASSWORD=' + PASSWORD, self.image,
+                               '-c', 'fsync=off'], stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.call(['docker', 'stop', self.name], stdout=subprocess.DEVNULL)
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__, add_help=True,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('labels', nargs='*', help='Test labels passed to manage.py test.')
+    parser.add_argument('--bindir', action='store', default=None,
+                        help='Directory with initdb and pg_ctl.')
+    parser.add_argument('--docker', action='store_true',
+                        help='Use a docker container even if initdb is available.')
+    parser.add_argument('--image', action='store', default='postgres:16',
+                        help='Docker image of the container.')
+    parser.add_argument('--port', type=int, default=None, help='Server port (default: a free one).')
+    parser.add_argument('--startup-timeout', type=float, default=60,
+                        help='Seconds to wait for the server.')
+
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Turn on INFO messages.')
+    parser.add_argument('--debug', action='store_true',
+                        help='Turn on DEBUG messages.')
+
+    return parser
+
+
+def main(args):
+    port = args.port or free_port()
+    bindir = None if args.docker else find_bindir(args.bindir)
+    if bindir:
+        server = TemporaryCluster(bindir, port)
+    elif shutil.which('docker'):
+        server = DockerServer(args.image, port)
+    else:
+        logging.error('Neither initdb/pg_ctl (see --bindir) nor docker was found')
+        return 1
+
+    logging.info('Starting {} on port {}'.format(type(server).__name__, port))
+    server.start()
+    try:
+        wait_for_server(port, args.startup_timeout)
+        env = dict(os.environ, DATABASE_ENGINE='postgresql', POSTGRES_DB='chantlab', POSTGRES_USER=USER,
+                   POSTGRES_PASSWORD=PASSWORD, POSTGRES_HOST='127.0.0.1', POSTGRES_PORT=str(port),
+                   CHANTLAB_SKIP_SEED='1')
+        return subprocess.call([sys.executable, 'manage.py', 'test'] + args.labels, cwd=ROOT, env=env)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    parser = build_argument_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    if args.debug:
+        logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
+
+    sys.exit(main(args))